@@ -36,11 +36,43 @@
 # -p <PORT>
 # -U <db user>
 # -m [html format flag]
-# -r [dry run flag]
+# -r [dry run flag: only plan the report, listing the sections and the estimated cost of their catalog queries]
 # -v [verbose output flag, mostly used for debugging]
+# --topn <number of rows in top-N workload lists, default 10>
+# --statedir <directory for snapshots kept between runs, default temp directory>
+# --ash <seconds to sample active sessions for wait event profiling, default 0 (off)>
+# --ash-interval <seconds between active session samples, default 0.5>
+# --walsample <seconds between WAL position samples used for the WAL generation rate, default 5, 0 to skip>
+# --archive-dircount [count archive_status files with pg_ls_dir instead of using pg_stat_archiver]
+# --gzip [gzip compress the report file]
+# --capture <archive file: only collect data (queries and os probes) and write it to a compressed archive>
+# --replay <archive file: generate the report offline from a capture archive, no database needed>
+# --execute [vacuum freeze and analyze the candidates found]
+# --jobs <maximum concurrent maintenance jobs with --execute, default 1>
+# --maxduration <minutes after which no new maintenance jobs are started, default 0 (no limit)>
+# --checks <comma separated report sections to run, default all: healthchecks, pgmemory, bloated, unusedindexes,
+#           redundantindexes, tablemaintenance, autovacuum, replication, locks, ash, workload, iohotspots, seqscans, logs, hostio, export, maintenance>
+# --results <file to also write the check results and lists to as json>
+# --iosample <seconds between /proc disk, pressure and vmstat samples during the report for local servers, default 2, 0 to skip>
+# --logs [analyze the server log files of a local server, resuming where the previous run stopped]
+# --log-jobs <worker processes for --logs, default one per cpu>
+# --max-query-cost <skip checks whose catalog query the planner estimates above this cost, default 0 (no limit)>
+# --partitions [roll leaf partitions up to their partitioned table in the bloat, freeze and analyze lists]
+# --checksdir <directory of *.sql checks, each with "-- key: value" header lines, run after the section they name>
+# --compare <OLD NEW: report what changed between two --results files or two snapshots, no database needed>
+# --offload-to <standby dsn, or auto for a streaming standby: run the heavy catalog only queries there>
+# --export <directory for the bloat, unused index, freeze and analyze lists as gzip csv files, with a manifest>
 #
 # Examples: run report on entire test database and output in web format
 # ./pg_report.py -d dvdrental --html --dryrun
+# capture on production, generate the report somewhere else
+# ./pg_report.py -d dvdrental --capture /tmp/dvdrental.capture.gz
+# ./pg_report.py --replay /tmp/dvdrental.capture.gz --html
+# freeze and analyze the candidates, 2 at a time, for at most an hour
+# ./pg_report.py -d dvdrental --execute --jobs 2 --maxduration 60
+# from python, without a subprocess:
+#   import pg_report
+#   results = pg_report.run_report([{'database': 'dvdrental'}], checks=['healthchecks', 'locks'], options={'html': True})
 #
 # Requirements:
 #  1. python 2.6+ or 3.x
@@ -72,11 +104,32 @@
 #  1. Get database conflicts, deadlocks, and temp_files.
 #  2. Unused indexes are identified where there are less than 20 index scans and thee size of the table is > 100 MB.
 #  3. Bloated tables/indexes are identified where at least 20% of the table/index is bloated or the wasted bytes is > 1GB.
-#  4. See if archiving is getting behind by more than 1000 WAL files.
+#  4. See if archiving is getting behind by more than 1000 WAL files or failing, based on pg_stat_archiver.
 #  5. Contrast PG memory configuration to recommended ones
 #  6. Identify orphaned large objects.
-#  7. List tables getting close to transaction wraparound (more than halfway to max freeze threshold).
+#  7. List tables getting close to transaction or multixact wraparound (more than halfway to max freeze threshold).
 #  8. list tables that have not been analyzed or vacuumed in the last 60 days or whose size has grown significantly.
+#  9. List duplicate and left-prefix redundant indexes with their wasted bytes and write cost.
+# 10. List root blocking sessions with the size of their blocked subtree, plus lock counts by relation and mode.
+# 11. Optionally sample pg_stat_activity for a wait event profile and the top waiting queries.
+# 12. Replication lag per standby, WAL generation rate, and WAL retained by replication slots.
+# 13. List top-N pg_stat_statements by total time, mean time, shared blocks read, temp blocks written and calls,
+#     using deltas since the previous snapshot when one exists.  Statements without a baseline are left out of deltas.
+# 14. Optionally vacuum freeze and analyze the candidates from 7. and 8., pausing while the load is high.
+# 15. Base the work_mem recommendation on temp file spills, peak active sessions and autovacuum memory when measured.
+# 16. Rank tables and indexes by blocks read outside shared_buffers and flag tables larger than shared_buffers.
+# 17. Autovacuum advisor: distance to the vacuum and analyze triggers, and per table scale factor and cost limit settings.
+# 18. Optionally read the local server logs for checkpoint durations, lock wait hot spots, temp file spills and slow statements.
+# 19. Sample disk I/O, pressure stalls and swapping on local linux hosts while the report runs.
+# 20. Size vm.nr_hugepages for the instance's shared memory and check huge_pages and transparent huge pages on local hosts.
+# 21. With -r, only plan the report: the sections that would run and EXPLAIN estimates for their catalog queries.
+# 22. Cache bloat estimates per table in the state directory and only estimate new or changed tables again.
+# 23. Optionally roll leaf partitions up to their partitioned table, with the worst leaves of each.
+# 24. Optionally run user sql checks from a directory, the cheap ones of a section batched into one psql call.
+# 25. Optionally compare two saved runs: changed check status, rows entering or leaving lists and values that moved.
+# 26. Optionally run the heavy catalog only queries on a hot standby and list which node served each section.
+# 27. Optionally export the detail lists into gzip csv files, with a manifest of row counts and times.
+# 28. Rank large tables by the data their sequential scans read and match them to the top statements that name them.
 #
 # TODOs:
 #
@@ -119,7 +172,13 @@ import string, sys, os, time
 from datetime import datetime
 from datetime import date
 
-import tempfile, platform, math
+import tempfile, platform, math, json, gzip, shutil, re, mmap, csv, multiprocessing, threading
+from collections import deque
+try:
+    from sys import intern
+except ImportError:
+    # python 2 has it as a builtin
+    pass
 from decimal import *
 import smtplib
 import subprocess
@@ -146,6 +205,95 @@ PROGDATE   = "2022-06-23"
 MARK_OK    = "[ OK ]  "
 MARK_WARN  = "[WARN]  "
 
+# html list sections are rendered client side from embedded json, one page at a time
+REPORT_PAGESIZE = 100
+
+# workload based work_mem: share of spilling calls to cover, in memory size of a spill relative to its temp file,
+# share of RAM for all memory consumers, sort/hash operations per active query
+WORKMEM_SPILL_COVERAGE = 0.9
+WORKMEM_SPILL_FACTOR   = 2
+WORKMEM_RAM_FRACTION   = 0.75
+WORKMEM_OPS_PER_QUERY  = 2
+
+# autovacuum advisor: tables smaller than this are only checked when past a trigger, most dead space to allow
+# between autovacuum runs, longest throttled vacuum run to allow, smallest scale factor to recommend
+AUTOVAC_MIN_BYTES      = 67108864
+AUTOVAC_MAX_DEAD_BYTES = 536870912
+AUTOVAC_MAX_SECONDS    = 3600
+AUTOVAC_MIN_SCALE      = 0.002
+
+# log analyzer: bytes per chunk handed to a worker process, and the messages it looks for
+LOG_CHUNK_BYTES   = 67108864
+LOG_RE_START      = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d')
+LOG_RE_LEVEL      = re.compile(r'\b(?:LOG|ERROR|WARNING|FATAL|PANIC|STATEMENT|DETAIL|HINT|CONTEXT|NOTICE|INFO|DEBUG\d?):  ')
+LOG_RE_CHECKPOINT = re.compile(r'^(checkpoint|restartpoint) complete: .*?write=([\d.]+) s, sync=([\d.]+) s, total=([\d.]+) s', re.S)
+LOG_RE_LOCKWAIT   = re.compile(r'^process \d+ (still waiting for|acquired) (\w+) on (.+?) after ([\d.]+) ms', re.S)
+LOG_RE_TEMPFILE   = re.compile(r'^temporary file: path "[^"]*", size (\d+)')
+LOG_RE_DURATION   = re.compile(r'^duration: ([\d.]+) ms\s+(?:statement|execute [^:]*|bind [^:]*|parse [^:]*): (.*)', re.S)
+LOG_TEMP_BUCKETS  = [1048576, 16777216, 268435456, 1073741824]
+
+# host I/O sampler: warn above this device utilization, average wait per I/O, or share of time stalled on I/O
+HOSTIO_MAX_UTIL  = 80
+HOSTIO_MAX_AWAIT = 20
+HOSTIO_MAX_STALL = 10
+
+# huge pages: recommend them from this shared_buffers size (MB) up, page table memory grows with every backend
+HUGEPAGES_MIN_SHARED = 8192
+
+# user sql checks (--checksdir): the "-- key: value" header lines a check file may have, and its warn_if condition
+SQLCHECK_KEYS    = ['name', 'section', 'minversion', 'cost', 'value', 'warn_if', 'ok', 'warn', 'list', 'headers']
+SQLCHECK_RE_WARN = re.compile(r'^(>=|<=|!=|=|>|<)\s*(-?[\d.]+)$')
+SQLCHECK_MARKER  = '@@pg_report_check '
+
+# --compare: list columns that identify a row, and the relative change (pct) of a number that is reported
+COMPARE_KEYS       = ['schemaname', 'schema', 'tablename', 'table', 'iname', 'fqindexname', 'index', 'redundant index', 'queryid', 'query id',
+                      'slot', 'application', 'client', 'pid', 'relation or lock type', 'lock object', 'mode', 'kind', 'statement', 'device',
+                      'used for', 'section', 'check', 'command']
+COMPARE_MIN_CHANGE = 50
+
+# sequential scan advisor: only tables from this size up, and flag them when a scan reads at least this many rows
+SEQSCAN_MIN_BYTES = 67108864
+SEQSCAN_MIN_ROWS  = 10000
+
+# --offload-to: do not use a standby whose replay is further behind the primary than this (bytes of WAL)
+OFFLOAD_MAX_LAG = 268435456
+
+# --export: bytes read from psql at a time while streaming a \copy into its gzip file
+EXPORT_CHUNK_BYTES = 1048576
+
+# run_report: probes of the host, not of a database, that run once and are shared by all targets of one call
+SHARED_PROBES = ['which psql', 'bindir', 'free', 'overcommit_memory', 'overcommit_ratio']
+
+# report sections in the order they run, and the method that generates each.  tablemaintenance and maintenance
+# work on the candidates found by healthchecks.
+REPORT_SECTIONS = [('healthchecks', 'do_report_healthchecks'), ('pgmemory', 'do_report_pgmemory'), ('bloated', 'do_report_bloated'),
+                   ('unusedindexes', 'do_report_unusedindexes'), ('redundantindexes', 'do_report_redundantindexes'),
+                   ('tablemaintenance', 'do_report_tablemaintenance'), ('autovacuum', 'do_report_autovacuum'), ('replication', 'do_report_replication'), ('locks', 'do_report_locks'),
+                   ('ash', 'do_report_ash'), ('workload', 'do_report_workload'), ('iohotspots', 'do_report_iohotspots'), ('seqscans', 'do_report_seqscans'), ('logs', 'do_report_logs'), ('hostio', 'do_report_hostio'), ('export', 'do_export'), ('maintenance', 'do_maintenance')]
+REPORT_SCRIPT = r"""
+var pgrData = {};
+function pgrEsc(v) { return String(v).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;'); }
+function pgrRender(id, page) {
+    if (!(id in pgrData)) { pgrData[id] = JSON.parse(document.getElementById(id + '_data').textContent); }
+    var d = pgrData[id], size = %d, pages = Math.max(1, Math.ceil(d.r.length / size));
+    page = Math.min(Math.max(page, 0), pages - 1);
+    var h = '<table class="table1"><tr>', r, c, end = Math.min(d.r.length, (page + 1) * size);
+    for (c = 0; c < d.h.length; c++) { h += '<th>' + pgrEsc(d.h[c]) + '</th>'; }
+    h += '</tr>';
+    for (r = page * size; r < end; r++) {
+        h += '<tr valign="top">';
+        for (c = 0; c < d.r[r].length; c++) { h += '<td>' + pgrEsc(d.r[r][c]) + '</td>'; }
+        h += '</tr>';
+    }
+    h += '</table>';
+    if (pages > 1) {
+        h += '<p><button onclick="pgrRender(\'' + id + '\', ' + (page - 1) + ')">&lt;</button> page ' + (page + 1) + ' of ' + pages +
+             ' <button onclick="pgrRender(\'' + id + '\', ' + (page + 1) + ')">&gt;</button></p>';
+    }
+    document.getElementById(id).innerHTML = h;
+}
+""" % REPORT_PAGESIZE
+
 #############################################################################################
 ########################### class definition ################################################
 #############################################################################################
@@ -195,6 +343,7 @@ class maint:
         self.bloatedtables     = False
         self.unusedindexes     = False
         self.freezecandidates  = False
+        self.freezerows        = []
         self.analyzecandidates = False
         self.timestartmins     = time.time() / 60
         self.loadthreshold     = 70.0
@@ -213,6 +362,96 @@ class maint:
         self.overcommit_memory = -1
         self.overcommit_ratio  = -1
 
+        # workload and snapshot stuff
+        self.topn              = 10
+        self.statedir          = self.tempdir
+        self.snapshotfile      = ''
+        self.prevsnapshot      = {}
+        self.snapshot          = {}
+        self.listcnt           = 0
+        self.gzip              = False
+
+        # maintenance executor stuff
+        self.execute           = False
+        self.jobs              = 1
+        self.maxduration       = 0
+        self.maint_deadline    = 0
+        self.maint_pause       = 30
+        self.maint_progress    = 10
+        self.maint_appname     = 'pg_report_maint'
+
+        # structured results, for library callers and --results
+        self.enabled           = []
+        self.cursection        = ''
+        self.checks            = []
+        self.sections          = []
+
+        # pg_stat_statements counters, shared by the workload and sequential scan sections
+        self.statements        = None
+
+        # capture/replay stuff
+        self.capturefile       = ''
+        self.replayfile        = ''
+        self.probes            = {}
+        self.probeidx          = {}
+        self.capturemeta       = {}
+
+        # host io sampling stuff
+        self.iosample_seconds  = 2
+        self.iosampler         = None
+        self.checkpointwarn    = False
+        self.writerwarn        = False
+
+        # log analysis stuff
+        self.logs              = False
+        self.log_jobs          = 0
+        self.logoffsetsfile    = ''
+        self.logoffsets        = None
+
+        # query cost guard stuff
+        self.max_query_cost    = 0
+
+        # bloat cache stuff
+        self.bloatcachefile    = ''
+        self.bloatrows         = None
+
+        # partition rollup stuff
+        self.partitions        = False
+        self.partitionmap      = None
+
+        # user sql checks stuff
+        self.checksdir         = ''
+        self.sqlchecks         = []
+
+        # export stuff
+        self.exportdir         = ''
+
+        # standby offload stuff
+        self.offloadto         = ''
+        self.offloadconn       = ''
+        self.offloadname       = ''
+        self.sectionnodes      = {}
+
+        # active session history stuff
+        self.ash_seconds       = 0
+        self.ash_interval      = 0.5
+        self.ash_maxsamples    = 100000
+        self.ash_samples       = deque(maxlen=self.ash_maxsamples)
+        self.ash_queries       = {}
+        self.ash_samplecnt     = 0
+
+        # wal sampling stuff
+        self.walsample_seconds = 5
+        self.walsamples        = []
+        self.walsample_started = 0
+        self.walrate           = -1
+        self.archiverate       = -1
+        self.archive_dircount  = False
+
+        # library stuff: run_report shares host probes and caches between its targets and keeps the console quiet
+        self.shared            = {}
+        self.quiet             = False
+
     ###########################################################
     def set_dbinfo(self, dbhost, dbport, dbuser, database, schema, html_format, dryrun, verbose, argv):
         self.dbhost          = dbhost
@@ -244,6 +483,15 @@ class maint:
             self.reportfile        = "%s%s%s_report.html" % (self.tempdir, self.dir_delim, self.pid)
         else:    
             self.reportfile        = "%s%s%s_report.txt" % (self.tempdir, self.dir_delim, self.pid)
+        if self.capturefile != '':
+            # capture only collects, the report is generated later with --replay
+            self.reportfile        = os.devnull
+
+        # snapshots persist between runs, so key them by cluster and database, not by pid
+        hostkey = self.dbhost if self.dbhost != '' else 'localhost'
+        self.snapshotfile      = "%s%spg_report_%s_%s_%s_snapshot.json" % (self.statedir, self.dir_delim, hostkey, self.dbport, self.database)
+        self.logoffsetsfile    = "%s%spg_report_%s_%s_logoffsets.json" % (self.statedir, self.dir_delim, hostkey, self.dbport)
+        self.bloatcachefile    = "%s%spg_report_%s_%s_%s_bloatcache.json" % (self.statedir, self.dir_delim, hostkey, self.dbport, self.database)
         
 
         # construct the connection string that will be used in all database requests
@@ -277,7 +525,7 @@ class maint:
         else:
             # assume windows
             cmd = "where psql"
-        rc, results = self.executecmd(cmd, True)
+        rc, results = self.executecmd(cmd, True, probe='which psql')
         if rc != SUCCESS:
             errors = "Unable to determine if psql is in path. rc=%d results=%s" % (rc,results)
             return rc, errors
@@ -330,7 +578,7 @@ class maint:
 
         if self.opsys == 'posix':
             cmd = "free -g | grep Mem: | /usr/bin/awk '{ total=$2; } END { print \"total=\" total  }'"
-            rc, results = self.executecmd(cmd, True)
+            rc, results = self.executecmd(cmd, True, probe='free')
             if rc != SUCCESS:
                 errors = "unable to get Total Physical Memory.  rc=%d %s\n" % (rc, results)
                 aline = "%s" % (errors)
@@ -357,7 +605,7 @@ class maint:
         overcommit_ratio  = -1
         if self.opsys == 'posix':
             cmd = "cat /proc/sys/vm/overcommit_memory"
-            rc, results = self.executecmd(cmd, True)
+            rc, results = self.executecmd(cmd, True, probe='overcommit_memory')
             if rc != SUCCESS:
                 errors = "unable to get overcommit_memory.  rc=%d %s\n" % (rc, results)
                 aline = "%s" % (errors)
@@ -366,7 +614,7 @@ class maint:
             overcommit_memory = int(results[0].strip())
             
             cmd = "cat /proc/sys/vm/overcommit_ratio"
-            rc, results = self.executecmd(cmd, True)
+            rc, results = self.executecmd(cmd, True, probe='overcommit_ratio')
             if rc != SUCCESS:
                 errors = "unable to get overcommit_ratio.  rc=%d %s\n" % (rc, results)
                 aline = "%s" % (errors)
@@ -390,10 +638,11 @@ class maint:
             # do something here later if we enable a db driver
             self.connected = false
         # print ("deleting temp file: %s" % self.tempfile)
-        try:
-            os.remove(self.tempfile)
-        except OSError:
-            pass
+        for afile in (self.tempfile, self.workfile, self.workfile_deferred):
+            try:
+                os.remove(afile)
+            except OSError:
+                pass
         return
 
     ###########################################################
@@ -432,6 +681,15 @@ class maint:
         return Decimal(valuefloat)
 
 
+    ###########################################################
+    def prettysize(self, numbytes):
+        # same units as pg_size_pretty()
+        for unit in ['bytes', 'kB', 'MB', 'GB']:
+            if abs(numbytes) < 10240:
+                return "%d %s" % (numbytes, unit)
+            numbytes = numbytes / 1024.0
+        return "%d TB" % numbytes
+
     ###########################################################
     def writeout(self,aline):
         if self.fout != '':
@@ -442,13 +700,461 @@ class maint:
             print (aline)
         return
 
+    ###########################################################
+    def shellquote(self, astring):
+        # wrap in single quotes so sql text can contain double quotes, dollar signs, etc.
+        return "'" + astring.replace("'", "'\"'\"'") + "'"
+
+    ###########################################################
+    def quoteident(self, name):
+        return '"' + name.replace('"', '""') + '"'
+
+    ###########################################################
+    def htmlescape(self, astring):
+        return str(astring).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+    ###########################################################
+    def get_rows(self, sql, connstring='', probe=''):
+
+        # returns unaligned, tuples-only rows split into columns.
+        # NOTE: text columns that may contain pipes or newlines must be cleaned up in the sql itself
+        if connstring == '':
+            connstring = self.connstring
+        if len(sql) > 65536:
+            # long statements, like large oid lists, go through a file to stay under the command line limit
+            f = open(self.workfile, "w")
+            f.write(sql)
+            f.close()
+            cmd = "psql %s -X -q -A -t -f %s > %s" % (connstring, self.workfile, self.tempfile)
+        else:
+            cmd = "psql %s -X -q -A -t -c %s > %s" % (connstring, self.shellquote(sql), self.tempfile)
+        rc, results = self.executecmd(cmd, False, probe)
+        if rc != SUCCESS:
+            return rc, results
+
+        rows = []
+        f = open(self.tempfile, "r")
+        for line in f:
+            aline = line.rstrip('\r\n')
+            if len(aline.strip()) < 1:
+                continue
+            rows.append(aline.split('|'))
+        f.close()
+        return SUCCESS, rows
+
+    ###########################################################
+    def get_batch_rows(self, sqls, probe=''):
+
+        # several queries in one psql session and round trip, each result preceded by a marker line.
+        # Returns the rows of each query, or an error if any of them failed.
+        script = ""
+        for i in range(len(sqls)):
+            script += "\\echo %s%d\n%s;\n" % (SQLCHECK_MARKER, i, sqls[i].strip().rstrip(';'))
+        f = open(self.workfile, "w")
+        f.write(script)
+        f.close()
+        cmd = "psql %s -X -q -A -t -f %s > %s" % (self.connstring, self.workfile, self.tempfile)
+        rc, results = self.executecmd(cmd, False, probe)
+        if rc != SUCCESS:
+            return rc, results
+        if 'ERROR:' in results:
+            return ERROR, results.strip()
+
+        batches = []
+        f = open(self.tempfile, "r")
+        for line in f:
+            aline = line.rstrip('\r\n')
+            if aline.startswith(SQLCHECK_MARKER):
+                batches.append([])
+            elif len(aline.strip()) > 0 and len(batches) > 0:
+                batches[-1].append(aline.split('|'))
+        f.close()
+        if len(batches) != len(sqls):
+            return ERROR, "Unexpected output from %d queries: %d results" % (len(sqls), len(batches))
+        return SUCCESS, batches
+
+    ###########################################################
+    def appendcheck(self, marker, category, msg):
+
+        self.checks.append({'section': self.cursection, 'category': category, 'status': 'ok' if marker == MARK_OK else 'warn', 'message': msg})
+        if self.capturefile != '':
+            # a capture only collects, the replay renders and prints the report
+            return SUCCESS, ""
+        if not self.quiet:
+            print (marker+msg)
+
+        if self.html_format:
+            if marker == MARK_OK:
+                color = "blue"
+                icon  = "&#10004;"
+            else:
+                color = "red"
+                icon  = "&#10060;"
+            html = "<tr><td width=\"5%\"><font color=\"" + color + "\">" + icon + "</font></td><td width=\"20%\"><font color=\"" + color + "\">" + self.htmlescape(category) + \
+                   "</font></td><td width=\"75%\"><font color=\"" + color + "\">" + self.htmlescape(msg) + "</font></td></tr>\n"
+            self.appendreport(html)
+        else:
+            self.appendreport(marker+msg+"\n")
+        return SUCCESS, ""
+
+    ###########################################################
+    def appendlist(self, title, headers, rows):
+
+        # the id only depends on the section and the title text without numbers, so it is stable between runs
+        sectionid = "%s.%s" % (self.cursection, re.sub('[^a-z]+', '_', title.lower()).strip('_')[:60])
+        self.sections.append({'id': sectionid, 'section': self.cursection, 'title': title, 'headers': headers, 'rows': rows})
+        if self.capturefile != '':
+            return SUCCESS, ""
+
+        if self.html_format:
+            # List data is embedded once as compact json and the browser renders one page at a time when the
+            # section is opened, so even very long lists keep the html small and the page opens instantly.
+            self.listcnt += 1
+            listid = "list%d" % self.listcnt
+            data = json.dumps({'h': headers, 'r': rows}, separators=(',', ':')).replace('</', '<\\/')
+            if len(rows) <= REPORT_PAGESIZE:
+                opened = " open"
+            else:
+                opened = ""
+            html = "<details id=\"" + listid + "_d\"" + opened + " ontoggle=\"if (this.open) pgrRender('" + listid + "', 0)\"><summary><b>" + self.htmlescape(title) + \
+                   "</b> (" + str(len(rows)) + " rows)</summary><div id=\"" + listid + "\"></div></details>\n" + \
+                   "<script type=\"application/json\" id=\"" + listid + "_data\">" + data + "</script>\n<p><br></p>"
+            self.appendreport(html)
+            return SUCCESS, ""
+
+        widths = [len(header) for header in headers]
+        for row in rows:
+            for idx, col in enumerate(row):
+                widths[idx] = max(widths[idx], len(str(col)))
+        f = open(self.reportfile, "a")
+        f.write("\n%s\n" % title)
+        f.write(" | ".join([header.ljust(widths[idx]) for idx, header in enumerate(headers)]) + "\n")
+        f.write("-+-".join(['-' * width for width in widths]) + "\n")
+        for row in rows:
+            f.write(" | ".join([str(col).ljust(widths[idx]) for idx, col in enumerate(row)]) + "\n")
+        f.write("(%d rows)\n" % len(rows))
+        f.close()
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_results(self):
+
+        return {'dbhost': self.dbhost, 'dbport': self.dbport, 'database': self.database, 'schema': self.schema, 'pgversion': str(self.pgversionminor),
+                'taken': self.snapshot.get('taken', time.time()), 'reportfile': self.reportfile, 'checks': self.checks, 'sections': self.sections,
+                'nodes': self.sectionnodes}
+
+    ###########################################################
+    def save_results(self, resultsfile):
+
+        try:
+            f = open(resultsfile, "w")
+            json.dump(self.get_results(), f, indent=1)
+            f.close()
+        except (IOError, OSError) as e:
+            return ERROR, "Unable to write results file, %s: %s" % (resultsfile, e)
+        return SUCCESS, ""
+
+    ###########################################################
+    def load_compare_file(self, filename):
+
+        # a --results file, or a snapshot from the state directory
+        try:
+            f = open(filename, "r")
+            data = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError) as e:
+            return ERROR, "Unable to load %s: %s" % (filename, e)
+        if isinstance(data, list) and len(data) == 1:
+            # run_report() output for one target
+            data = data[0]
+        if not isinstance(data, dict) or ('checks' not in data and 'taken' not in data):
+            return ERROR, "%s is neither a results file nor a snapshot." % filename
+        return SUCCESS, data
+
+    ###########################################################
+    def compare_key(self, headers):
+        # the identifying columns of a list, the first column if none of them is known
+        keys = [idx for idx in range(len(headers)) if headers[idx] in COMPARE_KEYS]
+        return keys if len(keys) > 0 else [0]
+
+    ###########################################################
+    def do_compare(self, oldfile, newfile):
+
+        # What changed between two runs.  Every comparison is a dictionary join on a key, so it stays linear in the
+        # number of checks and list rows.
+        rc, old = self.load_compare_file(oldfile)
+        if rc != SUCCESS:
+            return rc, old
+        rc, new = self.load_compare_file(newfile)
+        if rc != SUCCESS:
+            return rc, new
+        if ('checks' in old) != ('checks' in new):
+            return ERROR, "Cannot compare a results file with a snapshot."
+
+        self.dir_delim   = os.sep
+        self.dbhost      = new.get('dbhost', '')
+        self.dbport      = new.get('dbport', '')
+        self.database    = new.get('database', '')
+        self.schema      = new.get('schema', '')
+        self.pgversionminor = new.get('pgversion', '0.0')
+        self.reportfile  = "%s%s%s_compare.%s" % (self.tempdir, self.dir_delim, self.pid, 'html' if self.html_format else 'txt')
+        open(self.reportfile, "w").close()
+        if self.html_format:
+            rc, results = self.initreport()
+            if rc != SUCCESS:
+                return rc, results
+        self.cursection = 'compare'
+        minutes = (new.get('taken', 0) - old.get('taken', 0)) / 60.0
+        self.appendcheck(MARK_OK, "Compared", "%s with %s, %.1f minutes apart." % (oldfile, newfile, minutes))
+
+        if 'checks' in new:
+            rc, results = self.compare_results(old, new)
+        else:
+            rc, results = self.compare_snapshots(old, new, minutes)
+        if rc != SUCCESS:
+            return rc, results
+        self.cursection = ''
+
+        if self.html_format:
+            rc, results = self.finalizereport()
+            if rc != SUCCESS:
+                return rc, results
+        if self.gzip:
+            rc, results = self.compressreport()
+            if rc != SUCCESS:
+                return rc, results
+        print ("compare report file generated: %s" % self.reportfile)
+        return SUCCESS, ""
+
+    ###########################################################
+    def compare_results(self, old, new):
+
+        # checks, keyed by section, category and occurrence, since a category can be reported more than once
+        def keyed_checks(checks):
+            keyed = {}
+            for check in checks:
+                key = (check['section'], check['category'])
+                n = 0
+                while key + (n,) in keyed:
+                    n += 1
+                keyed[key + (n,)] = check
+            return keyed
+        oldchecks = keyed_checks(old['checks'])
+        newchecks = keyed_checks(new['checks'])
+        rows = []
+        worse = 0
+        for key in sorted(set(oldchecks) | set(newchecks)):
+            oldstatus = oldchecks[key]['status'] if key in oldchecks else 'none'
+            newstatus = newchecks[key]['status'] if key in newchecks else 'none'
+            if oldstatus == newstatus:
+                continue
+            if newstatus == 'warn':
+                worse += 1
+            rows.append([key[0], key[1], oldstatus, newstatus, newchecks[key]['message'] if key in newchecks else oldchecks[key]['message']])
+        if worse > 0:
+            self.appendcheck(MARK_WARN, "Check Status", "%d check(s) got worse and %d changed otherwise." % (worse, len(rows) - worse))
+        else:
+            self.appendcheck(MARK_OK, "Check Status", "No check got worse, %d changed." % len(rows))
+        if len(rows) > 0:
+            self.appendlist("Checks whose status changed.", ['section', 'check', 'old status', 'new status', 'message'], rows)
+
+        # list rows, keyed by the list id and the identifying columns of the row
+        oldlists = dict([(section['id'], section) for section in old['sections']])
+        newlists = dict([(section['id'], section) for section in new['sections']])
+        membership = []
+        moved = []
+        for listid in sorted(set(oldlists) | set(newlists)):
+            headers = (newlists.get(listid) or oldlists.get(listid))['headers']
+            keycols = self.compare_key(headers)
+            keyed = []
+            for lists in (oldlists, newlists):
+                section = lists.get(listid)
+                # a list can be missing because it was empty, which means all of its rows left or entered
+                keyed.append(dict([(" / ".join([str(row[idx]) for idx in keycols]), row) for row in (section['rows'] if section and section['headers'] == headers else [])]))
+            oldrows, newrows = keyed
+            for key in newrows:
+                if key not in oldrows:
+                    membership.append([listid, 'entered', key])
+            for key in oldrows:
+                if key not in newrows:
+                    membership.append([listid, 'left', key])
+            for key, row in newrows.items():
+                if key not in oldrows:
+                    continue
+                oldrow = oldrows[key]
+                for idx in range(len(headers)):
+                    if idx in keycols or idx >= len(row) or idx >= len(oldrow):
+                        continue
+                    try:
+                        oldvalue, newvalue = float(oldrow[idx]), float(row[idx])
+                    except (TypeError, ValueError):
+                        continue
+                    if oldvalue == newvalue:
+                        continue
+                    if oldvalue == 0:
+                        change = "new"
+                    else:
+                        pct = (newvalue - oldvalue) * 100.0 / abs(oldvalue)
+                        if abs(pct) < COMPARE_MIN_CHANGE:
+                            continue
+                        change = "%+.0f%%" % pct
+                    moved.append([listid, key, headers[idx], oldrow[idx], row[idx], change])
+
+        entered = len([row for row in membership if row[1] == 'entered'])
+        msg = "%d row(s) entered and %d left the lists, %d value(s) moved by %d%% or more." % (entered, len(membership) - entered, len(moved), COMPARE_MIN_CHANGE)
+        self.appendcheck(MARK_WARN if entered > 0 or len(moved) > 0 else MARK_OK, "List Changes", msg)
+        if len(membership) > 0:
+            self.appendlist("Rows that entered or left a list, like tables that became bloated, freeze or analyze candidates or indexes that became unused.", ['list', 'change', 'row'], membership)
+        if len(moved) > 0:
+            self.appendlist("Values that moved by %d%% or more." % COMPARE_MIN_CHANGE, ['list', 'row', 'column', 'old', 'new', 'change'], moved)
+        return SUCCESS, ""
+
+    ###########################################################
+    def compare_snapshots(self, old, new, minutes):
+
+        # Snapshots only hold cumulative counters, so two of them give the rate of each counter over the interval
+        # between them.  Counters that went backwards (stats reset) are left out.
+        def flatten(snapshot):
+            counters = {}
+            for name, value in snapshot.items():
+                if name == 'taken':
+                    continue
+                items = value.items() if isinstance(value, dict) else [('', value)]
+                for key, values in items:
+                    values = values if isinstance(values, list) else [values]
+                    for idx in range(len(values)):
+                        if isinstance(values[idx], (int, float)):
+                            counters["%s %s[%d]" % (name, key, idx)] = values[idx]
+            return counters
+        oldcounters = flatten(old)
+        newcounters = flatten(new)
+        rows = []
+        for key, value in newcounters.items():
+            if key in oldcounters and value > oldcounters[key]:
+                delta = value - oldcounters[key]
+                rows.append([key, oldcounters[key], value, delta, round(delta / minutes, 2) if minutes > 0 else ''])
+        rows.sort(key=lambda row: row[3], reverse=True)
+        self.appendcheck(MARK_OK, "Counters", "%d of %d counter(s) increased between the snapshots." % (len(rows), len(newcounters)))
+        if len(rows) > 0:
+            self.appendlist("Counters that increased between the snapshots, largest first.", ['counter', 'old', 'new', 'delta', 'per minute'], rows)
+        return SUCCESS, ""
+
+    ###########################################################
+    def set_offload(self):
+
+        # --offload-to: a standby dsn, or auto for the first streaming standby close enough to the primary.
+        # The heavy catalog only queries (bloat estimate, freeze ages and sizes, partition map) can run there, since
+        # a physical standby has the same catalog.  Anything based on the cumulative statistics views is per node
+        # and stays on the primary.
+        if self.offloadto == '':
+            return SUCCESS, ""
+        if self.in_recovery or self.pgversionmajor < Decimal('10.0'):
+            print ("Not offloading: %s" % ("this server is a standby" if self.in_recovery else "requires PG 10 or later"))
+            return SUCCESS, ""
+
+        candidates = []
+        if self.offloadto == 'auto':
+            sql = "select host(client_addr), pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)::bigint from pg_stat_replication " \
+                  "where state = 'streaming' and client_addr is not null order by 2"
+            rc, rows = self.get_rows(sql, probe='offload standbys')
+            if rc != SUCCESS:
+                return rc, "Unable to get standbys: %d %s\nsql=%s\n" % (rc, rows, sql)
+            for row in rows:
+                conn = " -h %s -d %s -p %s " % (row[0], self.database, self.dbport)
+                if self.dbuser != '':
+                    conn += " -U %s " % self.dbuser
+                candidates.append((row[0], conn))
+        else:
+            candidates.append((self.offloadto, " -d %s " % self.shellquote(self.offloadto)))
+
+        for name, conn in candidates:
+            rc, rows = self.get_rows("select pg_is_in_recovery(), pg_last_wal_replay_lsn()", conn, probe='offload standby %s' % name)
+            if rc != SUCCESS or len(rows) == 0 or rows[0][0] != 't':
+                print ("Not offloading to %s: not a reachable standby" % name)
+                continue
+            rc, lag = self.get_rows("select pg_wal_lsn_diff(pg_current_wal_lsn(), '%s')::bigint" % rows[0][1], probe='offload lag %s' % name)
+            if rc != SUCCESS:
+                return rc, "Unable to get standby lag: %d %s\n" % (rc, lag)
+            if int(lag[0][0]) > OFFLOAD_MAX_LAG:
+                print ("Not offloading to %s: replay is %s behind" % (name, self.prettysize(int(lag[0][0]))))
+                continue
+            self.offloadconn = conn
+            self.offloadname = "standby %s" % name
+            print ("Offloading catalog queries to %s" % self.offloadname)
+            return SUCCESS, ""
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_offload_rows(self, sql, probe=''):
+
+        # catalog only queries go to the offload standby when there is one, and back to the primary if it fails
+        if self.offloadconn != '':
+            rc, rows = self.get_rows(sql, self.offloadconn, probe)
+            if rc == SUCCESS:
+                self.mark_node(self.offloadname)
+                return rc, rows
+            print ("Offload query failed on %s, running it on the primary: %s" % (self.offloadname, rows))
+        self.mark_node('primary')
+        return self.get_rows(sql, probe=probe)
+
+    ###########################################################
+    def mark_node(self, node):
+        nodes = self.sectionnodes.setdefault(self.cursection, [])
+        if node not in nodes:
+            nodes.append(node)
+
+    ###########################################################
+    def load_snapshot(self):
+
+        # previous snapshot is optional: first run or unreadable file just means cumulative values are reported
+        self.snapshot = {'taken': time.time()}
+        self.prevsnapshot = {}
+        if self.replayfile != '':
+            # deltas are computed against the snapshot that was current when the archive was captured
+            self.snapshot['taken'] = self.capturemeta['taken']
+            self.prevsnapshot = self.capturemeta['prevsnapshot']
+            return SUCCESS, ""
+        if not os.path.exists(self.snapshotfile):
+            return SUCCESS, ""
+        try:
+            f = open(self.snapshotfile, "r")
+            self.prevsnapshot = json.load(f)
+            f.close()
+        except (IOError, OSError, ValueError) as e:
+            if self.verbose:
+                print ("Unable to load snapshot file, %s: %s" % (self.snapshotfile, e))
+            self.prevsnapshot = {}
+        return SUCCESS, ""
+
+    ###########################################################
+    def save_snapshot(self):
+
+        if self.replayfile != '' or self.capturefile != '':
+            # replaying old data must not overwrite the snapshot of the live cluster, and a capture must not move the
+            # baseline of the next live run forward, the replay computes its deltas against the captured one
+            return SUCCESS, ""
+        try:
+            f = open(self.snapshotfile, "w")
+            json.dump(self.snapshot, f)
+            f.close()
+        except (IOError, OSError) as e:
+            return WARNING, "Unable to save snapshot file, %s: %s" % (self.snapshotfile, e)
+        return SUCCESS, ""
+
+    ###########################################################
+    def snapshot_interval(self):
+        # minutes between previous and current snapshot, or zero if there is no previous snapshot
+        if 'taken' not in self.prevsnapshot:
+            return 0
+        return (self.snapshot['taken'] - self.prevsnapshot['taken']) / 60.0
+
     ###########################################################
     def get_configinfo(self):
 
         sql = "show all"
 
         cmd = "psql %s -t -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='show all')
         if rc != SUCCESS:
             # let calling function report the error
             errors = "Unable to get config info: %d %s\ncommand=%s\n" % (rc, results, cmd)
@@ -525,7 +1231,92 @@ class maint:
         return SUCCESS, results
 
     ###########################################################
-    def executecmd(self, cmd, expect):
+    def executecmd(self, cmd, expect, probe=''):
+
+        # every shell command and query goes through here, so this is where capture and replay happen.
+        # Results are keyed by the probe name, not the command text, so a replay with other thresholds, --topn
+        # or schema still finds them.  Without a name the command is the key, less the pid in the temp file names.
+        key = probe
+        if key == '':
+            key = cmd.replace(self.tempfile, '{tempfile}').replace(self.workfile, '{workfile}')
+        if self.replayfile != '':
+            value = self.replay_probe(key)
+            if value is None:
+                return ERROR, "Command not found in capture archive, %s: %s" % (self.replayfile, key)
+            if value[2] is not None:
+                f = open(self.tempfile, "w")
+                f.write(value[2])
+                f.close()
+            return value[0], value[1]
+
+        if key in SHARED_PROBES and key in self.shared:
+            rc, results = self.shared[key]
+        else:
+            rc, results = self.executecmd_live(cmd, expect)
+            if rc == SUCCESS and key in SHARED_PROBES:
+                self.shared[key] = (rc, results)
+        if self.capturefile != '':
+            contents = None
+            if '> %s' % self.tempfile in cmd and os.path.exists(self.tempfile):
+                f = open(self.tempfile, "r")
+                contents = f.read()
+                f.close()
+            self.capture_probe(key, [rc, results, contents])
+        return rc, results
+
+    ###########################################################
+    def probe(self, key, func):
+        # run a python side os probe, or get its captured value when replaying
+        if self.replayfile != '':
+            return self.replay_probe(key)
+        value = func()
+        if self.capturefile != '':
+            self.capture_probe(key, value)
+        return value
+
+    ###########################################################
+    def capture_probe(self, key, value):
+        # the same command can run more than once (WAL samples), so keep every result in order
+        self.probes.setdefault(key, []).append(value)
+
+    ###########################################################
+    def replay_probe(self, key):
+        values = self.probes.get(key, [])
+        idx = self.probeidx.get(key, 0)
+        if idx >= len(values):
+            return None
+        self.probeidx[key] = idx + 1
+        return values[idx]
+
+    ###########################################################
+    def save_capture(self):
+
+        meta = {'dbhost': self.dbhost, 'dbport': self.dbport, 'dbuser': self.dbuser, 'database': self.database, 'schema': self.schema,
+                'version': VERSION, 'taken': self.snapshot.get('taken', time.time()), 'prevsnapshot': self.prevsnapshot}
+        try:
+            f = gzip.open(self.capturefile, "wb")
+            f.write(json.dumps({'meta': meta, 'probes': self.probes}).encode('utf-8'))
+            f.close()
+        except (IOError, OSError) as e:
+            return ERROR, "Unable to write capture archive, %s: %s" % (self.capturefile, e)
+        return SUCCESS, ""
+
+    ###########################################################
+    def load_capture(self, replayfile):
+
+        try:
+            f = gzip.open(replayfile, "rb")
+            archive = json.loads(f.read().decode('utf-8'))
+            f.close()
+        except (IOError, OSError, ValueError) as e:
+            return ERROR, "Unable to read capture archive, %s: %s" % (replayfile, e)
+        self.replayfile  = replayfile
+        self.probes      = archive['probes']
+        self.capturemeta = archive['meta']
+        return SUCCESS, self.capturemeta
+
+    ###########################################################
+    def executecmd_live(self, cmd, expect):
 
         # NOTE: try and catch does not work for Popen
         try:
@@ -612,7 +1403,7 @@ class maint:
         # do not provide host name and/or port if not provided
         cmd = "psql %s -t -c \"%s\" " % (self.connstring, sql)
 
-        rc, results = self.executecmd(cmd, True)
+        rc, results = self.executecmd(cmd, True, probe='pgversion')
         if rc != SUCCESS:
             errors = "%s\n" % (results)
             aline = "%s" % (errors)
@@ -657,7 +1448,7 @@ class maint:
 
         # do not provide host name and/or port if not provided
         cmd = "psql %s -t -c \"%s\" " % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, True)
+        rc, results = self.executecmd(cmd, True, probe='readycnt')
         if rc != SUCCESS:
             errors = "%s" % (results)
             aline = "%s" % (errors)
@@ -675,7 +1466,7 @@ class maint:
         # do not provide host name and/or port if not provided
         cmd = "psql %s -t -c \"%s\" " % (self.connstring, sql)
 
-        rc, results = self.executecmd(cmd, True)
+        rc, results = self.executecmd(cmd, True, probe='datadir')
         if rc != SUCCESS:
             errors = "%s\n" % (results)
             aline = "%s" % (errors)
@@ -693,7 +1484,7 @@ class maint:
         else:
             cmd = "pg_config | find \"BINDIR\""
 
-        rc, results = self.executecmd(cmd, True)
+        rc, results = self.executecmd(cmd, True, probe='bindir')
         if rc != SUCCESS:
             # don't consider failure unless bindir not already populated by "which psql" command that executed earlier
             if self.pgbindir == "":
@@ -717,7 +1508,7 @@ class maint:
 
         if self.opsys == 'posix':
             cmd = "cat /proc/cpuinfo | grep processor | wc -l"
-            rc, results = self.executecmd(cmd, True)
+            rc, results = self.executecmd(cmd, True, probe='cpus')
             if rc != SUCCESS:
                 errors = "%s\n" % (results)
                 aline = "%s" % (errors)
@@ -726,7 +1517,7 @@ class maint:
             CPUs = int(results)
 
             cmd = "uptime | grep -ohe 'load average[s:][: ].*' | awk '{ print $5 }'"
-            rc, results = self.executecmd(cmd, True)
+            rc, results = self.executecmd(cmd, True, probe='load')
             if rc != SUCCESS:
                 errors = "%s\n" % (results)
                 aline = "%s" % (errors)
@@ -742,7 +1533,7 @@ class maint:
         else:
             # assume windows
             cmd = "wmic cpu get loadpercentage"
-            rc, results = self.executecmd(cmd, True)
+            rc, results = self.executecmd(cmd, True, probe='load')
             if rc != SUCCESS:
                 errors = "%s\n" % (results)
                 aline = "%s" % (errors)
@@ -780,7 +1571,7 @@ class maint:
         sql = "select count(*) from pg_stat_replication where state = 'streaming'"
         
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='streaming standbys')
         if rc != SUCCESS:
             errors = "Unable to get table/index bloat count: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -793,7 +1584,7 @@ class maint:
         # self.in_recovery
         sql = "select pg_is_in_recovery()"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='in recovery')
         if rc != SUCCESS:
             errors = "Unable to get master/slave status: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -811,8 +1602,7 @@ class maint:
         # get the host name
         if self.dbhost == '':
             # tuples = os.uname()
-            tuples = platform.uname()
-            hostname = tuples[1]
+            hostname = self.probe("hostname", lambda: platform.uname()[1])
         else:
             hostname = self.dbhost
 
@@ -832,7 +1622,9 @@ class maint:
             ".table1 th { color:#000;    text-align:left; border:1px solid black; padding: 5px;}" + \
             ".table1 td { color:#000099; text-align:left; border:1px solid black; padding: 5px;}" + \
             "caption { text-align:left; caption-side: left; }" + \
-            "</style>" + \
+            "summary { cursor:pointer; margin:10px 0px; }" + \
+            "</style>\n" + \
+            "<script>" + REPORT_SCRIPT + "</script>\n" + \
             "<BODY BGCOLOR=\"FFFFFF\">\n" + \
             "<div id='container'>\n" + \
             "<img src='" + self.imageURL + "' style='float: left;'/>\n" + \
@@ -856,6 +1648,21 @@ class maint:
 
         return SUCCESS, ""
 
+    ###########################################################
+    def compressreport(self):
+        gzfile = self.reportfile + ".gz"
+        try:
+            fin  = open(self.reportfile, "rb")
+            fout = gzip.open(gzfile, "wb")
+            shutil.copyfileobj(fin, fout)
+            fout.close()
+            fin.close()
+            os.remove(self.reportfile)
+        except (IOError, OSError) as e:
+            return ERROR, "Unable to compress report file, %s: %s" % (self.reportfile, e)
+        self.reportfile = gzfile
+        return SUCCESS, ""
+
     ###########################################################
     def appendreport(self, astring):
         f = open(self.reportfile, "a")
@@ -876,43 +1683,227 @@ class maint:
         if rc != SUCCESS:
             return rc, results
 
-        # do health checks
-        rc, results = self.do_report_healthchecks()
+        rc, results = self.set_offload()
         if rc != SUCCESS:
             return rc, results
-        print ("")
 
-        # get pg memory settings
-        rc, results = self.do_report_pgmemory()
+        # previous snapshot, if any, is used to compute deltas for cumulative counters
+        rc, results = self.load_snapshot()
         if rc != SUCCESS:
             return rc, results
 
-        # get bloated tables and indexes
-        rc, results = self.do_report_bloated()
+        rc, results = self.load_sql_checks()
         if rc != SUCCESS:
             return rc, results
 
-        # get unused indexes
-        rc, results = self.do_report_unusedindexes()
-        if rc != SUCCESS:
-            return rc, results
+        if self.dryrun:
+            # planning mode: nothing but the plan runs, so there is no new snapshot either
+            self.cursection = 'plan'
+            rc, results = self.do_plan()
+            self.cursection = ''
+            if rc != SUCCESS:
+                return rc, results
+        else:
+            # sample host I/O in the background while the other sections run
+            self.start_iosampler()
+            try:
+                rc, results = self.start_wal_sample()
+                if rc != SUCCESS:
+                    return rc, results
+
+                # run the enabled sections, all of them by default
+                for section, method in REPORT_SECTIONS:
+                    if len(self.enabled) > 0 and section not in self.enabled:
+                        continue
+                    self.cursection = section
+                    self.sectionnodes.setdefault(section, [])
+                    rc, results = getattr(self, method)()
+                    if rc != SUCCESS:
+                        return rc, results
+                    rc, results = self.do_sql_checks(section)
+                    if rc != SUCCESS:
+                        return rc, results
+                    if section == 'healthchecks' and self.capturefile == '' and not self.quiet:
+                        print ("")
+            finally:
+                # hostio stops the sampler, but a failed section returns before it gets there
+                self.stop_iosampler()
+
+            if self.offloadconn != '':
+                self.cursection = 'offload'
+                # everything else in a section runs on the primary
+                rows = []
+                for section, method in REPORT_SECTIONS:
+                    if section in self.sectionnodes:
+                        standbys = [node for node in self.sectionnodes[section] if node != 'primary']
+                        rows.append([section, 'primary' + ''.join([", catalog queries on %s" % node for node in standbys])])
+                self.appendlist("Node that served each section.", ['section', 'node'], rows)
+            self.cursection = ''
+
+            if self.capturefile != '':
+                # a capture only collects: the snapshot and log offsets of the live runs are left as they are, and
+                # the report is generated by the replay
+                return self.finish_wal_sample()
+
+            rc, results = self.save_snapshot()
+            if rc != SUCCESS:
+                print (results)
+            rc, results = self.save_log_offsets()
+            if rc != SUCCESS:
+                print (results)
 
-        # See what tables need to be analyzed, vacuumed, etc
-        rc, results = self.do_report_tablemaintenance()
-        if rc != SUCCESS:
-            return rc, results
+        if self.capturefile != '':
+            return SUCCESS, ""
 
         if self.html_format:
             rc,results = self.finalizereport()
             if rc != SUCCESS:
                 return rc, results
 
+
+        if self.gzip:
+            rc, results = self.compressreport()
+            if rc != SUCCESS:
+                return rc, results
+
+        if self.quiet:
+            return SUCCESS, ""
+        if self.html_format:
             print ("html report file generated: %s" % self.reportfile)
         else:
             print ("text report file generated: %s" % self.reportfile)
         
         return SUCCESS, ""
 
+    ###########################################################
+    def get_workmem_model(self):
+
+        # Size work_mem from the measured workload instead of memory tiers.  The need is the per call temp spill that
+        # covers most spilling calls (pg_stat_statements), or the average temp file (pg_stat_database) without it.
+        # The budget is the RAM left after shared_buffers and the autovacuum workers, shared by the peak number of
+        # active sessions each running a couple of sort/hash operations.  Returns the work_mem in MB (0 if there is
+        # nothing to base it on) and the evidence rows behind it.
+        evidence = []
+        if self.pgversionmajor < Decimal('9.2'):
+            # pg_stat_database has no temp_files
+            return SUCCESS, (0, evidence)
+
+        if self.pgversionmajor < Decimal('10.0'):
+            activefilter = "state = 'active'"
+        else:
+            activefilter = "state = 'active' and backend_type = 'client backend'"
+        if self.pgversionmajor < Decimal('13.0'):
+            hashmult = "'1'"
+        else:
+            hashmult = "current_setting('hash_mem_multiplier')"
+        sql = "select d.temp_files, d.temp_bytes, coalesce(extract(epoch from d.stats_reset), 0), (select count(*) from pg_stat_activity where %s and pid <> pg_backend_pid()), " \
+              "current_setting('autovacuum_max_workers'), (select setting from pg_settings where name = 'autovacuum_work_mem'), current_setting('block_size'), %s " \
+              "from pg_stat_database d where d.datname = current_database()" % (activefilter, hashmult)
+        rc, rows = self.get_rows(sql, probe='workmem')
+        if rc != SUCCESS:
+            errors = "Unable to get temp file and session stats: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+        temp_files, temp_bytes, reset, active = int(rows[0][0]), int(rows[0][1]), float(rows[0][2]), int(rows[0][3])
+        av_workers, av_work_mem, blocksize, hash_mem_multiplier = int(rows[0][4]), int(rows[0][5]), int(rows[0][6]), float(rows[0][7])
+
+        # temp file deltas, unless stats were reset in between
+        self.snapshot['tempfiles'] = [temp_files, temp_bytes, reset]
+        prev = self.prevsnapshot.get('tempfiles')
+        if prev is not None and prev[2] == reset and temp_files >= prev[0]:
+            temp_files -= prev[0]
+            temp_bytes -= prev[1]
+            qualifier = "last %.1f minutes" % self.snapshot_interval()
+        else:
+            qualifier = "since stats reset"
+        evidence.append(['temp files', temp_files, qualifier])
+        evidence.append(['temp bytes', self.prettysize(temp_bytes), qualifier])
+
+        # the memory settings are Decimal MB from convert_humanfriendly_to_MB, the arithmetic below is in float
+        shared_buffers, work_mem, maint_work_mem = float(self.shared_buffers), float(self.work_mem), float(self.maint_work_mem)
+
+        # one sample per run, so remember the highest count seen across runs
+        peak = max(active, self.prevsnapshot.get('peakactive', 0), 1)
+        self.snapshot['peakactive'] = peak
+        evidence.append(['peak active sessions', peak, "highest seen at report runs (now %d)" % active])
+
+        # a vacuum uses at most 1GB for dead tuples
+        if av_work_mem == -1:
+            av_mem_mb = min(maint_work_mem, 1024)
+        else:
+            av_mem_mb = min(av_work_mem / 1024, 1024)
+        evidence.append(['autovacuum memory', "%d MB" % (av_workers * av_mem_mb), "%d workers x %d MB" % (av_workers, av_mem_mb)])
+
+        # per call spill of the statements that wrote temp blocks, as deltas when they were in the previous snapshot
+        spills = []
+        rc, available = self.get_pgss_available()
+        if rc != SUCCESS:
+            return rc, available
+        if available:
+            sql = "select userid, queryid, calls, temp_blks_written from pg_stat_statements where dbid = (select oid from pg_database where datname = current_database()) " \
+                  "and temp_blks_written > 0 order by temp_blks_written desc limit 500"
+            rc, rows = self.get_rows(sql, probe='workmem statements')
+            if rc != SUCCESS:
+                errors = "Unable to get pg_stat_statements temp spills: %d %s\nsql=%s\n" % (rc, rows, sql)
+                self.writeout(errors)
+                return rc, errors
+            prevstmts = self.prevsnapshot.get('tempstatements', {})
+            current = {}
+            for row in rows:
+                key = "%s:%s" % (row[0], row[1])
+                calls, temp_blks = int(row[2]), int(row[3])
+                current[key] = [calls, temp_blks]
+                if key in prevstmts and calls >= prevstmts[key][0]:
+                    calls     -= prevstmts[key][0]
+                    temp_blks -= prevstmts[key][1]
+                if calls > 0 and temp_blks > 0:
+                    spills.append([float(temp_blks) * blocksize / calls, calls])
+            self.snapshot['tempstatements'] = current
+
+        # in memory sorts and hashes take more room than their temp files, hence the factor
+        needbytes = 0
+        if len(spills) > 0:
+            spills.sort()
+            spillcalls = sum([calls for spill, calls in spills])
+            covered = 0
+            for spill, calls in spills:
+                covered += calls
+                if covered >= spillcalls * WORKMEM_SPILL_COVERAGE:
+                    needbytes = spill * WORKMEM_SPILL_FACTOR
+                    break
+            evidence.append(['spilling statements', len(spills), "%d calls wrote temp blocks" % spillcalls])
+            evidence.append(['spill per call covering %d%% of calls' % (WORKMEM_SPILL_COVERAGE * 100), self.prettysize(int(spill)), "x %d for in memory size" % WORKMEM_SPILL_FACTOR])
+        elif temp_files > 0:
+            needbytes = float(temp_bytes) / temp_files * WORKMEM_SPILL_FACTOR
+            evidence.append(['average temp file', self.prettysize(temp_bytes / temp_files), "x %d for in memory size, pg_stat_statements not available" % WORKMEM_SPILL_FACTOR])
+        needmb = int(math.ceil(needbytes / 1048576.0))
+
+        # physical memory is only known for local servers
+        if self.totalmemGB <= 0:
+            if needmb == 0:
+                return SUCCESS, (0, evidence)
+            recommended = max(needmb, work_mem)
+            evidence.append(['work_mem to remove most spills', "%d MB" % recommended, "not checked against RAM, physical memory is only known for local servers"])
+            return SUCCESS, (recommended, evidence)
+
+        budgetmb = self.totalmemGB * 1024 * WORKMEM_RAM_FRACTION - shared_buffers - av_workers * av_mem_mb
+        peropmb = max(int(budgetmb / (peak * WORKMEM_OPS_PER_QUERY * hash_mem_multiplier)), 4)
+        evidence.append(['work_mem budget', "%d MB" % budgetmb, "%d%% of RAM less shared_buffers and autovacuum memory" % (WORKMEM_RAM_FRACTION * 100)])
+        evidence.append(['safe work_mem per operation', "%d MB" % peropmb, "budget / (%d sessions x %d operations x hash_mem_multiplier %.1f)" % (peak, WORKMEM_OPS_PER_QUERY, hash_mem_multiplier)])
+        if needmb == 0:
+            recommended = min(work_mem, peropmb)
+            evidence.append(['work_mem', "%d MB" % recommended, "no temp spills measured, current work_mem capped at the safe value"])
+        else:
+            recommended = min(max(needmb, work_mem), peropmb)
+            if recommended < needmb:
+                note = "capped at the safe value, %d MB would remove most spills" % needmb
+            elif needmb <= work_mem:
+                note = "average spill per call is below the current work_mem, so only some calls spill"
+            else:
+                note = "removes most spills within the RAM budget"
+            evidence.append(['work_mem', "%d MB" % recommended, note])
+        return SUCCESS, (recommended, evidence)
+
     ###########################################################
     def do_report_pgmemory(self):
 
@@ -989,6 +1980,14 @@ class maint:
             else:
                 recommended_work_mem = 0.256
 
+        # the measured workload, when there is one, overrides the memory tiers
+        rc, model = self.get_workmem_model()
+        if rc != SUCCESS:
+            return rc, model
+        workmem_mb, evidence = model
+        if workmem_mb > 0:
+            recommended_work_mem = workmem_mb / 1000.0
+
         # effective_cache_size: settings shows it in 8kb chunks
         # set it to 85% of memory
         recommended_effective_cache_size = .85 * self.totalmemGB
@@ -1038,231 +2037,2001 @@ class maint:
             self.appendreport("maintenance_work_mem: %s   recommended: %s\n" % (maintenance_work_mem_f, recommended_maintenance_work_mem_f))
             self.appendreport("work_mem            : %s   recommended: %s\n" % (work_mem_f, recommended_work_mem_f))
 
+        if workmem_mb > 0:
+            title = "Workload evidence for the work_mem recommendation."
+            self.appendlist(title, ['input', 'value', 'note'], evidence)
+
         return SUCCESS, ""
 
     ###########################################################
-    def do_report_bloated(self):
-        '''
-         SELECT schemaname, tablename, ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) AS tbloat,  CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END AS wastedbytes,  iname,   ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) AS ibloat, CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END AS wastedibytes FROM (SELECT  schemaname, tablename, cc.reltuples, cc.relpages, bs,  CEIL((cc.reltuples*((datahdr+ma- (CASE WHEN datahdr%ma=0 THEN ma ELSE datahdr%ma END))+nullhdr2+4))/(bs-20::FLOAT)) AS otta,  COALESCE(c2.relname,'?') AS iname, COALESCE(c2.reltuples,0) AS ituples, COALESCE(c2.relpages,0) AS ipages, COALESCE(CEIL((c2.reltuples*(datahdr-12))/(bs-20::FLOAT)),0) AS iotta FROM ( SELECT   ma,bs,schemaname,tablename,   (datawidth+(hdr+ma-(CASE WHEN hdr%ma=0 THEN ma ELSE hdr%ma END)))::NUMERIC AS datahdr,   (maxfracsum*(nullhdr+ma-(CASE WHEN nullhdr%ma=0 THEN ma ELSE nullhdr%ma END))) AS nullhdr2 FROM ( SELECT schemaname, tablename, hdr, ma, bs, SUM((1-null_frac)*avg_width) AS datawidth, MAX(null_frac) AS maxfracsum,  hdr+( SELECT 1+COUNT(*)/8 FROM pg_stats s2 WHERE null_frac<>0 AND s2.schemaname = s.schemaname AND s2.tablename = s.tablename ) AS nullhdr FROM pg_stats s, ( SELECT (SELECT current_setting('block_size')::NUMERIC) AS bs, CASE WHEN SUBSTRING(v,12,3) IN ('8.0','8.1','8.2') THEN 27 ELSE 23 END AS hdr, CASE WHEN v ~ 'mingw32' THEN 8 ELSE 4 END AS ma FROM (SELECT version() AS v) AS foo ) AS constants  GROUP BY 1,2,3,4,5 ) AS foo) AS rs  JOIN pg_class cc ON cc.relname = rs.tablename  JOIN pg_namespace nn ON cc.relnamespace = nn.oid AND nn.nspname = rs.schemaname AND nn.nspname <> 'information_schema' LEFT JOIN pg_index i ON indrelid = cc.oid LEFT JOIN pg_class c2 ON c2.oid = i.indexrelid ) AS sml where ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) > 20 OR ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) > 20 or CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END > 10737418240 OR CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END > 10737418240 ORDER BY wastedbytes DESC;
-        '''
+    def get_bloat_sql(self, cached=False, oids=None):
+
+        # cached: one row per table/index with the table oid and no thresholds, for the bloat cache,
+        # optionally only for the tables in oids.  Pipes in names would split the list rows, so they become spaces.
+        relfilter = ""
+        statsfilter = ""
+        if oids is not None:
+            oidlist = ",".join([str(oid) for oid in oids])
+            relfilter = " AND cc.oid IN (%s)" % oidlist
+            statsfilter = " WHERE (s.schemaname, s.tablename) IN (SELECT n.nspname, c.relname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.oid IN (%s))" % oidlist
+        sql = "SELECT " + ("reloid, " if cached else "") + "replace(schemaname, '|', ' ') AS schemaname, replace(tablename, '|', ' ') AS tablename, ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) AS tbloat,  CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END AS wastedbytes,  replace(iname, '|', ' ') AS iname,   ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) AS ibloat, CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END AS wastedibytes FROM (SELECT  " + \
+              ("cc.oid AS reloid, " if cached else "") + "schemaname, tablename, cc.reltuples, cc.relpages, bs,  CEIL((cc.reltuples*((datahdr+ma- (CASE WHEN datahdr%ma=0 THEN ma ELSE datahdr%ma END))+nullhdr2+4))/(bs-20::FLOAT)) AS otta,  COALESCE(c2.relname,'?') AS iname, COALESCE(c2.reltuples,0) AS ituples, COALESCE(c2.relpages,0) AS ipages, COALESCE(CEIL((c2.reltuples*(datahdr-12))/(bs-20::FLOAT)),0) AS iotta FROM ( SELECT   ma,bs,schemaname,tablename,   (datawidth+(hdr+ma-(CASE WHEN hdr%ma=0 THEN ma ELSE hdr%ma END)))::NUMERIC AS datahdr,   (maxfracsum*(nullhdr+ma-(CASE WHEN nullhdr%ma=0 THEN ma ELSE nullhdr%ma END))) AS nullhdr2 FROM ( SELECT schemaname, tablename, hdr, ma, bs, SUM((1-null_frac)*avg_width) AS datawidth, MAX(null_frac) AS maxfracsum,  hdr+( SELECT 1+COUNT(*)/8 FROM pg_stats s2 WHERE null_frac<>0 AND s2.schemaname = s.schemaname AND s2.tablename = s.tablename ) AS nullhdr FROM pg_stats s, ( SELECT (SELECT current_setting('block_size')::NUMERIC) AS bs, CASE WHEN SUBSTRING(v,12,3) IN ('8.0','8.1','8.2') THEN 27 ELSE 23 END AS hdr, CASE WHEN v ~ 'mingw32' THEN 8 ELSE 4 END AS ma FROM (SELECT version() AS v) AS foo ) AS constants" + \
+              statsfilter + "  GROUP BY 1,2,3,4,5 ) AS foo) AS rs  JOIN pg_class cc ON cc.relname = rs.tablename " + relfilter + \
+              " JOIN pg_namespace nn ON cc.relnamespace = nn.oid AND nn.nspname = rs.schemaname AND nn.nspname <> 'information_schema' LEFT JOIN pg_index i ON indrelid = cc.oid LEFT JOIN pg_class c2 ON c2.oid = i.indexrelid ) AS sml"
+        if not cached:
+            sql += " where " + "ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) > 20 OR ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) > 20 or CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END > 10737418240 OR CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END > 10737418240" + \
+                   " ORDER BY wastedbytes DESC"
+        return sql
 
-        if self.bloatedtables == False:
-            return SUCCESS, ""
+    ###########################################################
+    def get_unused_sql(self):
+        return "SELECT replace(relname, '|', ' ') as table, replace(schemaname||'.'||indexrelname, '|', ' ') AS fqindexname, pg_size_pretty(pg_relation_size(indexrelid)) as total_size, pg_relation_size(indexrelid) as raw_size, idx_scan as index_scans FROM pg_stat_user_indexes JOIN pg_index USING(indexrelid) WHERE idx_scan = 0 AND idx_tup_read = 0 AND idx_tup_fetch = 0 AND NOT indisprimary AND NOT indisunique AND NOT indisexclusion AND indisvalid AND indisready AND pg_relation_size(indexrelid) > 8192 ORDER BY 4 DESC"
 
-        sql = "SELECT schemaname, tablename, ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) AS tbloat,  CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END AS wastedbytes,  iname,   ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) AS ibloat, CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END AS wastedibytes FROM (SELECT  schemaname, tablename, cc.reltuples, cc.relpages, bs,  CEIL((cc.reltuples*((datahdr+ma- (CASE WHEN datahdr%ma=0 THEN ma ELSE datahdr%ma END))+nullhdr2+4))/(bs-20::FLOAT)) AS otta,  COALESCE(c2.relname,'?') AS iname, COALESCE(c2.reltuples,0) AS ituples, COALESCE(c2.relpages,0) AS ipages, COALESCE(CEIL((c2.reltuples*(datahdr-12))/(bs-20::FLOAT)),0) AS iotta FROM ( SELECT   ma,bs,schemaname,tablename,   (datawidth+(hdr+ma-(CASE WHEN hdr%ma=0 THEN ma ELSE hdr%ma END)))::NUMERIC AS datahdr,   (maxfracsum*(nullhdr+ma-(CASE WHEN nullhdr%ma=0 THEN ma ELSE nullhdr%ma END))) AS nullhdr2 FROM ( SELECT schemaname, tablename, hdr, ma, bs, SUM((1-null_frac)*avg_width) AS datawidth, MAX(null_frac) AS maxfracsum,  hdr+( SELECT 1+COUNT(*)/8 FROM pg_stats s2 WHERE null_frac<>0 AND s2.schemaname = s.schemaname AND s2.tablename = s.tablename ) AS nullhdr FROM pg_stats s, ( SELECT (SELECT current_setting('block_size')::NUMERIC) AS bs, CASE WHEN SUBSTRING(v,12,3) IN ('8.0','8.1','8.2') THEN 27 ELSE 23 END AS hdr, CASE WHEN v ~ 'mingw32' THEN 8 ELSE 4 END AS ma FROM (SELECT version() AS v) AS foo ) AS constants  GROUP BY 1,2,3,4,5 ) AS foo) AS rs  JOIN pg_class cc ON cc.relname = rs.tablename  JOIN pg_namespace nn ON cc.relnamespace = nn.oid AND nn.nspname = rs.schemaname AND nn.nspname <> 'information_schema' LEFT JOIN pg_index i ON indrelid = cc.oid LEFT JOIN pg_class c2 ON c2.oid = i.indexrelid ) AS sml where ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) > 20 OR ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) > 20 or CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END > 10737418240 OR CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END > 10737418240 ORDER BY wastedbytes DESC"
-        if self.html_format:
-            cmd = "psql %s --html -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-        else:
-            cmd = "psql %s -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-        rc, results = self.executecmd(cmd, False)
+    ###########################################################
+    def get_bloat_rows(self):
+
+        # Bloat estimates only change when a table's statistics or size change, so per table results are cached in
+        # the state directory keyed by oid, relfilenode, last (auto)analyze and table and index pages. Only new and
+        # changed tables are estimated again, and dropped tables fall out of the cache.
+        if self.bloatrows is not None:
+            return SUCCESS, self.bloatrows
+
+        usecache = self.capturefile == '' and self.replayfile == ''
+        sql = "select c.oid, c.relfilenode, coalesce(greatest(s.last_analyze, s.last_autoanalyze)::text, ''), c.relpages, " \
+              "(select coalesce(sum(ic.relpages), 0) from pg_index i join pg_class ic on ic.oid = i.indexrelid where i.indrelid = c.oid) " \
+              "from pg_stat_all_tables s join pg_class c on c.oid = s.relid where s.schemaname not in ('information_schema', 'pg_toast')"
+        rc, keyrows = self.get_rows(sql, probe='bloat cache keys') if usecache else (SUCCESS, [])
         if rc != SUCCESS:
-            errors = "Unable to get table/index bloat: %d %s\nsql=%s\n" % (rc, results, sql)
-            aline = "%s" % (errors)
-            self.writeout(aline)
-            return rc, errors
+            return rc, "Unable to get table statistics keys: %d %s\nsql=%s\n" % (rc, keyrows, sql)
+        keys = {}
+        for row in keyrows:
+            keys[row[0]] = '|'.join(row[1:])
+
+        # run_report keeps the caches in memory between its targets, they are only read from disk once
+        bloatcaches = self.shared.setdefault('bloatcache', {})
+        cache = {}
+        if usecache and self.bloatcachefile in bloatcaches:
+            cache = bloatcaches[self.bloatcachefile]
+        elif usecache and os.path.exists(self.bloatcachefile):
+            try:
+                f = open(self.bloatcachefile, "r")
+                cache = json.load(f)
+                f.close()
+            except (IOError, OSError, ValueError):
+                cache = {}
+
+        newcache = {}
+        changed = []
+        for oid, key in keys.items():
+            if oid in cache and cache[oid]['key'] == key:
+                newcache[oid] = cache[oid]
+            else:
+                newcache[oid] = {'key': key, 'rows': []}
+                changed.append(oid)
+
+        if self.verbose and usecache:
+            print ("Bloat cache: %d of %d tables to estimate" % (len(changed), len(keys)))
+        if not usecache or len(changed) > 0:
+            # when most tables changed, one pass over pg_stats beats a long oid list
+            oids = None
+            if usecache and len(changed) * 2 < len(keys):
+                oids = changed
+            sql = self.get_bloat_sql(True, oids)
+            rc, rows = self.get_offload_rows(sql, probe='bloat')
+            if rc != SUCCESS:
+                return rc, "Unable to get table/index bloat: %d %s\n" % (rc, rows)
+            changedset = set(changed)
+            for row in rows:
+                if not usecache:
+                    newcache.setdefault(row[0], {'key': '', 'rows': []})['rows'].append(row[1:])
+                elif row[0] in changedset:
+                    # a full pass also returns the unchanged tables, which are already cached
+                    newcache[row[0]]['rows'].append(row[1:])
+
+        if usecache and not self.dryrun:
+            bloatcaches[self.bloatcachefile] = newcache
+            try:
+                f = open(self.bloatcachefile, "w")
+                json.dump(newcache, f)
+                f.close()
+            except (IOError, OSError) as e:
+                print ("Unable to save bloat cache file, %s: %s" % (self.bloatcachefile, e))
+
+        # same thresholds as the uncached query: 20x the expected size or more than 10 GB wasted
+        self.bloatrows = []
+        for entry in newcache.values():
+            for row in entry['rows']:
+                if float(row[2]) > 20 or float(row[5]) > 20 or float(row[3]) > 10737418240 or float(row[6]) > 10737418240:
+                    self.bloatrows.append(row)
+        self.bloatrows.sort(key=lambda row: float(row[3]), reverse=True)
+        return SUCCESS, self.bloatrows
 
-        if self.html_format:
-            self.appendreport("<H4>Bloated tables/indexes are identified where at least 20% of the table/index is bloated or the wasted bytes is > 10 GB.</H4>\n")
-        else:    
-            self.appendreport("Bloated tables/indexes are identified where at least 20% of the table/index is bloated or the wasted bytes is > 10 GB.\n")
+    ###########################################################
+    def load_sql_checks(self):
 
-        f = open(self.tempfile, "r")
-        lineno = 0
-        bloated = 0
-        for line in f:
-            lineno = lineno + 1
-            if self.verbose:
-                #print ("%d line=%s" % (lineno,line))
-                pass
-            aline = line.strip()
-            if len(aline) < 1:
-                continue
-            elif '(0 rows)' in aline:
+        # Each *.sql file in --checksdir is one check: "-- key: value" header lines (SQLCHECK_KEYS), then the query.
+        # The value checked is the first column of the first row, or the row count with "value: rows".
+        self.sqlchecks = []
+        if self.checksdir == '':
+            return SUCCESS, ""
+        try:
+            names = sorted([name for name in os.listdir(self.checksdir) if name.endswith('.sql')])
+        except OSError as e:
+            return ERROR, "Unable to read checks directory, %s: %s" % (self.checksdir, e)
+
+        sections = [section for section, method in REPORT_SECTIONS]
+        for name in names:
+            path = os.path.join(self.checksdir, name)
+            check = {'name': name[:-4], 'section': 'healthchecks', 'minversion': '0', 'cost': 'cheap', 'value': 'first',
+                     'warn_if': '', 'ok': '', 'warn': '', 'list': '', 'headers': '', 'file': path}
+            lines = []
+            f = open(path, "r")
+            for line in f:
+                match = re.match(r'^--\s*([a-z_]+)\s*:\s*(.*?)\s*$', line)
+                if match and len(lines) == 0 and match.group(1) in SQLCHECK_KEYS:
+                    check[match.group(1)] = match.group(2)
+                elif match and len(lines) == 0:
+                    f.close()
+                    return ERROR, "Unknown key in check %s: %s" % (path, match.group(1))
+                elif line.strip() != '' or len(lines) > 0:
+                    lines.append(line)
+            f.close()
+            check['sql'] = ''.join(lines).strip().rstrip(';')
+
+            if check['sql'] == '':
+                return ERROR, "No query in check %s" % path
+            if check['section'] not in sections:
+                return ERROR, "Unknown section in check %s: %s" % (path, check['section'])
+            if check['cost'] not in ('cheap', 'expensive'):
+                return ERROR, "Check %s: cost must be cheap or expensive" % path
+            if check['value'] not in ('first', 'rows'):
+                return ERROR, "Check %s: value must be first or rows" % path
+            if check['warn_if'] != '' and not SQLCHECK_RE_WARN.match(check['warn_if']):
+                return ERROR, "Check %s: warn_if must be an operator and a number, like > 0" % path
+            try:
+                minversion = Decimal(check['minversion'])
+            except ArithmeticError:
+                return ERROR, "Check %s: invalid minversion %s" % (path, check['minversion'])
+            if self.pgversionmajor < minversion:
+                if self.verbose:
+                    print ("Skipping check %s: requires PG %s" % (path, check['minversion']))
                 continue
+            self.sqlchecks.append(check)
+        return SUCCESS, ""
 
-            # bloated table or index
-            bloated = bloated + 1
-            if self.html_format:
-                msg = "%s" % aline
-                self.appendreport(msg)
-            else:
-                self.appendreport("%s\n" % (aline))
+    ###########################################################
+    def eval_sql_check(self, check, rows):
 
-        if self.html_format:
-            self.appendreport("<p><br></p>")
-        f.close()
+        if check['value'] == 'rows':
+            value = str(len(rows))
+        elif len(rows) > 0:
+            value = rows[0][0]
+        else:
+            value = None
+
+        if check['warn_if'] != '' and value is not None:
+            op, limit = SQLCHECK_RE_WARN.match(check['warn_if']).groups()
+            try:
+                number = float(value)
+            except ValueError:
+                return ERROR, "Check %s: value is not a number: %s" % (check['file'], value)
+            limit = float(limit)
+            warn = {'>': number > limit, '>=': number >= limit, '<': number < limit, '<=': number <= limit, '=': number == limit, '!=': number != limit}[op]
+        else:
+            warn = False
+
+        if warn:
+            marker = MARK_WARN
+            msg = check['warn'] if check['warn'] != '' else "%s: %s" % (check['name'], value)
+        else:
+            marker = MARK_OK
+            msg = check['ok'] if check['ok'] != '' else "%s: %s" % (check['name'], value if value is not None else 'no rows')
+        self.appendcheck(marker, check['name'], msg.replace('{value}', str(value)))
 
+        if check['list'] != '' and len(rows) > 0:
+            headers = [header.strip() for header in check['headers'].split(',')] if check['headers'] != '' else ["column%d" % (i + 1) for i in range(len(rows[0]))]
+            self.appendlist(check['list'], headers, rows)
         return SUCCESS, ""
 
     ###########################################################
-    def do_report_unusedindexes(self):
-
-        # NOTE: no version problems identified yet
+    def do_sql_checks(self, section):
 
-        if self.unusedindexes == False:
+        # the section's cheap checks share one round trip, expensive ones run alone and are subject to --max-query-cost
+        checks = [check for check in self.sqlchecks if check['section'] == section]
+        if len(checks) == 0:
             return SUCCESS, ""
 
-        # Criteria is indexes that are used less than 20 times and whose table size is > 100MB
-        sql="SELECT relname as table, schemaname||'.'||indexrelname AS fqindexname, pg_size_pretty(pg_relation_size(indexrelid)) as total_size, pg_relation_size(indexrelid) as raw_size, idx_scan as index_scans FROM pg_stat_user_indexes JOIN pg_index USING(indexrelid) WHERE idx_scan = 0 AND idx_tup_read = 0 AND idx_tup_fetch = 0 AND NOT indisprimary AND NOT indisunique AND NOT indisexclusion AND indisvalid AND indisready AND pg_relation_size(indexrelid) > 8192 ORDER BY 4 DESC"
-
-        if self.html_format:
-            cmd = "psql %s --html -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-        else:
-            cmd = "psql %s -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-        rc, results = self.executecmd(cmd, False)
+        cheap = [check for check in checks if check['cost'] == 'cheap']
+        batched = {}
+        if len(cheap) > 1:
+            rc, results = self.get_batch_rows([check['sql'] for check in cheap], probe='sqlchecks %s' % section)
+            if rc == SUCCESS:
+                for i in range(len(cheap)):
+                    batched[cheap[i]['file']] = results[i]
+
+        for check in checks:
+            if check['file'] in batched:
+                rows = batched[check['file']]
+            else:
+                if check['cost'] == 'expensive':
+                    rc, cost = self.query_cost(check['sql'])
+                    if rc != SUCCESS:
+                        return rc, cost
+                    if self.skip_costly(check['name'], cost):
+                        continue
+                # run alone, also when the batch failed, so the failing check is the one reported
+                rc, results = self.get_batch_rows([check['sql']], probe='sqlcheck %s' % check['file'])
+                if rc != SUCCESS:
+                    self.appendcheck(MARK_WARN, check['name'], "Check %s failed: %s" % (check['file'], results))
+                    continue
+                rows = results[0]
+            rc, results = self.eval_sql_check(check, rows)
+            if rc != SUCCESS:
+                return rc, results
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_plan_queries(self):
+
+        # the heavy catalog queries, by the section that runs them, for the plan and --max-query-cost
+        return [('healthchecks', 'vacuum freeze candidates', self.get_freeze_sql()),
+                ('healthchecks', 'analyze candidates count', "select count(*) from %s" % self.get_analyze_from()),
+                ('healthchecks', 'bloated tables/indexes count', "select count(*) from (%s) as bloat" % self.get_bloat_sql()),
+                ('healthchecks', 'unused indexes count', "select count(*) from (%s) as unused" % self.get_unused_sql()),
+                ('bloated', 'bloated tables/indexes list', self.get_bloat_sql()),
+                ('unusedindexes', 'unused indexes list', self.get_unused_sql()),
+                ('tablemaintenance', 'analyze candidates list', "select * from %s" % self.get_analyze_from()),
+                ('maintenance', 'analyze candidates queue', "select * from %s" % self.get_analyze_from())] + \
+               [(check['section'], "%s (%s)" % (check['name'], check['cost']), check['sql']) for check in self.sqlchecks]
+
+    ###########################################################
+    def explain_cost(self, sql):
+
+        # planner estimate from the top plan node: (cost=0.00..1234.56 rows=789 width=8)
+        rc, rows = self.get_rows("explain %s" % sql, probe='explain')
+        if rc != SUCCESS:
+            return rc, "Unable to explain query: %d %s\nsql=%s\n" % (rc, rows, sql)
+        match = re.search(r'cost=[\d.]+\.\.([\d.]+) rows=(\d+)', '|'.join(rows[0]))
+        if not match:
+            return ERROR, "Unable to parse explain output: %s" % rows[0]
+        return SUCCESS, (float(match.group(1)), int(match.group(2)))
+
+    ###########################################################
+    def get_vacuumlo_cost(self):
+
+        # vacuumlo reads every oid and lo column of every user table, so estimate it like the planner would a
+        # sequential scan of those tables
+        sql = "select (select count(*) from pg_largeobject_metadata), count(distinct c.oid), " \
+              "coalesce(sum(c.relpages * current_setting('seq_page_cost')::float + c.reltuples * current_setting('cpu_tuple_cost')::float), 0), coalesce(sum(c.reltuples), 0)::bigint " \
+              "from pg_attribute a join pg_class c on c.oid = a.attrelid join pg_namespace n on n.oid = c.relnamespace join pg_type t on t.oid = a.atttypid " \
+              "where c.relkind = 'r' and a.attnum > 0 and not a.attisdropped and t.typname in ('oid', 'lo') and n.nspname not in ('pg_catalog', 'information_schema')"
+        rc, rows = self.get_rows(sql, probe='vacuumlo cost')
+        if rc != SUCCESS:
+            return rc, "Unable to estimate vacuumlo work: %d %s\nsql=%s\n" % (rc, rows, sql)
+        return SUCCESS, (int(rows[0][0]), int(rows[0][1]), float(rows[0][2]), int(rows[0][3]))
+
+    ###########################################################
+    def skip_costly(self, category, cost):
+
+        # with --max-query-cost, a check whose estimate is above the limit is reported as skipped instead of run
+        if self.max_query_cost <= 0 or cost <= self.max_query_cost:
+            return False
+        self.appendcheck(MARK_WARN, category, "Skipped: estimated cost %.0f is above --max-query-cost %.0f." % (cost, self.max_query_cost))
+        return True
+
+    ###########################################################
+    def query_cost(self, sql):
+        if self.max_query_cost <= 0:
+            return SUCCESS, 0
+        rc, results = self.explain_cost(sql)
+        if rc != SUCCESS:
+            return rc, results
+        return SUCCESS, results[0]
+
+    ###########################################################
+    def do_plan(self):
+
+        # -r/--dryrun: list the sections that would run and the planner estimates for their heavy queries,
+        # without running any of them
+        queries = self.get_plan_queries()
+        listrows = []
+        for section, method in REPORT_SECTIONS:
+            if len(self.enabled) > 0 and section not in self.enabled:
+                continue
+            planned = [query for query in queries if query[0] == section]
+            if section == 'maintenance' and not self.execute:
+                listrows.append([section, 'VACUUM (FREEZE) and ANALYZE', '', '', "off, only with --execute"])
+                continue
+            for section_, name, sql in planned:
+                rc, results = self.explain_cost(sql)
+                if rc != SUCCESS:
+                    listrows.append([section, name, '', '', results])
+                    continue
+                cost, rows = results
+                note = ''
+                if self.max_query_cost > 0 and cost > self.max_query_cost:
+                    note = "skipped by --max-query-cost"
+                listrows.append([section, name, "%.0f" % cost, rows, note])
+
+            if section == 'healthchecks':
+                if self.in_recovery:
+                    listrows.append([section, 'orphaned large objects (vacuumlo)', '', '', "not run on a standby"])
+                else:
+                    rc, results = self.get_vacuumlo_cost()
+                    if rc != SUCCESS:
+                        return rc, results
+                    objects, tables, cost, rows = results
+                    note = "%d large objects matched against %d table(s) with oid/lo columns" % (objects, tables)
+                    if self.max_query_cost > 0 and cost > self.max_query_cost:
+                        note += ", skipped by --max-query-cost"
+                    listrows.append([section, 'orphaned large objects (vacuumlo)', "%.0f" % cost, rows, note])
+                if self.archive_mode not in ('off', '') and (self.archive_dircount or self.pgversionmajor < Decimal('10.0') or self.in_recovery):
+                    # pg_ls_dir lists about max_wal_size worth of WAL files, more when archiving is behind
+                    files = ''
+                    if self.pgversionmajor >= Decimal('10.0'):
+                        rc, rows = self.get_rows("select pg_size_bytes(current_setting('max_wal_size')) / pg_size_bytes(current_setting('wal_segment_size'))", probe='wal segments')
+                        if rc != SUCCESS:
+                            return rc, "Unable to estimate archive_status files: %d %s\n" % (rc, rows)
+                        files = int(rows[0][0])
+                    listrows.append([section, 'archive_status files (pg_ls_dir)', '', files, "directory entries, about max_wal_size worth of WAL files"])
+            elif section == 'ash':
+                if self.ash_seconds > 0:
+                    listrows.append([section, 'pg_stat_activity samples', '', int(self.ash_seconds / self.ash_interval), "one session for %d seconds" % self.ash_seconds])
+                else:
+                    listrows.append([section, 'pg_stat_activity samples', '', '', "off, only with --ash"])
+            elif section == 'logs':
+                listrows.append([section, 'server log files', '', '', "reads new log data since the previous run" if self.logs else "off, only with --logs"])
+            elif section == 'hostio':
+                listrows.append([section, '/proc samples', '', '', "every %d seconds while the report runs, local linux servers only" % self.iosample_seconds if self.iosample_seconds > 0 else "off, --iosample 0"])
+            elif section == 'export':
+                listrows.append([section, 'bloat, unused index, freeze and analyze lists as gzip csv', '', '', "into %s" % self.exportdir if self.exportdir != '' else "off, only with --export"])
+            elif section == 'maintenance':
+                listrows.append([section, 'VACUUM (FREEZE) and ANALYZE', '', '', "on the candidates, %d job(s) at a time" % self.jobs])
+            elif len(planned) == 0:
+                listrows.append([section, 'statistics views and settings', '', '', "no heavy catalog query"])
+
+        title = "Plan: sections that would run and the planner estimates for their heavy queries (dry run, nothing else was run)."
+        headers = ['section', 'check', 'estimated cost', 'estimated rows', 'note']
+        self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_bloated(self):
+        '''
+         SELECT schemaname, tablename, ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) AS tbloat,  CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END AS wastedbytes,  iname,   ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) AS ibloat, CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END AS wastedibytes FROM (SELECT  schemaname, tablename, cc.reltuples, cc.relpages, bs,  CEIL((cc.reltuples*((datahdr+ma- (CASE WHEN datahdr%ma=0 THEN ma ELSE datahdr%ma END))+nullhdr2+4))/(bs-20::FLOAT)) AS otta,  COALESCE(c2.relname,'?') AS iname, COALESCE(c2.reltuples,0) AS ituples, COALESCE(c2.relpages,0) AS ipages, COALESCE(CEIL((c2.reltuples*(datahdr-12))/(bs-20::FLOAT)),0) AS iotta FROM ( SELECT   ma,bs,schemaname,tablename,   (datawidth+(hdr+ma-(CASE WHEN hdr%ma=0 THEN ma ELSE hdr%ma END)))::NUMERIC AS datahdr,   (maxfracsum*(nullhdr+ma-(CASE WHEN nullhdr%ma=0 THEN ma ELSE nullhdr%ma END))) AS nullhdr2 FROM ( SELECT schemaname, tablename, hdr, ma, bs, SUM((1-null_frac)*avg_width) AS datawidth, MAX(null_frac) AS maxfracsum,  hdr+( SELECT 1+COUNT(*)/8 FROM pg_stats s2 WHERE null_frac<>0 AND s2.schemaname = s.schemaname AND s2.tablename = s.tablename ) AS nullhdr FROM pg_stats s, ( SELECT (SELECT current_setting('block_size')::NUMERIC) AS bs, CASE WHEN SUBSTRING(v,12,3) IN ('8.0','8.1','8.2') THEN 27 ELSE 23 END AS hdr, CASE WHEN v ~ 'mingw32' THEN 8 ELSE 4 END AS ma FROM (SELECT version() AS v) AS foo ) AS constants  GROUP BY 1,2,3,4,5 ) AS foo) AS rs  JOIN pg_class cc ON cc.relname = rs.tablename  JOIN pg_namespace nn ON cc.relnamespace = nn.oid AND nn.nspname = rs.schemaname AND nn.nspname <> 'information_schema' LEFT JOIN pg_index i ON indrelid = cc.oid LEFT JOIN pg_class c2 ON c2.oid = i.indexrelid ) AS sml where ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) > 20 OR ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) > 20 or CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END > 10737418240 OR CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END > 10737418240 ORDER BY wastedbytes DESC;
+        '''
+
+        if self.bloatedtables == False:
+            return SUCCESS, ""
+
+        rc, rows = self.get_bloat_rows()
+        if rc != SUCCESS:
+            self.writeout(rows)
+            return rc, rows
+
+        title = "Bloated tables/indexes are identified where at least 20% of the table/index is bloated or the wasted bytes is > 10 GB."
+        headers = ['schemaname', 'tablename', 'tbloat', 'wastedbytes', 'iname', 'ibloat', 'wastedibytes']
+        if self.partitions:
+            rc, rows = self.rollup_partitions(rows, lambda row: "%s.%s" % (row[0], row[1]), self.rollup_bloat)
+            if rc != SUCCESS:
+                self.writeout(rows)
+                return rc, rows
+            rows.sort(key=lambda row: float(row[3]), reverse=True)
+            headers.append('worst partitions')
+        self.appendlist(title, headers, rows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_unusedindexes(self):
+
+        # NOTE: no version problems identified yet
+
+        if self.unusedindexes == False:
+            return SUCCESS, ""
+
+        # Criteria is indexes that are used less than 20 times and whose table size is > 100MB
+        sql = self.get_unused_sql()
+        rc, rows = self.get_rows(sql, probe='unused indexes')
         if rc != SUCCESS:
-            errors = "Unable to get unused indexes: %d %s\nsql=%s\n" % (rc, results, sql)
+            errors = "Unable to get unused indexes: %d %s\nsql=%s\n" % (rc, rows, sql)
             aline = "%s" % (errors)
             self.writeout(aline)
             return rc, errors
 
-        if self.html_format:
-            self.appendreport("<H4>Unused indexes are identified where there are no index scans and the size of the index is > 8 KB.</H4>\n")
-        else:    
-            self.appendreport("\nUnused indexes are identified where there are no index scans and the size of the index  is > 8 KB.\n")
+        title = "Unused indexes are identified where there are no index scans and the size of the index is > 8 KB."
 
         # See if this cluster has dependent slaves and if so give information warning
         if self.slavecnt > 0:
-            msg = "%d slave(s) are dependent on this cluster.  Make sure unused indexes are also unused on the slave(s) before considering them as index drop candidates.\n" % self.slavecnt
+            msg = "%d slave(s) are dependent on this cluster.  Make sure unused indexes are also unused on the slave(s) before considering them as index drop candidates." % self.slavecnt
             print (msg)
-            if self.html_format:
-                msg = "<H4><p style=\"color:red;\">" + msg + "</p><H4>"
-                self.appendreport(msg)
-            else:
-                self.appendreport(msg+"\n")
+            title = title + "  " + msg
 
-        f = open(self.tempfile, "r")
-        lineno = 0
-        count  = 0
-        for line in f:
-            lineno = lineno + 1
-            if self.verbose:
-                #print ("%d line=%s" % (lineno,line))
-                pass
-            aline = line.strip()
-            if len(aline) < 1:
+        headers = ['table', 'fqindexname', 'total_size', 'raw_size', 'index_scans']
+        self.appendlist(title, headers, rows)
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_redundantindexes(self):
+
+        # pull every index definition in one catalog-only query: no size functions, size comes from relpages
+        if self.pgversionmajor < Decimal('11.0'):
+            nkeyatts = 'i.indnatts'
+        else:
+            nkeyatts = 'i.indnkeyatts'
+        sql = "select i.indexrelid, i.indrelid, n.nspname || '.' || t.relname, ic.relname, am.amname, i.indkey::text, i.indclass::text, i.indoption::text, i.indcollation::text, " \
+              "regexp_replace(coalesce(pg_get_expr(i.indpred, i.indrelid), ''), '[[:space:]|]+', ' ', 'g'), regexp_replace(coalesce(pg_get_expr(i.indexprs, i.indrelid), ''), '[[:space:]|]+', ' ', 'g'), " \
+              "i.indisunique, i.indisprimary, ic.relpages::bigint * current_setting('block_size')::bigint, coalesce(s.n_tup_ins + s.n_tup_upd - s.n_tup_hot_upd, 0), %s " \
+              "from pg_index i join pg_class ic on ic.oid = i.indexrelid join pg_class t on t.oid = i.indrelid join pg_namespace n on n.oid = t.relnamespace " \
+              "join pg_am am on am.oid = ic.relam left join pg_stat_user_tables s on s.relid = i.indrelid " \
+              "where i.indisvalid and n.nspname not in ('pg_catalog', 'information_schema') and n.nspname !~ '^pg_toast' %s" % (nkeyatts, self.schemaclause)
+        rc, rows = self.get_rows(sql, probe='redundant indexes')
+        if rc != SUCCESS:
+            errors = "Unable to get index definitions: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        # Indexes can only cover each other within the same table, access method, predicate and expressions.
+        # Within a group, identical key definitions are duplicates, and a btree whose keys are a left prefix
+        # of a longer btree's keys is redundant.  One pass builds the hashes, one pass checks them.
+        groups = {}
+        for row in rows:
+            nkey     = int(row[15])
+            attnums  = row[5].split()
+            keycols  = tuple(zip(attnums[:nkey], row[6].split(), row[7].split(), row[8].split()))
+            index = {'name': row[3], 'table': row[2], 'am': row[4], 'keycols': keycols, 'include': tuple(attnums[nkey:]), 'exprs': row[10],
+                     'unique': row[11] == 't', 'primary': row[12] == 't', 'bytes': int(row[13]), 'writes': int(row[14])}
+            groupkey = (row[1], row[4], row[9], row[10])
+            group = groups.setdefault(groupkey, {'exact': {}, 'prefixes': {}})
+            group['exact'].setdefault((keycols, index['include']), []).append(index)
+            if row[4] == 'btree' and row[10] == '':
+                for plen in range(1, len(keycols)):
+                    group['prefixes'].setdefault(keycols[:plen], index)
+
+        redundant = []
+        for group in groups.values():
+            for (keycols, include), indexes in group['exact'].items():
+                # keep the constraint-backing index if there is one, report the others as duplicates of it
+                indexes.sort(key=lambda index: (not index['primary'], not index['unique'], index['name']))
+                keeper = indexes[0]
+                for index in indexes[1:]:
+                    redundant.append([index, "duplicate of %s" % keeper['name']])
+                if keeper['unique'] or keeper['include'] or keeper['am'] != 'btree' or keeper['exprs'] != '':
+                    continue
+                coverer = group['prefixes'].get(keycols)
+                if coverer is not None:
+                    redundant.append([keeper, "left prefix of %s" % coverer['name']])
+
+        if len(redundant) == 0:
+            return SUCCESS, ""
+
+        redundant.sort(key=lambda item: item[0]['bytes'], reverse=True)
+        listrows = []
+        for index, reason in redundant:
+            listrows.append([index['table'], index['name'], reason, self.prettysize(index['bytes']), index['writes']])
+        title = "Duplicate and left-prefix redundant indexes.  Each one wastes its size on disk and adds an index write for every insert and non-HOT update."
+        headers = ['table', 'redundant index', 'reason', 'wasted size', 'index writes since stats reset']
+        self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_freeze_sql(self):
+
+        # Prefilter from the catalog alone: relpages (heap plus toast) and the xid/multixact ages.  Only the few
+        # survivors get an exact pg_table_size(), which stats every relation file.  OFFSET 0 keeps the planner from
+        # evaluating the size filter before the catalog filters.
+        if self.pgversionmajor < Decimal('9.5'):
+            mxid_age = "0"
+        else:
+            mxid_age = "mxid_age(c.relminmxid)"
+        sql = "select xid_max, nspname, relname, xid_age, pg_size_pretty(size), round(xid_age * 100.0 / xid_max), mxid_age, round(mxid_age * 100.0 / mxid_max), size from " \
+              "(select *, pg_table_size(oid) as size from " \
+              "(select c.oid, n.nspname, c.relname, age(c.relfrozenxid) as xid_age, %s as mxid_age, s.xid_max, s.mxid_max from " \
+              "(select current_setting('autovacuum_freeze_max_age')::bigint as xid_max, current_setting('autovacuum_multixact_freeze_max_age')::bigint as mxid_max, current_setting('block_size')::bigint as bs) s, " \
+              "pg_class c join pg_namespace n on n.oid = c.relnamespace left join pg_class t on t.oid = c.reltoastrelid " \
+              "where c.relkind = 'r' and (c.relpages + coalesce(t.relpages, 0))::bigint * s.bs > 536870912 " \
+              "and (age(c.relfrozenxid) > s.xid_max / 2 or %s > s.mxid_max / 2) offset 0) candidates) sized " \
+              "where size > 1073741824 order by greatest(xid_age::float / xid_max, mxid_age::float / mxid_max) desc" % (mxid_age, mxid_age)
+        return sql
+
+    ###########################################################
+    def get_analyze_from(self):
+        # shared by the analyze candidate count, the detail list and the maintenance executor
+        return "pg_namespace n, pg_class c, pg_tables t, pg_stat_user_tables u where c.relnamespace = n.oid and n.nspname = t.schemaname and t.tablename = c.relname and t.schemaname = u.schemaname and t.tablename = u.relname and n.nspname not in ('information_schema','pg_catalog') and (((c.reltuples > 0 and round((u.n_live_tup::float / c.reltuples::float) * 100) < 50)) OR ((last_vacuum is null and last_autovacuum is null and last_analyze is null and last_autoanalyze is null ) or (now()::date  - last_vacuum::date > 60 AND now()::date - last_autovacuum::date > 60 AND now()::date  - last_analyze::date > 60 AND now()::date  - last_autoanalyze::date > 60)))"
+
+    ###########################################################
+    def get_partitions(self):
+
+        # one set-based pass over pg_inherits: every leaf partition with its top level partitioned table. Detached
+        # partitions are no longer in pg_inherits, and leaves that are known to be empty are flagged so the rollups
+        # can leave them out.
+        if self.partitionmap is not None:
+            return SUCCESS, self.partitionmap
+        self.partitionmap = {}
+        if self.pgversionmajor < Decimal('10.0'):
+            # no declarative partitioning
+            return SUCCESS, self.partitionmap
+        sql = "%s select n.nspname || '.' || c.relname, rn.nspname, r.relname, case when %s then 1 else 0 end " \
+              "from tree t join pg_class c on c.oid = t.relid join pg_namespace n on n.oid = c.relnamespace left join pg_stat_all_tables s on s.relid = c.oid " \
+              "join pg_class r on r.oid = t.root join pg_namespace rn on rn.oid = r.relnamespace where c.relkind not in ('p', 'I')" % \
+              (self.get_partition_tree_sql(), self.get_empty_leaf_sql('c', 's'))
+        rc, rows = self.get_offload_rows(sql, probe='partitions')
+        if rc != SUCCESS:
+            return rc, "Unable to get partitions: %d %s\nsql=%s\n" % (rc, rows, sql)
+        for row in rows:
+            self.partitionmap[row[0]] = (row[1], row[2], row[3] == '1')
+        return SUCCESS, self.partitionmap
+
+    ###########################################################
+    def get_partition_tree_sql(self):
+        # every partitioned table that is not itself a partition, and all relations below it, as (root, relid)
+        return "with recursive tree as (select c.oid as root, c.oid as relid from pg_class c where c.relkind = 'p' and not c.relispartition " \
+               "union all select t.root, i.inhrelid from tree t join pg_inherits i on i.inhparent = t.relid)"
+
+    ###########################################################
+    def get_empty_leaf_sql(self, classalias, statsalias):
+        # A leaf is only known to be empty once a vacuum or analyze counted 0 pages and tuples.  Before PG 14
+        # reltuples is also 0 for a leaf that was never vacuumed or analyzed, whatever it holds (-1 from PG 14).
+        return "%s.relpages = 0 and %s.reltuples = 0 and coalesce(%s.last_vacuum, %s.last_autovacuum, %s.last_analyze, %s.last_autoanalyze) is not null" % \
+               (classalias, classalias, statsalias, statsalias, statsalias, statsalias)
+
+    ###########################################################
+    def rollup_partitions(self, rows, getname, rollup, skipempty=True):
+
+        # Replace the rows of leaf partitions with one row per partitioned table, built by rollup(schema, table,
+        # leafrows), at the position of its first leaf.  Other rows pass through with an empty last column.
+        # The list itself may know better than the catalog that a leaf holds data, then skipempty is False.
+        rc, partmap = self.get_partitions()
+        if rc != SUCCESS:
+            return rc, partmap
+        out = []
+        parents = {}
+        for row in rows:
+            name = getname(row)
+            if name not in partmap:
+                out.append(list(row) + [''])
                 continue
-            elif '(0 rows)' in aline:
+            schema, table, empty = partmap[name]
+            if empty and skipempty:
                 continue
+            if (schema, table) not in parents:
+                parents[(schema, table)] = []
+                out.append((schema, table))
+            parents[(schema, table)].append(row)
+        for i in range(len(out)):
+            if isinstance(out[i], tuple):
+                schema, table = out[i]
+                out[i] = rollup(schema, table, parents[(schema, table)])
+        return SUCCESS, out
 
-            if lineno == 1:
-                if self.html_format:
-                    self.appendreport(aline)
-                else:
-                    self.appendreport("          %s\n" % aline)
+    ###########################################################
+    def worst_partitions(self, leafrows, getname, getvalue):
+        # the three worst leaves, worst first, as one column
+        names = []
+        for row in sorted(leafrows, key=getvalue, reverse=True):
+            name = getname(row).split('.')[-1]
+            if name not in names:
+                names.append(name)
+        return ", ".join(names[:3])
+
+    ###########################################################
+    def rollup_freeze(self, schema, table, leafrows):
+        urgency = lambda row: max(float(row[5]), float(row[7]))
+        worst = max(leafrows, key=urgency)
+        return [worst[0], schema, "%s (%d partitions)" % (table, len(leafrows)), max([int(row[3]) for row in leafrows]),
+                self.prettysize(sum([int(row[8]) for row in leafrows])), worst[5], max([int(row[6]) for row in leafrows]), worst[7],
+                sum([int(row[8]) for row in leafrows]), self.worst_partitions(leafrows, lambda row: row[2], urgency)]
+
+    ###########################################################
+    def rollup_bloat(self, schema, table, leafrows):
+        # a leaf has one row per index, each with the same table bloat, so table bytes are summed once per leaf
+        tablebytes = {}
+        for row in leafrows:
+            tablebytes[row[1]] = float(row[3])
+        leaves = len(tablebytes)
+        return [schema, "%s (%d partitions)" % (table, leaves), max([float(row[2]) for row in leafrows]), int(sum(tablebytes.values())),
+                "%d index rows" % len(leafrows), max([float(row[5]) for row in leafrows]), int(sum([float(row[6]) for row in leafrows])),
+                self.worst_partitions(leafrows, lambda row: row[1], lambda row: float(row[3]) + float(row[6]))]
+
+    ###########################################################
+    def get_analyze_list_sql(self):
+        return "select replace(n.nspname || '.' || c.relname, '|', ' ') as table, last_analyze, last_autoanalyze, last_vacuum, last_autovacuum, u.n_live_tup::bigint, c.reltuples::bigint, round((u.n_live_tup::float / CASE WHEN c.reltuples = 0 THEN 1.0 ELSE c.reltuples::float  END) * 100) as pct from %s order by n.nspname, c.relname" % self.get_analyze_from()
+
+    ###########################################################
+    def get_analyze_rollup_sql(self):
+
+        # The analyze candidates grouped by their top level partitioned table in the query, so one row comes back
+        # per parent: the oldest (never first) analyze and vacuum times, live and estimated tuples summed over the
+        # leaves and the three leaves with the lowest live to estimated ratio.  Empty leaves are left out, other
+        # tables and detached partitions are their own group.
+        if self.pgversionmajor < Decimal('10.0'):
+            return "select l.*, '' from (%s) l order by 1" % self.get_analyze_list_sql()
+        oldest = lambda col: "case when bool_or(a.%s is null) then null else min(a.%s) end" % (col, col)
+        return "%s, candidates as (select c.oid, c.relname, c.relpages, c.reltuples, u.last_analyze, u.last_autoanalyze, u.last_vacuum, u.last_autovacuum, u.n_live_tup::bigint as live, " \
+               "greatest(c.reltuples, 0)::bigint as tuples, round((u.n_live_tup::float / CASE WHEN c.reltuples <= 0 THEN 1.0 ELSE c.reltuples::float END) * 100) as pct from %s) " \
+               "select replace(pn.nspname || '.' || p.relname, '|', ' ') || case when t.root is null then '' else ' (' || count(*) || ' partitions)' end, " \
+               "%s, %s, %s, %s, sum(a.live), sum(a.tuples), round(sum(a.live) * 100.0 / greatest(sum(a.tuples), 1)), " \
+               "case when t.root is null then '' else replace(array_to_string((array_agg(a.relname order by a.pct, a.relname))[1:3], ', '), '|', ' ') end " \
+               "from candidates a left join tree t on t.relid = a.oid and t.root <> a.oid " \
+               "join pg_class p on p.oid = coalesce(t.root, a.oid) join pg_namespace pn on pn.oid = p.relnamespace " \
+               "where t.root is null or not (%s) group by pn.nspname, p.relname, t.root order by 1" % \
+               (self.get_partition_tree_sql(), self.get_analyze_from(), oldest('last_analyze'), oldest('last_autoanalyze'), oldest('last_vacuum'), oldest('last_autovacuum'),
+                self.get_empty_leaf_sql('a', 'a'))
+
+    ###########################################################
+    def export_list(self, sql, filename, connstring):
+
+        # \copy ... to pstdout streamed from psql straight into the gzip file, a chunk at a time, so a list of any
+        # size never sits in memory.  The COPY status with the row count goes to the -o file, not into the data.
+        cmd = "psql %s -X -o %s -c %s" % (connstring, self.tempfile, self.shellquote("\\copy (%s) to pstdout with (format csv, header)" % sql))
+        if self.opsys == 'posix':
+            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, executable="/bin/bash")
+        else:
+            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+
+        # stderr is drained in a thread, psql would block on a full stderr pipe while stdout is still being read
+        errors = []
+        drain = threading.Thread(target=lambda: errors.append(p.stderr.read()))
+        drain.daemon = True
+        drain.start()
+        fout = gzip.open(filename, "wb")
+        while True:
+            chunk = p.stdout.read(EXPORT_CHUNK_BYTES)
+            if not chunk:
+                break
+            fout.write(chunk)
+        fout.close()
+        drain.join()
+        p.wait()
+        err = bytes(errors[0] if len(errors) > 0 else b'').decode('utf-8').strip()
+
+        status = ''
+        if os.path.exists(self.tempfile):
+            f = open(self.tempfile, "r")
+            status = f.read()
+            f.close()
+        match = re.search(r'^COPY (\d+)', status, re.M)
+        if p.returncode != SUCCESS or 'ERROR' in err or not match:
+            os.remove(filename)
+            return ERROR, err or "no COPY status: %s" % status.strip()
+        return SUCCESS, int(match.group(1))
+
+    ###########################################################
+    def export_rows(self, headers, rows, filename):
+
+        # a list this run already has in memory, written as the same gzip csv (python 2 csv writes byte strings)
+        try:
+            if sys.version_info[0] < 3:
+                fout = gzip.open(filename, "wb")
             else:
-                if self.html_format:
-                    self.appendreport(aline)
-                else:
-                    self.appendreport("%s\n" % aline)
-        if self.html_format:
-            self.appendreport("<p><br></p>")
-        f.close()
+                fout = gzip.open(filename, "wt", newline='')
+            writer = csv.writer(fout, lineterminator="\n")
+            writer.writerow(headers)
+            writer.writerows(rows)
+            fout.close()
+        except (IOError, OSError) as e:
+            return ERROR, "Unable to write %s: %s" % (filename, e)
+        return SUCCESS, len(rows)
+
+    ###########################################################
+    def do_export(self):
+
+        # --export: the detail lists as gzip csv files and a manifest with the row count and time of each.  The
+        # bloat list is the estimate of this run, from the bloat cache, not a second full estimate.  The catalog only
+        # lists come from the offload standby when there is one.  --max-query-cost applies as it does to the checks.
+        if self.exportdir == '':
+            return SUCCESS, ""
+        if not os.path.isdir(self.exportdir):
+            try:
+                os.makedirs(self.exportdir)
+            except OSError as e:
+                return ERROR, "Unable to create export directory, %s: %s" % (self.exportdir, e)
+
+        exports = [('bloated', None, True), ('unusedindexes', self.get_unused_sql(), False),
+                   ('freeze_candidates', self.get_freeze_sql(), True), ('analyze_candidates', self.get_analyze_list_sql(), False)]
+        manifest = {'dbhost': self.dbhost, 'dbport': self.dbport, 'database': self.database, 'taken': time.time(), 'exports': []}
+        rows = []
+        for name, sql, catalogonly in exports:
+            filename = os.path.join(self.exportdir, "%s.csv.gz" % name)
+            if sql is not None or self.bloatrows is None:
+                rc, cost = self.query_cost("select count(*) from (%s) as export" % (sql or self.get_bloat_sql()))
+                if rc != SUCCESS:
+                    return rc, cost
+                if self.skip_costly("Export %s" % name, cost):
+                    manifest['exports'].append({'list': name, 'skipped': "estimated cost %.0f" % cost})
+                    rows.append([name, '', 'skipped', 0, ''])
+                    continue
+
+            if sql is None:
+                started = time.time()
+                rc, results = self.get_bloat_rows()
+                if rc == SUCCESS:
+                    headers = ['schemaname', 'tablename', 'tbloat', 'wastedbytes', 'iname', 'ibloat', 'wastedibytes']
+                    rc, results = self.export_rows(headers, results, filename)
+                elapsed = round(time.time() - started, 2)
+                node = 'bloat cache'
+                if rc != SUCCESS:
+                    return rc, "Unable to export %s: %s" % (name, results)
+            else:
+                nodes = []
+                if catalogonly and self.offloadconn != '':
+                    nodes.append((self.offloadname, self.offloadconn))
+                nodes.append(('primary', self.connstring))
+                for node, connstring in nodes:
+                    started = time.time()
+                    rc, results = self.export_list(sql, filename, connstring)
+                    elapsed = round(time.time() - started, 2)
+                    if rc == SUCCESS:
+                        break
+                    print ("Unable to export %s from %s: %s" % (name, node, results))
+                if rc != SUCCESS:
+                    return rc, "Unable to export %s: %s" % (name, results)
+                self.mark_node(node)
+            if not self.quiet:
+                print ("Exported %d rows to %s in %.2f seconds" % (results, filename, elapsed))
+            manifest['exports'].append({'list': name, 'file': os.path.basename(filename), 'rows': results, 'seconds': elapsed, 'node': node})
+            rows.append([name, filename, results, elapsed, node])
+
+        manifestfile = os.path.join(self.exportdir, "manifest.json")
+        try:
+            f = open(manifestfile, "w")
+            json.dump(manifest, f, indent=1)
+            f.close()
+        except (IOError, OSError) as e:
+            return ERROR, "Unable to write export manifest, %s: %s" % (manifestfile, e)
+
+        title = "Lists exported to %s (see manifest.json)." % self.exportdir
+        self.appendlist(title, ['list', 'file', 'rows', 'seconds', 'node'], rows)
         return SUCCESS, ""
 
     ###########################################################
     def do_report_tablemaintenance(self):
 
         if self.freezecandidates == True:
-            sql = "WITH settings AS (select s.setting from pg_settings s where s.name = 'autovacuum_freeze_max_age') select s.setting as autovac_freeze_max_age, n.nspname as schema, c.relname as table, age(c.relfrozenxid) as xid_age, pg_size_pretty(pg_table_size(c.oid)) as table_size, round((age(c.relfrozenxid)::float / s.setting::float) * 100) as pct from settings s, pg_class c, pg_namespace n WHERE n.oid = c.relnamespace and c.relkind = 'r' and pg_table_size(c.oid) > 1073741824 and round((age(c.relfrozenxid)::float / s.setting::float) * 100) > 50 ORDER BY age(c.relfrozenxid)"
-            if self.html_format:
-                cmd = "psql %s --html -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
+            # the last column is the size in bytes, only kept for the partition rollup
+            rows = [row[:8] for row in self.freezerows]
+            title = "List of tables that are past the midway point of going into transaction or multixact wraparound mode and therefore candidates for manual vacuum freeze."
+            headers = ['autovac_freeze_max_age', 'schema', 'table', 'xid_age', 'table_size', 'pct', 'mxid_age', 'mxid_pct']
+            if self.partitions:
+                # freeze candidates are over 1 GB by their own query, so no leaf is left out as empty
+                rc, rows = self.rollup_partitions(self.freezerows, lambda row: "%s.%s" % (row[1], row[2]), self.rollup_freeze, False)
+                if rc != SUCCESS:
+                    self.writeout(rows)
+                    return rc, rows
+                rows = [row[:8] + row[9:] for row in rows]
+                headers.append('worst partitions')
+            self.appendlist(title, headers, rows)
+
+        print ("")
+
+        if self.analyzecandidates == False:
+            return SUCCESS, ""
+
+        if self.partitions:
+            sql = self.get_analyze_rollup_sql()
+        else:
+            sql = self.get_analyze_list_sql()
+        rc, rows = self.get_rows(sql, probe='table maintenance')
+        if rc != SUCCESS:
+            errors = "Unable to get user table stats: %d %s\nsql=%s\n" % (rc, rows, sql)
+            aline = "%s" % (errors)
+            self.writeout(aline)
+            return rc, errors
+
+        title = "List of tables that have not been analyzed or vacuumed (manual and auto) in the last 60 days or whose size has changed significantly (n_live_tup/reltuples * 100 < 50) and therefore candidates for manual vacuum analyze."
+        headers = ['table', 'last_analyze', 'last_autoanalyze', 'last_vacuum', 'last_autovacuum', 'n_live_tup', 'reltuples', 'pct']
+        if self.partitions:
+            headers.append('worst partitions')
+        self.appendlist(title, headers, rows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_autovacuum(self):
+
+        # Why autovacuum falls behind: compute each table's vacuum and analyze trigger from the cluster settings and
+        # its reloptions, flag tables past their trigger, tables whose scale factor lets a lot of dead space build up
+        # between runs, and tables too big to vacuum within AUTOVAC_MAX_SECONDS at the throttled cost limit.
+        if self.pgversionmajor < Decimal('9.4'):
+            # n_mod_since_analyze does not exist
+            return SUCCESS, ""
+
+        sql = "select name, setting from pg_settings where name in ('autovacuum_vacuum_scale_factor', 'autovacuum_vacuum_threshold', 'autovacuum_analyze_scale_factor', " \
+              "'autovacuum_analyze_threshold', 'autovacuum_vacuum_cost_limit', 'vacuum_cost_limit', 'autovacuum_vacuum_cost_delay', 'vacuum_cost_delay', 'vacuum_cost_page_miss', " \
+              "'autovacuum_max_workers', 'block_size') union all select 'busy_workers', count(*)::text from pg_stat_activity where query like 'autovacuum:%'"
+        rc, rows = self.get_rows(sql, probe='autovacuum settings')
+        if rc != SUCCESS:
+            errors = "Unable to get autovacuum settings: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+        settings = dict([(row[0], float(row[1])) for row in rows])
+        costlimit = settings['autovacuum_vacuum_cost_limit']
+        if costlimit == -1:
+            costlimit = settings['vacuum_cost_limit']
+        costdelay = settings['autovacuum_vacuum_cost_delay']
+        if costdelay == -1:
+            costdelay = settings['vacuum_cost_delay']
+        busy    = int(settings['busy_workers'])
+        workers = int(settings['autovacuum_max_workers'])
+
+        # prefilter server side with the cluster settings, tables with reloptions are always checked
+        sql = "select quote_ident(n.nspname) || '.' || quote_ident(c.relname), c.reltuples::bigint, c.relpages::bigint * %d, s.n_dead_tup, s.n_mod_since_analyze, s.autovacuum_count, s.autoanalyze_count, " \
+              "coalesce(round(extract(epoch from now() - s.last_autovacuum) / 3600), -1), coalesce(array_to_string(c.reloptions, ' '), '') " \
+              "from pg_class c join pg_namespace n on n.oid = c.relnamespace join pg_stat_user_tables s on s.relid = c.oid " \
+              "where c.relkind in ('r', 'm') %s and (c.relpages::bigint * %d > %d or c.reloptions is not null or s.n_dead_tup > %f + %f * c.reltuples or s.n_mod_since_analyze > %f + %f * c.reltuples)" % \
+              (settings['block_size'], self.schemaclause, settings['block_size'], AUTOVAC_MIN_BYTES, settings['autovacuum_vacuum_threshold'], settings['autovacuum_vacuum_scale_factor'],
+               settings['autovacuum_analyze_threshold'], settings['autovacuum_analyze_scale_factor'])
+        rc, rows = self.get_rows(sql, probe='autovacuum tables')
+        if rc != SUCCESS:
+            errors = "Unable to get autovacuum table stats: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        listrows = []
+        for row in rows:
+            table, reltuples, size, dead, mods = row[0], max(int(row[1]), 0), int(row[2]), int(row[3]), int(row[4])
+            options = dict([option.split('=', 1) for option in row[8].split()])
+            vac_sf   = float(options.get('autovacuum_vacuum_scale_factor', settings['autovacuum_vacuum_scale_factor']))
+            vac_thr  = float(options.get('autovacuum_vacuum_threshold', settings['autovacuum_vacuum_threshold']))
+            anl_sf   = float(options.get('autovacuum_analyze_scale_factor', settings['autovacuum_analyze_scale_factor']))
+            anl_thr  = float(options.get('autovacuum_analyze_threshold', settings['autovacuum_analyze_threshold']))
+            vac_trigger = vac_thr + vac_sf * reltuples
+            anl_trigger = anl_thr + anl_sf * reltuples
+
+            findings = []
+            settable = []
+            if options.get('autovacuum_enabled', 'true') in ('false', 'off', '0'):
+                findings.append("autovacuum disabled for this table")
+            if dead > vac_trigger:
+                findings.append("past vacuum trigger, autovacuum is behind")
+            if mods > anl_trigger:
+                findings.append("past analyze trigger")
+
+            # dead space that can build up before the trigger fires
+            if reltuples > 0 and vac_sf * size > AUTOVAC_MAX_DEAD_BYTES:
+                newsf = max(round(float(AUTOVAC_MAX_DEAD_BYTES) / size, 3), AUTOVAC_MIN_SCALE)
+                findings.append("bloats up to %s between autovacuum runs" % self.prettysize(int(vac_sf * size)))
+                settable.append("autovacuum_vacuum_scale_factor = %s" % newsf)
+                settable.append("autovacuum_analyze_scale_factor = %s" % max(round(newsf / 2, 3), AUTOVAC_MIN_SCALE / 2))
+
+            # a throttled vacuum reads about every page once, each costing vacuum_cost_page_miss, and sleeps
+            # cost_delay after every cost_limit worth.  The cluster limit is shared by the running workers.
+            pertable = 'autovacuum_vacuum_cost_limit' in options
+            if pertable:
+                tablelimit = float(options['autovacuum_vacuum_cost_limit'])
+            else:
+                tablelimit = costlimit / max(busy, 1)
+            tabledelay = float(options.get('autovacuum_vacuum_cost_delay', costdelay))
+            if tabledelay > 0 and tablelimit > 0:
+                pagecost = size / settings['block_size'] * settings['vacuum_cost_page_miss']
+                seconds  = pagecost / tablelimit * tabledelay / 1000
+                if seconds > AUTOVAC_MAX_SECONDS:
+                    newlimit = min(int(math.ceil(pagecost * tabledelay / 1000 / AUTOVAC_MAX_SECONDS / 100.0)) * 100, 10000)
+                    findings.append("throttled vacuum takes about %.1f hours" % (seconds / 3600))
+                    settable.append("autovacuum_vacuum_cost_limit = %d" % newlimit)
+
+            if len(findings) == 0:
+                continue
+            if len(settable) > 0:
+                recommendation = "alter table %s set (%s);" % (table, ', '.join(settable))
             else:
-                cmd = "psql %s -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-            rc, results = self.executecmd(cmd, False)
+                recommendation = ''
+            pct = dead * 100.0 / vac_trigger if vac_trigger > 0 else 0
+            lastrun = "never" if row[7] == '-1' else row[7]
+            listrows.append([pct, table, self.prettysize(size), dead, int(vac_trigger), "%.0f" % pct, mods, int(anl_trigger), row[5], row[6], lastrun, '; '.join(findings), recommendation])
+
+        # most overdue first
+        listrows.sort(key=lambda row: row[0], reverse=True)
+        listrows = [row[1:] for row in listrows]
+        title = "Autovacuum advisor: tables past their trigger, bloating between runs or too big for the cost limit. %d of %d autovacuum workers busy, cost limit %d, cost delay %s ms." % \
+                (busy, workers, costlimit, costdelay)
+        headers = ['table', 'size', 'dead tuples', 'vacuum trigger', 'pct of trigger', 'mods since analyze', 'analyze trigger', 'autovacuums', 'autoanalyzes', 'hours since autovacuum', 'findings', 'recommendation']
+        self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def sample_wal(self):
+
+        # WAL generation and archive rates: sample the current WAL position and pg_stat_archiver twice and use
+        # the server clock for the interval.  Only sampled once per run, both archiver and replication checks use it.
+        rc, results = self.start_wal_sample()
+        if rc != SUCCESS or self.capturefile != '':
+            # a capture does not need the rates, the second sample is taken at the end of the run
+            return rc, results
+        return self.finish_wal_sample()
+
+    ###########################################################
+    def get_wal_sample(self):
+
+        sql = "select pg_current_wal_lsn(), extract(epoch from clock_timestamp()), pg_walfile_name(pg_current_wal_lsn()), archived_count, failed_count, " \
+              "coalesce(last_archived_wal, ''), coalesce(extract(epoch from last_archived_time), 0), coalesce(extract(epoch from last_failed_time), 0), " \
+              "pg_size_bytes(current_setting('wal_segment_size')) from pg_stat_archiver"
+        rc, rows = self.get_rows(sql, probe='wal sample')
+        if rc != SUCCESS:
+            return rc, "Unable to get current WAL position: %d %s\nsql=%s\n" % (rc, rows, sql)
+        self.walsamples.append(rows[0])
+        return SUCCESS, ""
+
+    ###########################################################
+    def start_wal_sample(self):
+
+        # The first sample is taken as soon as the run starts, so the sample interval overlaps the sections
+        # that run before the archiver and replication checks and only what is left of it has to be waited for.
+        if len(self.walsamples) > 0 or self.in_recovery or self.pgversionmajor < Decimal('10.0'):
+            return SUCCESS, ""
+        if len(self.enabled) > 0 and 'healthchecks' not in self.enabled and 'replication' not in self.enabled:
+            return SUCCESS, ""
+        self.walsample_started = time.time()
+        return self.get_wal_sample()
+
+    ###########################################################
+    def finish_wal_sample(self):
+
+        if len(self.walsamples) != 1 or self.walsample_seconds <= 0:
+            return SUCCESS, ""
+        remaining = self.walsample_seconds - (time.time() - self.walsample_started)
+        if self.replayfile == '' and remaining > 0:
+            time.sleep(remaining)
+        rc, results = self.get_wal_sample()
+        if rc != SUCCESS:
+            return rc, results
+
+        first, second = self.walsamples
+        elapsed = float(second[1]) - float(first[1])
+        if elapsed > 0:
+            self.walrate     = (self.lsn_to_bytes(second[0]) - self.lsn_to_bytes(first[0])) / elapsed
+            self.archiverate = (int(second[3]) - int(first[3])) / elapsed
+        return SUCCESS, ""
+
+    ###########################################################
+    def walfile_to_segno(self, walfile, segsize):
+        # WAL file names are timeline, log and segment as 8 hex digits each.  Ignore the timeline.
+        return int(walfile[8:16], 16) * (0x100000000 // segsize) + int(walfile[16:24], 16)
+
+    ###########################################################
+    def get_archiverstatus(self):
+
+        rc, results = self.sample_wal()
+        if rc != SUCCESS:
+            return rc, results
+        if len(self.walsamples) == 0:
+            return WARNING, "no WAL samples"
+
+        sample  = self.walsamples[-1]
+        segsize = int(sample[8])
+        lastwal = sample[5][0:24]
+        lastarchived = float(sample[6])
+        lastfailed   = float(sample[7])
+        failed  = int(sample[4]) - int(self.walsamples[0][4])
+
+        # history and backup files are archived too, only WAL segment names can be compared to the current position
+        if len(lastwal) != 24 or not all(c in '0123456789ABCDEF' for c in lastwal):
+            backlog = -1
+        else:
+            backlog = max(self.walfile_to_segno(sample[2], segsize) - self.walfile_to_segno(lastwal, segsize) - 1, 0)
+
+        rates = ''
+        if self.archiverate >= 0 and self.walrate >= 0:
+            rates = "  Archiving %.2f WAL files/min while generating %.2f WAL files/min." % (self.archiverate * 60, self.walrate / segsize * 60)
+
+        if failed > 0:
+            marker = MARK_WARN
+            msg = "Archiving failed %d times during the %d second sample. Last archived WAL: %s.%s" % (failed, self.walsample_seconds, sample[5], rates)
+        elif lastfailed > lastarchived:
+            marker = MARK_WARN
+            msg = "Last archive attempt failed (total failures=%s). Last archived WAL: %s.%s" % (sample[4], sample[5], rates)
+        elif backlog > 1000:
+            marker = MARK_WARN
+            msg = "Archiving is behind more than 1000 WAL files. Current count: %d.%s" % (backlog, rates)
+        elif backlog == -1 and int(sample[3]) == 0:
+            marker = MARK_WARN
+            msg = "Archiving is on but no WAL files have been archived yet."
+        elif backlog <= 0:
+            marker = MARK_OK
+            msg = "Archiving is on and no WAL backup detected.%s" % rates
+        else:
+            marker = MARK_OK
+            msg = "Archiving is working and not too far behind. WALs waiting to be archived=%d.%s" % (backlog, rates)
+
+        return SUCCESS, (marker, msg)
+
+    ###########################################################
+    def lsn_to_bytes(self, lsn):
+        # LSN text form is two hex numbers: high and low 32 bits
+        parts = lsn.split('/')
+        return (int(parts[0], 16) << 32) + int(parts[1], 16)
+
+    ###########################################################
+    def get_walfreebytes(self):
+        try:
+            st = os.statvfs("%s%spg_wal" % (self.datadir, self.dir_delim))
+        except (OSError, AttributeError):
+            return -1
+        return st.f_bavail * st.f_frsize
+
+    ###########################################################
+    def do_report_replication(self):
+
+        if self.pgversionmajor < Decimal('10.0'):
+            # lag columns and wal function names only exist in v10+
+            return SUCCESS, ""
+
+        if self.in_recovery:
+            sql = "select coalesce(round(extract(epoch from now() - pg_last_xact_replay_timestamp()))::bigint, 0), coalesce(pg_wal_lsn_diff(pg_last_wal_receive_lsn(), pg_last_wal_replay_lsn()), 0)::bigint"
+            rc, rows = self.get_rows(sql, probe='standby replay')
             if rc != SUCCESS:
-                errors = "Unable to get user table stats: %d %s\ncmd=%s\n" % (rc, results, cmd)
-                aline = "%s" % (errors)
-                self.writeout(aline)
+                errors = "Unable to get standby replay status: %d %s\nsql=%s\n" % (rc, rows, sql)
+                self.writeout(errors)
                 return rc, errors
+            title = "Replication: this cluster is a standby."
+            headers = ['seconds since last replayed transaction', 'received but not replayed']
+            self.appendlist(title, headers, [[rows[0][0], self.prettysize(int(rows[0][1]))]])
+            return SUCCESS, ""
+
+        rc, results = self.sample_wal()
+        if rc != SUCCESS:
+            self.writeout(results)
+            return rc, results
+
+        sql = "select coalesce(application_name, ''), coalesce(client_addr::text, 'local'), state, sync_state, " \
+              "coalesce(pg_wal_lsn_diff(pg_current_wal_lsn(), sent_lsn), 0)::bigint, coalesce(pg_wal_lsn_diff(pg_current_wal_lsn(), write_lsn), 0)::bigint, " \
+              "coalesce(pg_wal_lsn_diff(pg_current_wal_lsn(), flush_lsn), 0)::bigint, coalesce(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn), 0)::bigint, " \
+              "coalesce(extract(epoch from write_lag), 0), coalesce(extract(epoch from flush_lag), 0), coalesce(extract(epoch from replay_lag), 0) " \
+              "from pg_stat_replication order by 8 desc"
+        rc, standbys = self.get_rows(sql, probe='replication lag')
+        if rc != SUCCESS:
+            errors = "Unable to get replication lag: %d %s\nsql=%s\n" % (rc, standbys, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        if self.pgversionmajor < Decimal('13.0'):
+            walstatus = "''"
+        else:
+            walstatus = "coalesce(wal_status, '')"
+        sql = "select slot_name, slot_type, coalesce(database, ''), active, coalesce(pg_wal_lsn_diff(pg_current_wal_lsn(), restart_lsn), 0)::bigint, %s " \
+              "from pg_replication_slots order by 5 desc" % walstatus
+        rc, slots = self.get_rows(sql, probe='replication slots')
+        if rc != SUCCESS:
+            errors = "Unable to get replication slots: %d %s\nsql=%s\n" % (rc, slots, sql)
+            self.writeout(errors)
+            return rc, errors
 
-            if self.html_format:
-                self.appendreport("<H4>List of tables that are past the midway point of going into transaction wraparound mode and therefore candidates for manual vacuum freeze.</H4>")
+        if len(standbys) == 0 and len(slots) == 0:
+            return SUCCESS, ""
+
+        if self.walrate >= 0:
+            rate = "WAL generation rate: %s/sec." % self.prettysize(int(self.walrate))
+        else:
+            rate = "WAL generation rate: N/A."
+
+        if len(standbys) > 0:
+            listrows = []
+            for row in standbys:
+                listrows.append(row[0:4] + [self.prettysize(int(row[idx])) for idx in range(4, 8)] + ["%.2f" % float(row[idx]) for idx in range(8, 11)])
+            title = "Replication lag per standby.  %s" % rate
+            headers = ['application', 'client', 'state', 'sync state', 'not sent', 'write lag', 'flush lag', 'replay lag', 'write lag secs', 'flush lag secs', 'replay lag secs']
+            self.appendlist(title, headers, listrows)
+
+        if len(slots) == 0:
+            return SUCCESS, ""
+
+        # inactive slots hold back WAL that grows at the generation rate, so estimate when pg_wal fills up
+        inactive = [slot for slot in slots if slot[3] != 't']
+        estimate = ''
+        if len(inactive) > 0 and self.local and self.datadir != '':
+            freebytes = self.probe("statvfs pg_wal", self.get_walfreebytes)
+            if freebytes is None or freebytes < 0:
+                estimate = "  %d inactive slot(s) retaining WAL." % len(inactive)
+            elif self.walrate > 0:
+                estimate = "  %d inactive slot(s): pg_wal disk (%s free) fills in about %.1f hours at the current WAL rate." % (len(inactive), self.prettysize(freebytes), freebytes / self.walrate / 3600)
             else:
-                self.appendreport("\nList of tables that are past the midway point of going into transaction wraparound mode and therefore candidates for manual vacuum freeze.\n")
+                estimate = "  %d inactive slot(s): pg_wal disk has %s free." % (len(inactive), self.prettysize(freebytes))
+        elif len(inactive) > 0:
+            estimate = "  %d inactive slot(s) retaining WAL." % len(inactive)
 
-            f = open(self.tempfile, "r")
-            lineno = 0
-            count  = 0
-            for line in f:
-                lineno = lineno + 1
-                if self.verbose:
-                    #print ("%d line=%s" % (lineno,line))
-                    pass
-                aline = line.strip()
-                if len(aline) < 1:
-                    continue
-                elif '(0 rows)' in aline:
-                    continue
-                elif '(0 rows)' in aline:
+        listrows = []
+        for row in slots:
+            listrows.append([row[0], row[1], row[2], row[3], self.prettysize(int(row[4])), row[5]])
+        title = "WAL retained by replication slots.  %s%s" % (rate, estimate)
+        headers = ['slot', 'type', 'database', 'active', 'retained WAL', 'wal status']
+        self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_locks(self):
+
+        if self.pgversionmajor < Decimal('9.6'):
+            # pg_blocking_pids() and wait_event_type do not exist
+            return SUCCESS, ""
+
+        # pg_blocking_pids() takes the lock manager locks, so only call it for sessions actually waiting on a lock
+        sql = "select pid, case when wait_event_type = 'Lock' then array_to_string(pg_blocking_pids(pid), ',') else '' end, coalesce(usename, ''), coalesce(state, ''), " \
+              "coalesce(wait_event_type || ':' || wait_event, ''), coalesce(round(extract(epoch from now() - xact_start))::bigint, 0), " \
+              "regexp_replace(left(coalesce(query, ''), 100), '[[:space:]|]+', ' ', 'g') from pg_stat_activity where pid <> pg_backend_pid()"
+        rc, rows = self.get_rows(sql, probe='blocking sessions')
+        if rc != SUCCESS:
+            errors = "Unable to get blocking sessions: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        # build the wait-for graph: blocker pid --> pids it blocks
+        sessions = {}
+        blocked  = {}
+        for row in rows:
+            sessions[row[0]] = row
+            if row[1] == '':
+                continue
+            for blocker in row[1].split(','):
+                blocked.setdefault(blocker, []).append(row[0])
+
+        waiting = set()
+        for pids in blocked.values():
+            waiting.update(pids)
+
+        # root blockers block others but are not waiting themselves.  Sessions in a lock cycle have no root,
+        # the deadlock detector will resolve those.
+        roots = []
+        for blocker in blocked:
+            if blocker in waiting:
+                continue
+            subtree = set()
+            stack = list(blocked[blocker])
+            while stack:
+                pid = stack.pop()
+                if pid in subtree:
                     continue
+                subtree.add(pid)
+                stack.extend(blocked.get(pid, []))
+            roots.append([blocker, len(blocked[blocker]), len(subtree)])
 
-                if lineno == 1:
-                    if self.html_format:
-                        self.appendreport(aline)
-                    else:     
-                        self.appendreport("%s\n" % aline)
-                else:
-                    if self.html_format:
-                         self.appendreport(aline)
-                    else:
-                        self.appendreport("%s\n" % aline)
+        if len(roots) == 0:
+            return SUCCESS, ""
+
+        roots.sort(key=lambda root: root[2], reverse=True)
+        listrows = []
+        for pid, direct, total in roots[:self.topn]:
+            row = sessions.get(pid, [pid, '', '', '', '', 0, ''])
+            listrows.append([pid, row[2], row[3], row[4], row[5], direct, total, row[6]])
+        title = "Root blockers: %d sessions are waiting behind %d root blocking sessions." % (len(waiting), len(roots))
+        headers = ['pid', 'user', 'state', 'wait event', 'xact seconds', 'directly blocked', 'blocked subtree', 'query']
+        self.appendlist(title, headers, listrows)
+
+        # lock counts by relation and mode for the current database only, since relation oids are per database
+        sql = "select case when l.relation is not null then replace(l.relation::regclass::text, '|', ' ') else l.locktype end, l.mode, count(*) filter (where l.granted), count(*) filter (where not l.granted) " \
+              "from pg_locks l where l.database is null or l.database = (select oid from pg_database where datname = current_database()) " \
+              "group by 1, 2 order by 4 desc, 3 desc limit %d" % self.topn
+        rc, rows = self.get_rows(sql, probe='lock counts')
+        if rc != SUCCESS:
+            errors = "Unable to get lock counts: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        title = "Locks by relation and mode."
+        headers = ['relation or lock type', 'mode', 'granted', 'waiting']
+        self.appendlist(title, headers, rows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_ash_samples(self):
+
+        # All samples are taken by one psql session running a generated script, so there is no connection
+        # overhead per sample.  Each statement runs in its own transaction, so pg_stat_activity is fresh every time.
+        # query_id only exists in v14+ and may be null if compute_query_id is off, so fall back to a hash of the text.
+        if self.pgversionmajor < Decimal('14.0'):
+            queryid = "left(md5(query), 16)"
+        else:
+            queryid = "coalesce(query_id::text, left(md5(query), 16))"
+        sql = "select %%d, coalesce(wait_event_type, ''), coalesce(wait_event, ''), coalesce(state, ''), %s, backend_type, " \
+              "regexp_replace(left(query, 100), '[[:space:]|]+', ' ', 'g') from pg_stat_activity " \
+              "where pid <> pg_backend_pid() and (coalesce(state, '') not in ('idle', '') or (state is null and wait_event_type is not null and wait_event_type <> 'Activity'));\n" \
+              "select pg_sleep(%.3f);\n" % (queryid, self.ash_interval)
+        samples = int(self.ash_seconds / self.ash_interval)
+
+        key = "ash"
+        if self.replayfile != '':
+            # the sampling is what was captured, whatever --ash and --ash-interval say now
+            captured = self.replay_probe(key)
+            if captured is None:
+                return ERROR, "Active session samples not found in capture archive, %s" % self.replayfile
+            for aline in captured['lines']:
+                self.add_ash_sample(aline)
+            self.ash_seconds   = captured['seconds']
+            self.ash_interval  = captured['interval']
+            self.ash_samplecnt = captured['samples']
+            return SUCCESS, ""
+
+        ashfile = "%s%s%s_ash.sql" % (self.tempdir, self.dir_delim, self.pid)
+        f = open(ashfile, "w")
+        for sampleno in range(samples):
+            f.write(sql % sampleno)
+        f.close()
+
+        cmd = "psql %s -X -q -A -t -f %s" % (self.connstring, ashfile)
+        if self.opsys == 'posix':
+            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, executable="/bin/bash")
+        else:
+            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+
+        # stderr is drained in a thread, psql would block on a full stderr pipe while stdout is still being read
+        errors = []
+        drain = threading.Thread(target=lambda: errors.append(p.stderr.read()))
+        drain.daemon = True
+        drain.start()
+
+        # stream the rows into the ring buffer as they arrive
+        captured = []
+        for line in p.stdout:
+            aline = bytes(line).decode('utf-8').rstrip('\r\n')
+            if self.capturefile != '':
+                captured.append(aline)
+            self.add_ash_sample(aline)
+        drain.join()
+        p.wait()
+        err = errors[0] if len(errors) > 0 else b''
+        try:
+            os.remove(ashfile)
+        except OSError:
+            pass
+        if p.returncode != SUCCESS:
+            return ERROR, "Unable to sample pg_stat_activity: %s" % bytes(err).decode('utf-8')
+        if self.capturefile != '':
+            self.capture_probe(key, {'seconds': self.ash_seconds, 'interval': self.ash_interval, 'samples': samples, 'lines': captured})
+
+        self.ash_samplecnt = samples
+        return SUCCESS, ""
+
+    ###########################################################
+    def add_ash_sample(self, aline):
+        # interning the repeated strings keeps the ring buffer compact
+        if len(aline) < 1:
+            return
+        cols = aline.split('|')
+        if len(cols) < 7:
+            return
+        queryid = intern(cols[4])
+        if queryid not in self.ash_queries:
+            self.ash_queries[queryid] = cols[6]
+        self.ash_samples.append((int(cols[0]), intern(cols[1]), intern(cols[2]), intern(cols[3]), queryid, intern(cols[5])))
+
+    ###########################################################
+    def do_report_ash(self):
+
+        if self.ash_seconds <= 0:
+            return SUCCESS, ""
+        if self.pgversionmajor < Decimal('10.0'):
+            # backend_type does not exist
+            print ("Active session history sampling requires PG 10 or higher.")
+            return SUCCESS, ""
+
+        print ("Sampling active sessions every %.2f seconds for %d seconds..." % (self.ash_interval, self.ash_seconds))
+        rc, results = self.get_ash_samples()
+        if rc != SUCCESS:
+            self.writeout(results)
+            return rc, results
+        if self.ash_samplecnt == 0 or len(self.ash_samples) == 0:
+            return SUCCESS, ""
+
+        # wait event profile: active sessions not waiting on anything are on CPU (or waiting on something untracked)
+        events  = {}
+        queries = {}
+        for sample in self.ash_samples:
+            if sample[2] == '':
+                event = 'CPU'
+            else:
+                event = "%s:%s" % (sample[1], sample[2])
+            events[event] = events.get(event, 0) + 1
+            if sample[2] == '' or sample[1] == 'Activity':
+                continue
+            query = queries.setdefault(sample[4], {})
+            query[event] = query.get(event, 0) + 1
+
+        total = len(self.ash_samples)
+        listrows = []
+        for event, count in sorted(events.items(), key=lambda item: item[1], reverse=True)[:self.topn * 2]:
+            listrows.append([event, count, "%.2f" % (count * 100.0 / total), "%.2f" % (float(count) / self.ash_samplecnt)])
+        title = "Wait event profile from %d samples over %d seconds (%d session samples)." % (self.ash_samplecnt, self.ash_seconds, total)
+        headers = ['wait event', 'samples', 'pct', 'avg active sessions']
+        self.appendlist(title, headers, listrows)
+
+        listrows = []
+        ranked = sorted(queries.items(), key=lambda item: sum(item[1].values()), reverse=True)[:self.topn]
+        for queryid, waits in ranked:
+            topevent = max(waits.items(), key=lambda item: item[1])[0]
+            listrows.append([queryid, sum(waits.values()), topevent, self.ash_queries.get(queryid, '')])
+        if len(listrows) > 0:
+            title = "Top waiting queries, including DataFileRead waits."
+            headers = ['query id', 'wait samples', 'top wait event', 'query']
+            self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_pgss_available(self):
+
+        if 'pg_stat_statements' not in self.shared_preload_libraries:
+            # health checks already warn about this
+            return SUCCESS, False
+        if self.pgversionmajor < Decimal('9.4'):
+            # queryid column does not exist
+            return SUCCESS, False
+
+        # library may be preloaded without the extension being created in this database
+        rc, rows = self.get_rows("select count(*) from pg_extension where extname = 'pg_stat_statements'", probe='pg_stat_statements')
+        if rc != SUCCESS:
+            errors = "Unable to check for pg_stat_statements extension: %d %s\n" % (rc, rows)
+            self.writeout(errors)
+            return rc, errors
+        return SUCCESS, int(rows[0][0]) > 0
+
+    ###########################################################
+    def do_report_workload(self):
+
+        rc, available = self.get_pgss_available()
+        if rc != SUCCESS:
+            return rc, available
+        if not available:
+            return SUCCESS, ""
+
+        rc, results = self.get_statement_deltas()
+        if rc != SUCCESS:
+            self.writeout(results)
+            return rc, results
+        rows, leftout = results
+        statements = []
+        for row in rows:
+            calls = row[1]
+            total = row[2] / 1000.0
+            mean  = total / calls if calls > 0 else 0.0
+            statements.append([row[0], calls, total, mean, row[3], row[4]])
+        qualifier = self.delta_qualifier('statements', leftout, 'statement(s)')
+
+        # rank first, then fetch the text of the statements that made a list
+        metrics = [('total time', 2), ('mean time', 3), ('shared blocks read', 4), ('temp blocks written', 5), ('calls', 1)]
+        rankings = []
+        keys = set()
+        for name, idx in metrics:
+            ranked = sorted([stmt for stmt in statements if stmt[idx] > 0], key=lambda stmt: stmt[idx], reverse=True)[:self.topn]
+            rankings.append((name, ranked))
+            keys.update([stmt[0] for stmt in ranked])
+        rc, texts = self.get_statement_texts(keys, 200)
+        if rc != SUCCESS:
+            self.writeout(texts)
+            return rc, texts
+
+        headers = ['queryid', 'calls', 'total ms', 'mean ms', 'shared blks read', 'temp blks written', 'query']
+        for name, ranked in rankings:
+            listrows = [[stmt[0].split(':', 1)[1], stmt[1], "%.2f" % stmt[2], "%.2f" % stmt[3], stmt[4], stmt[5], texts.get(stmt[0], '')] for stmt in ranked]
+            title = "Top %d statements by %s (%s)." % (self.topn, name, qualifier)
+            self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_statement_deltas(self):
+
+        # Counters of every statement of this database, not only of a top window, so that each one has a baseline in
+        # the next snapshot and the top lists are ranked on deltas.  The text is not fetched here.  queryid is null
+        # when compute_query_id is off, so fall back to a hash of the text, as the active session sampler does.
+        # Fetched once per run, the workload and sequential scan sections share them.
+        if self.statements is not None:
+            return SUCCESS, self.statements
+        if self.pgversionmajor < Decimal('13.0'):
+            total_col = 'total_time'
+        else:
+            total_col = 'total_exec_time'
+        sql = "select userid || ':' || coalesce(queryid::text, left(md5(query), 16)), sum(calls), round(sum(%s) * 1000)::bigint, sum(shared_blks_read), " \
+              "sum(temp_blks_written), sum(shared_blks_hit) from pg_stat_statements where dbid = (select oid from pg_database where datname = current_database()) " \
+              "group by 1" % total_col
+        rc, rows = self.get_rows(sql, probe='statements')
+        if rc != SUCCESS:
+            return rc, "Unable to get pg_stat_statements counters: %d %s\nsql=%s\n" % (rc, rows, sql)
+        # total time is kept in microseconds so all counters are integers
+        self.statements = self.get_deltas('statements', rows, 5)
+        return SUCCESS, self.statements
+
+    ###########################################################
+    def get_statement_texts(self, keys, length):
+
+        # query text of the given statements only, truncated and cleaned up server side
+        if len(keys) == 0:
+            return SUCCESS, {}
+        sql = "select key, min(query) from (select userid || ':' || coalesce(queryid::text, left(md5(query), 16)) as key, " \
+              "regexp_replace(left(query, %d), '[[:space:]|]+', ' ', 'g') as query from pg_stat_statements " \
+              "where dbid = (select oid from pg_database where datname = current_database())) s where key in (%s) group by key" % \
+              (length, ', '.join(["'%s'" % key for key in sorted(keys)]))
+        rc, rows = self.get_rows(sql, probe='statement texts')
+        if rc != SUCCESS:
+            return rc, "Unable to get pg_stat_statements query text: %d %s\nsql=%s\n" % (rc, rows, sql)
+        return SUCCESS, dict([(row[0], row[1]) for row in rows])
+
+    ###########################################################
+    def get_deltas(self, name, rows, ncounters):
+
+        # rows start with a key followed by ncounters cumulative counters.  Every row is saved in the snapshot, so the
+        # next run has a baseline for the whole candidate set.  When there is a baseline for this name, counters are
+        # replaced by their deltas.  Rows without one (new since the previous run, or counters that went backwards
+        # after a stats reset) are left out: their cumulative counters would outrank every real delta.
+        # Returns the rows and the number of rows left out.
+        prev = self.prevsnapshot.get(name) if self.snapshot_interval() > 0 else None
+        current = {}
+        deltas = []
+        leftout = 0
+        for row in rows:
+            counters = [int(col) for col in row[1:ncounters + 1]]
+            current[row[0]] = counters
+            if prev is None:
+                row[1:ncounters + 1] = counters
+                deltas.append(row)
+                continue
+            old = prev.get(row[0])
+            if old is None or len(old) != ncounters or any([counters[idx] < old[idx] for idx in range(ncounters)]):
+                leftout += 1
+                continue
+            row[1:ncounters + 1] = [counters[idx] - old[idx] for idx in range(ncounters)]
+            deltas.append(row)
+        self.snapshot[name] = current
+        return deltas, leftout
+
+    ###########################################################
+    def delta_qualifier(self, name, leftout, what):
+        # how the counters of a list were computed, for its title
+        interval = self.snapshot_interval()
+        if interval <= 0 or name not in self.prevsnapshot:
+            return "cumulative since stats reset"
+        qualifier = "deltas over the last %.1f minutes" % interval
+        if leftout > 0:
+            qualifier += ", %d %s without a baseline in the previous run left out" % (leftout, what)
+        return qualifier
+
+    ###########################################################
+    def do_report_iohotspots(self):
+
+        # The database wide cache hit ratio hides which relations cause the reads, so rank them from pg_statio.
+        # The counters of every relation are fetched, so each one has a baseline in the next snapshot, and the
+        # ranking is on deltas.  Only the top relations are sized.  Reads are blocks not found in shared_buffers,
+        # they may still come from the OS cache.
+        sql = "select s.relid, s.heap_blks_read, s.heap_blks_hit, coalesce(s.idx_blks_read, 0), coalesce(s.idx_blks_hit, 0), coalesce(s.toast_blks_read, 0) + coalesce(s.tidx_blks_read, 0), " \
+              "coalesce(s.toast_blks_hit, 0) + coalesce(s.tidx_blks_hit, 0), s.schemaname || '.' || s.relname from pg_statio_user_tables s " \
+              "join pg_namespace n on n.nspname = s.schemaname where true %s" % self.schemaclause
+        rc, tables = self.get_rows(sql, probe='io tables')
+        if rc != SUCCESS:
+            errors = "Unable to get table I/O stats: %d %s\nsql=%s\n" % (rc, tables, sql)
+            self.writeout(errors)
+            return rc, errors
+        sql = "select s.indexrelid, s.idx_blks_read, s.idx_blks_hit, s.schemaname || '.' || s.relname, s.indexrelname from pg_statio_user_indexes s " \
+              "join pg_namespace n on n.nspname = s.schemaname where true %s" % self.schemaclause
+        rc, indexes = self.get_rows(sql, probe='io indexes')
+        if rc != SUCCESS:
+            errors = "Unable to get index I/O stats: %d %s\nsql=%s\n" % (rc, indexes, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        tables, tablesleftout   = self.get_deltas('statio_tables', tables, 6)
+        indexes, indexesleftout = self.get_deltas('statio_indexes', indexes, 2)
+        tables  = [row for row in tables if row[1] + row[3] + row[5] > 0]
+        tables.sort(key=lambda row: row[1] + row[3] + row[5], reverse=True)
+        tables  = tables[:self.topn]
+        indexes = [row for row in indexes if row[1] > 0]
+        indexes.sort(key=lambda row: row[1], reverse=True)
+        indexes = indexes[:self.topn]
+
+        sizes = {}
+        oids = [row[0] for row in tables + indexes]
+        if len(oids) > 0:
+            sql = "select c.oid, case when c.relkind = 'i' then pg_relation_size(c.oid) else pg_total_relation_size(c.oid) end from pg_class c where c.oid in (%s)" % ','.join(oids)
+            rc, rows = self.get_rows(sql, probe='io sizes')
+            if rc != SUCCESS:
+                errors = "Unable to get relation sizes: %d %s\nsql=%s\n" % (rc, rows, sql)
+                self.writeout(errors)
+                return rc, errors
+            sizes = dict([(row[0], int(row[1])) for row in rows])
+
+        # a table plus its indexes that does not fit in shared_buffers can never be fully cached there
+        sharedbytes = self.shared_buffers * 1048576
+        listrows = []
+        toobig = 0
+        for row in tables:
+            reads = row[1] + row[3] + row[5]
+            hits = row[2] + row[4] + row[6]
+            size = sizes.get(row[0], 0)
+            if self.shared_buffers > 0 and size > sharedbytes:
+                flag = 'yes'
+                toobig += 1
+            else:
+                flag = ''
+            listrows.append([row[7], row[1], row[3], row[5], reads, "%.2f" % (hits * 100.0 / (hits + reads)), self.prettysize(size), flag])
+        qualifier = self.delta_qualifier('statio_tables', tablesleftout, 'table(s)')
+        title = "Top %d tables by blocks read outside shared_buffers (%s). %d of them are larger than shared_buffers (%d MB)." % (self.topn, qualifier, toobig, self.shared_buffers)
+        headers = ['table', 'heap blks read', 'idx blks read', 'toast blks read', 'total blks read', 'hit pct', 'total size', 'larger than shared_buffers']
+        self.appendlist(title, headers, listrows)
+
+        listrows = []
+        for row in indexes:
+            listrows.append([row[3], row[4], row[1], "%.2f" % (row[2] * 100.0 / (row[1] + row[2])), self.prettysize(sizes.get(row[0], 0))])
+        qualifier = self.delta_qualifier('statio_indexes', indexesleftout, 'index(es)')
+        title = "Top %d indexes by blocks read outside shared_buffers (%s)." % (self.topn, qualifier)
+        headers = ['table', 'index', 'blks read', 'hit pct', 'size']
+        self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_seqscans(self):
+
+        # Tables that need an index: rank tables by the data their sequential scans read (scans times table size),
+        # with the share of scans that were sequential and the rows each one read.  Small tables are left out, a
+        # sequential scan is the right plan for them.  Every candidate table is fetched so each one has a baseline
+        # in the next snapshot.  With pg_stat_statements, the top statements by blocks accessed, on the same kind of
+        # counters as the tables, are matched to the tables whose name appears in their text.
+        window = self.topn * 5
+        sql = "select s.relid, s.seq_scan, s.seq_tup_read, coalesce(s.idx_scan, 0), s.schemaname || '.' || s.relname, s.relname, " \
+              "c.relpages::bigint * current_setting('block_size')::bigint, s.n_live_tup from pg_stat_user_tables s join pg_class c on c.oid = s.relid " \
+              "join pg_namespace n on n.oid = c.relnamespace where c.relpages::bigint * current_setting('block_size')::bigint >= %d %s" % \
+              (SEQSCAN_MIN_BYTES, self.schemaclause)
+        rc, tables = self.get_rows(sql, probe='seqscans')
+        if rc != SUCCESS:
+            errors = "Unable to get sequential scan stats: %d %s\nsql=%s\n" % (rc, tables, sql)
+            self.writeout(errors)
+            return rc, errors
+
+        tables, leftout = self.get_deltas('seqscans', tables, 3)
+        qualifier = self.delta_qualifier('seqscans', leftout, 'table(s)')
+        tables = [row for row in tables if row[1] > 0]
+        tables.sort(key=lambda row: row[1] * int(row[6]), reverse=True)
+        tables = tables[:self.topn]
+
+        statements = []
+        stmtqualifier = ''
+        rc, available = self.get_pgss_available()
+        if rc != SUCCESS:
+            return rc, available
+        if available:
+            # fetched even without tables to match, so the statements keep their baseline for the next run
+            rc, results = self.get_statement_deltas()
+            if rc != SUCCESS:
+                self.writeout(results)
+                return rc, results
+            rows, stmtleftout = results
+            stmtqualifier = self.delta_qualifier('statements', stmtleftout, 'statement(s)')
+            # key, calls, total ms, shared blocks read + hit, ranked before the text of the top window is fetched
+            ranked = [[row[0], row[1], row[2] / 1000.0, row[3] + row[5]] for row in rows if row[3] + row[5] > 0]
+            ranked = sorted(ranked, key=lambda stmt: stmt[3], reverse=True)[:window if len(tables) > 0 else 0]
+            rc, texts = self.get_statement_texts([stmt[0] for stmt in ranked], 300)
+            if rc != SUCCESS:
+                self.writeout(texts)
+                return rc, texts
+            statements = [[stmt[0].split(':', 1)[1], stmt[1], "%.2f" % stmt[2], stmt[3], texts.get(stmt[0], '')] for stmt in ranked]
+
+        listrows = []
+        stmtrows = []
+        needindex = 0
+        for row in tables:
+            seqscans, seqrows, idxscans, size = row[1], row[2], row[3], int(row[6])
+            rowsperscan = seqrows // seqscans
+            seqpct = seqscans * 100.0 / (seqscans + idxscans)
+            if seqscans > idxscans and rowsperscan >= SEQSCAN_MIN_ROWS:
+                flag = 'yes'
+                needindex += 1
+            else:
+                flag = ''
+            # the table name as a word, optionally schema qualified or quoted
+            pattern = re.compile(r'(^|[^\w$])("?%s"?\.)?"?%s"?($|[^\w$])' % (re.escape(row[4].split('.')[0]), re.escape(row[5])), re.I)
+            matched = [stmt for stmt in statements if pattern.search(stmt[4])][:3]
+            for stmt in matched:
+                stmtrows.append([row[4], stmt[0], stmt[1], stmt[2], stmt[3], stmt[4]])
+            listrows.append([row[4], self.prettysize(size), seqscans, idxscans, "%.1f" % seqpct, rowsperscan, self.prettysize(seqscans * size), flag,
+                             ", ".join([stmt[0] for stmt in matched])])
+
+        title = "Top %d tables by data read with sequential scans (%s), tables of %s or more. %d of them read at least %d rows per scan with more sequential than index scans and likely miss an index." % \
+                (self.topn, qualifier, self.prettysize(SEQSCAN_MIN_BYTES), needindex, SEQSCAN_MIN_ROWS)
+        headers = ['table', 'size', 'seq scans', 'idx scans', 'seq scan pct', 'rows per seq scan', 'est. data scanned', 'likely missing index', 'top queryids']
+        self.appendlist(title, headers, listrows)
+
+        if len(stmtrows) > 0:
+            title = "Top statements by blocks accessed that name the tables above (matched on the query text, %s)." % stmtqualifier
+            headers = ['table', 'queryid', 'calls', 'total ms', 'shared blks accessed', 'query']
+            self.appendlist(title, headers, stmtrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_log_stats(self):
+
+        # Find the log files of the local server and split the part not read by the previous run into chunks for
+        # a pool of worker processes.  Only complete lines are read.  The new offsets, where the next run resumes,
+        # are saved by save_log_offsets once the whole report succeeded.
+        sql = "select name, setting from pg_settings where name in ('log_directory', 'log_destination', 'logging_collector')"
+        rc, rows = self.get_rows(sql, probe='log settings')
+        if rc != SUCCESS:
+            return rc, "Unable to get log settings: %d %s\nsql=%s\n" % (rc, rows, sql)
+        settings = dict(rows)
+        if settings['logging_collector'] != 'on':
+            # stderr goes wherever the server was started from, nothing is written to log_directory
+            return WARNING, "Log analysis skipped: logging_collector is off, so there are no log files in log_directory."
+        logdir = settings['log_directory']
+        if not os.path.isabs(logdir):
+            logdir = "%s%s%s" % (self.datadir, self.dir_delim, logdir)
+        destinations = [dest.strip() for dest in settings['log_destination'].split(',')]
+        try:
+            names = os.listdir(logdir)
+        except OSError as e:
+            return ERROR, "Unable to read log directory, %s: %s" % (logdir, e)
+
+        offsets = {}
+        if os.path.exists(self.logoffsetsfile):
+            try:
+                f = open(self.logoffsetsfile, "r")
+                offsets = json.load(f)
+                f.close()
+            except (IOError, OSError, ValueError):
+                offsets = {}
+
+        chunks = []
+        newoffsets = {}
+        resumed = False
+        for name in sorted(names):
+            if name.endswith('.csv'):
+                fmt = 'csvlog'
+            elif name.endswith('.json'):
+                fmt = 'jsonlog'
+            else:
+                fmt = 'stderr'
+            if fmt not in destinations:
+                continue
+            path = "%s%s%s" % (logdir, self.dir_delim, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            # a rotated and reused file name has a new inode or shrank, so start over
+            prev = offsets.get(path)
+            start = 0
+            if prev is not None and prev['inode'] == st.st_ino and prev['offset'] <= st.st_size:
+                start = prev['offset']
+                resumed = True
+            newoffsets[path] = {'inode': st.st_ino, 'offset': start}
+            if st.st_size <= start:
+                continue
+            f = open(path, "rb")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            last = mm.rfind(b'\n', start, st.st_size)
+            mm.close()
+            f.close()
+            if last < 0:
+                continue
+            end = last + 1
+            for chunkstart in range(start, end, LOG_CHUNK_BYTES):
+                chunks.append((path, fmt, chunkstart, min(chunkstart + LOG_CHUNK_BYTES, end), end))
+            newoffsets[path]['offset'] = end
+
+        stats = new_log_stats()
+        if len(chunks) == 1:
+            merge_log_stats(stats, analyze_log_chunk(chunks[0]))
+        elif len(chunks) > 1:
+            pool = multiprocessing.Pool(self.log_jobs or None)
+            for part in pool.imap_unordered(analyze_log_chunk, chunks):
+                merge_log_stats(stats, part)
+            pool.close()
+            pool.join()
+        stats['files']   = len(newoffsets)
+        stats['resumed'] = resumed
+        stats['logdir']  = logdir
+        self.logoffsets  = newoffsets
+        return SUCCESS, stats
+
+    ###########################################################
+    def save_log_offsets(self):
+
+        # only a live run that completed moves the offsets forward, a capture or a failed run reads the same logs again
+        if self.logoffsets is None or self.capturefile != '' or self.replayfile != '':
+            return SUCCESS, ""
+        try:
+            f = open(self.logoffsetsfile, "w")
+            json.dump(self.logoffsets, f)
+            f.close()
+        except (IOError, OSError) as e:
+            return WARNING, "Unable to save log offsets file, %s: %s" % (self.logoffsetsfile, e)
+        return SUCCESS, ""
+
+    ###########################################################
+    def do_report_logs(self):
+
+        if not self.logs:
+            return SUCCESS, ""
+        if not self.local or self.pg_type == 'rds':
+            print ("Log analysis skipped: it reads the log files of a local server.")
+            return SUCCESS, ""
+
+        result = self.probe("logs", self.get_log_stats)
+        if result is None:
+            return ERROR, "Log analysis not found in capture archive, %s" % self.replayfile
+        rc, stats = result
+        if rc == WARNING:
+            print (stats)
+            return SUCCESS, ""
+        if rc != SUCCESS:
+            self.writeout(stats)
+            return rc, stats
+        if stats['resumed']:
+            qualifier = "since the previous run"
+        else:
+            qualifier = "all log files"
+        print ("Log analysis: %s of log data read from %d file(s) in %s (%s)." % (self.prettysize(stats['bytes']), stats['files'], stats['logdir'], qualifier))
+
+        listrows = []
+        for kind, values in sorted(stats['checkpoints'].items()):
+            count, total, maxtotal, write, sync, maxsync = values
+            listrows.append([kind, count, "%.1f" % (total / count), "%.1f" % maxtotal, "%.1f" % (write / count), "%.1f" % (sync / count), "%.1f" % maxsync])
+        title = "Checkpoint durations from the server log (%s)." % qualifier
+        headers = ['kind', 'count', 'avg total s', 'max total s', 'avg write s', 'avg sync s', 'max sync s']
+        self.appendlist(title, headers, listrows)
+
+        # relation oids in lock messages are only resolved for the current database
+        oids = set()
+        for key in stats['lockwaits']:
+            match = re.search(r'relation (\d+) of database (\d+)', key)
+            if match:
+                oids.add(match.group(1))
+        names = {}
+        if len(oids) > 0:
+            sql = "select c.oid, n.nspname || '.' || c.relname, (select oid from pg_database where datname = current_database()) from pg_class c join pg_namespace n on n.oid = c.relnamespace " \
+                  "where c.oid in (%s)" % ','.join(sorted(oids))
+            rc, rows = self.get_rows(sql, probe='log relations')
+            if rc == SUCCESS:
+                names = dict([("relation %s of database %s" % (row[0], row[2]), row[1]) for row in rows])
+        listrows = []
+        for key, values in sorted(stats['lockwaits'].items(), key=lambda item: (item[1][0], item[1][2]), reverse=True)[:self.topn]:
+            mode, lockobject = key.split('|', 1)
+            for relation, name in names.items():
+                lockobject = lockobject.replace(relation, name)
+            waits, acquired, totalms, maxms = values
+            avgms = "%.0f" % (totalms / acquired) if acquired > 0 else ''
+            listrows.append([lockobject, mode, waits, acquired, avgms, "%.0f" % maxms])
+        title = "Top %d lock wait hot spots from log_lock_waits messages (%s)." % (self.topn, qualifier)
+        headers = ['lock object', 'mode', 'waits', 'acquired after wait', 'avg wait ms', 'max wait ms']
+        self.appendlist(title, headers, listrows)
+
+        count, totalbytes, maxbytes, buckets = stats['tempfiles']
+        listrows = []
+        lower = 0
+        for idx, upper in enumerate(LOG_TEMP_BUCKETS + [0]):
+            if upper > 0:
+                label = "%s - %s" % (self.prettysize(lower), self.prettysize(upper))
+            else:
+                label = "over %s" % self.prettysize(lower)
+            listrows.append([label, buckets[idx]])
+            lower = upper
+        title = "Temp file spills from log_temp_files messages (%s): %d files, %s in total, largest %s." % (qualifier, count, self.prettysize(totalbytes), self.prettysize(maxbytes))
+        self.appendlist(title, ['size', 'files'], listrows)
+
+        listrows = []
+        for fingerprint, values in sorted(stats['slow'].items(), key=lambda item: item[1][1], reverse=True)[:self.topn]:
+            calls, totalms, maxms = values
+            listrows.append([calls, "%.0f" % totalms, "%.0f" % (totalms / calls), "%.0f" % maxms, fingerprint])
+        title = "Top %d slow statement fingerprints by total duration from log_min_duration_statement messages (%s)." % (self.topn, qualifier)
+        headers = ['count', 'total ms', 'avg ms', 'max ms', 'statement']
+        self.appendlist(title, headers, listrows)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def check_hugepages(self):
+
+        # Without huge pages every backend maps shared memory with 4kB pages, so the page tables and TLB misses grow
+        # with shared_buffers times the number of backends.  PG 15+ reports the exact huge pages it needs, before that
+        # shared memory is estimated as shared_buffers plus wal_buffers plus a fixed overhead.
+        sql = "select name, setting from pg_settings where name in ('huge_pages', 'huge_pages_status', 'shared_memory_size_in_huge_pages', 'wal_buffers', 'block_size')"
+        rc, rows = self.get_rows(sql, probe='hugepages settings')
+        if rc != SUCCESS:
+            errors = "Unable to get huge pages settings: %d %s\nsql=%s\n" % (rc, rows, sql)
+            self.writeout(errors)
+            return rc, errors
+        settings = dict(rows)
+
+        rc, results = self.executecmd("cat /proc/meminfo", False, probe='meminfo')
+        if rc != SUCCESS:
+            errors = "Unable to read /proc/meminfo: %d %s\n" % (rc, results)
+            self.writeout(errors)
+            return rc, errors
+        meminfo = {}
+        for line in results.split('\n'):
+            fields = line.replace(':', ' ').split()
+            if len(fields) >= 2:
+                meminfo[fields[0]] = int(fields[1])
+        pagesizekb = meminfo.get('Hugepagesize', 2048)
+        # shared_buffers is Decimal MB from convert_humanfriendly_to_MB, mixed with floats below
+        sharedmb = float(self.shared_buffers)
+        total, free, rsvd = meminfo.get('HugePages_Total', 0), meminfo.get('HugePages_Free', 0), meminfo.get('HugePages_Rsvd', 0)
+
+        if 'shared_memory_size_in_huge_pages' in settings and int(settings['shared_memory_size_in_huge_pages']) > 0:
+            required = int(settings['shared_memory_size_in_huge_pages'])
+            how = "as reported by shared_memory_size_in_huge_pages"
+        else:
+            walmb = int(settings['wal_buffers']) * int(settings['block_size']) / 1048576.0
+            required = int(math.ceil((sharedmb * 1.02 + walmb + 64) * 1024 / pagesizekb))
+            how = "estimated from shared_buffers and wal_buffers"
+
+        hugepages = settings.get('huge_pages', 'off')
+        msg = ''
+        if hugepages == 'off':
+            if sharedmb >= HUGEPAGES_MIN_SHARED:
+                msg = "huge_pages is off with shared_buffers at %d GB, page tables already use %d MB.  Set vm.nr_hugepages = %d (%s) and huge_pages = on.  " % \
+                      (sharedmb / 1024, meminfo.get('PageTables', 0) / 1024, required, how)
+        elif total < required:
+            msg = "vm.nr_hugepages (%d) is below the %d huge pages of %d kB needed (%s), so huge_pages = %s %s.  " % \
+                  (total, required, pagesizekb, how, hugepages, 'falls back to normal pages' if hugepages == 'try' else 'keeps the server from starting')
+        elif settings.get('huge_pages_status', '') == 'off' or (hugepages == 'try' and total - free + rsvd < required):
+            msg = "huge_pages = try but the server is not using huge pages (%d of %d in use).  " % (total - free + rsvd, total)
+
+        for name in ('enabled', 'defrag'):
+            rc, results = self.executecmd("cat /sys/kernel/mm/transparent_hugepage/%s" % name, False, probe='thp %s' % name)
+            if rc == SUCCESS and '[always]' in results:
+                msg += "Transparent huge pages %s is set to always, which causes latency spikes from compaction.  Set it to madvise or never.  " % name
+
+        if msg == '':
+            marker = MARK_OK
+            msg = "Huge pages: huge_pages = %s, %d of %d kB configured, %d needed (%s)." % (hugepages, total, pagesizekb, required, how)
+        else:
+            marker = MARK_WARN
+            msg = msg.strip()
+        self.appendcheck(marker, "Huge Pages", msg)
+
+        return SUCCESS, ""
+
+    ###########################################################
+    def get_iodevices(self):
+
+        # map the data directory and pg_wal to their /proc/diskstats device names by major:minor
+        devices = {}
+        for role, path in [('data', self.datadir), ('pg_wal', "%s%spg_wal" % (self.datadir, self.dir_delim))]:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            devices.setdefault("%d:%d" % (os.major(st.st_dev), os.minor(st.st_dev)), []).append(role)
+        names = {}
+        f = open('/proc/diskstats', 'r')
+        for line in f:
+            fields = line.split()
+            key = "%s:%s" % (fields[0], fields[1])
+            if key in devices:
+                names[fields[2]] = '+'.join(devices[key])
+        f.close()
+        return names
+
+    ###########################################################
+    def get_iosample(self, devices):
+
+        sample = {'t': time.time(), 'disks': {}, 'psi': {}, 'vmstat': {}}
+        f = open('/proc/diskstats', 'r')
+        for line in f:
+            fields = line.split()
+            if fields[2] in devices:
+                # reads, sectors read, ms reading, writes, sectors written, ms writing, ms doing I/O
+                sample['disks'][fields[2]] = [int(fields[idx]) for idx in (3, 5, 6, 7, 9, 10, 12)]
+        f.close()
+        for resource in ('io', 'memory'):
+            try:
+                f = open('/proc/pressure/%s' % resource, 'r')
+            except IOError:
+                # no PSI before linux 4.20, or disabled
+                continue
+            for line in f:
+                fields = line.split()
+                sample['psi']["%s %s" % (resource, fields[0])] = int(fields[-1].split('=')[1])
             f.close()
-            if self.html_format:
-                self.appendreport("<p><br></p>")
-
-        print ("")
-
-        if self.analyzecandidates == False:
-            return SUCCESS, ""
+        f = open('/proc/vmstat', 'r')
+        for line in f:
+            fields = line.split()
+            if fields[0] in ('pgfault', 'pgmajfault', 'pswpin', 'pswpout'):
+                sample['vmstat'][fields[0]] = int(fields[1])
+        f.close()
+        return sample
 
-        sql = "select n.nspname || '.' || c.relname as table, last_analyze, last_autoanalyze, last_vacuum, last_autovacuum, u.n_live_tup::bigint, c.reltuples::bigint, round((u.n_live_tup::float / CASE WHEN c.reltuples = 0 THEN 1.0 ELSE c.reltuples::float  END) * 100) as pct from pg_namespace n, pg_class c, pg_tables t, pg_stat_user_tables u where c.relnamespace = n.oid and n.nspname = t.schemaname and t.tablename = c.relname and t.schemaname = u.schemaname and t.tablename = u.relname and n.nspname not in ('information_schema','pg_catalog') and (((c.reltuples > 0 and round((u.n_live_tup::float / c.reltuples::float) * 100) < 50)) OR ((last_vacuum is null and last_autovacuum is null and last_analyze is null and last_autoanalyze is null ) or (now()::date  - last_vacuum::date > 60 AND now()::date - last_autovacuum::date > 60 AND now()::date  - last_analyze::date > 60 AND now()::date  - last_autoanalyze::date > 60))) order by n.nspname, c.relname"
+    ###########################################################
+    def start_iosampler(self):
+
+        # only for local linux servers, and not when the samples come from a capture archive
+        if self.iosample_seconds <= 0 or not self.local or not sys.platform.startswith('linux') or self.replayfile != '':
+            return
+        if len(self.enabled) > 0 and 'hostio' not in self.enabled:
+            return
+        devices = self.get_iodevices()
+        stop = threading.Event()
+        samples = []
+
+        def sampler():
+            while True:
+                samples.append(self.get_iosample(devices))
+                if stop.wait(self.iosample_seconds):
+                    samples.append(self.get_iosample(devices))
+                    return
+
+        thread = threading.Thread(target=sampler)
+        thread.daemon = True
+        thread.start()
+        self.iosampler = (thread, stop, samples, devices)
 
-        if self.html_format:
-            cmd = "psql %s --html -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-        else:
-            cmd = "psql %s -c \"%s\" > %s" % (self.connstring, sql, self.tempfile)
-            
-        rc, results = self.executecmd(cmd, False)
-        if rc != SUCCESS:
-            errors = "Unable to get user table stats: %d %s\nsql=%s\n" % (rc, results, sql)
-            aline = "%s" % (errors)
-            self.writeout(aline)
-            return rc, errors
+    ###########################################################
+    def stop_iosampler(self):
 
-        if self.html_format:
-            self.appendreport("<H4>List of tables that have not been analyzed or vacuumed (manual and auto) in the last 60 days or whose size has changed significantly (n_live_tup/reltuples * 100 < 50) and therefore candidates for manual vacuum analyze.</H4>")
-        else:    
-            self.appendreport("\nList of tables that have not been analyzed or vacuumed (manual and auto) in the last 60 days or whose size has changed significantly (n_live_tup/reltuples * 100 < 50) and therefore candidates for manual vacuum analyze.\n")
+        if self.iosampler is None:
+            return {'devices': {}, 'samples': []}
+        thread, stop, samples, devices = self.iosampler
+        stop.set()
+        thread.join()
+        self.iosampler = None
+        return {'devices': devices, 'samples': samples}
 
-        f = open(self.tempfile, "r")
-        lineno = 0
-        count  = 0
-        for line in f:
-            lineno = lineno + 1
-            if self.verbose:
-                #print ("%d line=%s" % (lineno,line))
-                pass
-            aline = line.strip()
-            if len(aline) < 1:
-                continue
-            elif '(0 rows)' in aline:
-                continue
+    ###########################################################
+    def do_report_hostio(self):
 
-            if lineno == 1:
-                if self.html_format:
-                    self.appendreport(aline)
-                else:
-                    self.appendreport("              %s\n" % aline)
-            else:
-                if self.html_format:
-                    self.appendreport(aline)
-                else:
-                    self.appendreport("%s\n" % aline)
+        result = self.probe("iosamples", self.stop_iosampler)
+        if result is None or len(result['samples']) < 2:
+            return SUCCESS, ""
+        devices, samples = result['devices'], result['samples']
+        first, last = samples[0], samples[-1]
+        elapsed = last['t'] - first['t']
+        if elapsed <= 0:
+            return SUCCESS, ""
 
-        if self.html_format:
-            self.appendreport("<p><br></p>")
-        f.close()
+        # averages over the whole run, peaks over single intervals
+        listrows = []
+        findings = []
+        for device, role in sorted(devices.items()):
+            peakiops, peakawait, peakutil = 0.0, 0.0, 0.0
+            for prev, cur in zip(samples[:-1], samples[1:]):
+                secs = cur['t'] - prev['t']
+                if secs < 0.5:
+                    # the final sample right after the last interval
+                    continue
+                delta = [a - b for a, b in zip(cur['disks'][device], prev['disks'][device])]
+                ios = delta[0] + delta[3]
+                peakiops = max(peakiops, ios / secs)
+                if ios > 0:
+                    peakawait = max(peakawait, float(delta[2] + delta[5]) / ios)
+                peakutil = max(peakutil, delta[6] / (secs * 10.0))
+            delta = [a - b for a, b in zip(last['disks'][device], first['disks'][device])]
+            ios = delta[0] + delta[3]
+            iawait = float(delta[2] + delta[5]) / ios if ios > 0 else 0.0
+            util = delta[6] / (elapsed * 10.0)
+            listrows.append([device, role, "%.0f" % (ios / elapsed), "%.0f" % peakiops, "%.1f" % (delta[1] * 512 / elapsed / 1048576), "%.1f" % (delta[4] * 512 / elapsed / 1048576),
+                             "%.1f" % iawait, "%.1f" % peakawait, "%.0f" % util, "%.0f" % peakutil])
+            if util > HOSTIO_MAX_UTIL or iawait > HOSTIO_MAX_AWAIT:
+                findings.append([device, "%s device %s is %.0f%% busy with %.1f ms average wait per I/O." % (role, device, util, iawait)])
+        title = "Host I/O for the data directory and pg_wal devices, sampled every %d seconds for %.0f seconds during the report." % (self.iosample_seconds, elapsed)
+        headers = ['device', 'used for', 'avg iops', 'peak iops', 'read MB/s', 'write MB/s', 'avg await ms', 'peak await ms', 'avg util pct', 'peak util pct']
+        self.appendlist(title, headers, listrows)
+
+        # PSI totals are microseconds stalled
+        listrows = []
+        stalled = 0.0
+        for name in sorted(last['psi'].keys()):
+            pct = (last['psi'][name] - first['psi'][name]) / (elapsed * 10000.0)
+            listrows.append([name, "%.2f" % pct])
+            if name.startswith('io') and pct > HOSTIO_MAX_STALL:
+                stalled = max(stalled, pct)
+                findings.append([name, "Tasks were stalled on I/O (%s) %.1f%% of the time." % (name, pct)])
+        for name in ('pgfault', 'pgmajfault', 'pswpin', 'pswpout'):
+            if name in last['vmstat']:
+                listrows.append([name + ' per second', "%.1f" % ((last['vmstat'][name] - first['vmstat'][name]) / elapsed)])
+        if last['vmstat'].get('pswpout', 0) > first['vmstat'].get('pswpout', 0):
+            findings.append(['pswpout', "The host swapped out memory during the report."])
+        title = "Pressure stall (PSI) percentages and page fault and swap rates during the report."
+        self.appendlist(title, ['counter', 'value'], listrows)
+
+        # storage that is saturated explains checkpoint and writer problems found by the health checks
+        if len(findings) > 0 and self.checkpointwarn:
+            findings.append(['checkpoints', "The checkpoint frequency warning coincides with saturated storage: spread checkpoints (checkpoint_completion_target, max_wal_size) before adding I/O."])
+        if len(findings) > 0 and self.writerwarn:
+            findings.append(['writers', "The checkpoint/background/backend writer warning coincides with saturated storage: backends writing and fsyncing their own buffers wait on this device."])
+        if len(findings) > 0:
+            self.appendlist("Host I/O findings.", ['source', 'finding'], findings)
 
         return SUCCESS, ""
 
@@ -1296,21 +4065,14 @@ class maint:
         if self.pgversionmajor < Decimal('10.0'):
             marker = MARK_WARN
             msg = "(EOL) Unsupported major version detected: %.1f.  Please upgrade ASAP." % self.pgversionmajor
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Major Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"            
         elif self.pgversionmajor < Decimal('14.0'):
             marker = MARK_WARN        
             msg = "Current PG major version is not the latest (%.1f).  Consider upgrading to 14." % self.pgversionmajor
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Major Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                        
         else:
             marker = MARK_OK        
             msg = "Current PG major version is the latest (%.1f).  No major upgrade necessary." % self.pgversionmajor        
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">PG Major Version Summary</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"        
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg)
-        print (marker+msg)        
+        self.appendcheck(marker, "PG Major Version Summary", msg)
         
         # latest versions: 14.4, 13.7, 12.11, 11.16, 10.21, EOL(9.6.24)
         if self.pgversionmajor > Decimal('9.5'):
@@ -1318,42 +4080,30 @@ class maint:
                 # probably a newer minor version is already out since these minor versions were last updated in the program
                 marker = MARK_WARN
                 msg = "Current version: %s.  Please upgrade to latest minor version." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
             elif self.pgversionmajor == Decimal('9.6') and self.pgversionminor < '9.6.24':
                 marker = MARK_WARN
                 msg = "Current version: %s.  Please upgrade to latest minor version, 9.6.24." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
             elif self.pgversionmajor == Decimal('10.0') and self.pgversionminor < '10.21':
                 marker = MARK_WARN        
                 msg = "Current version: %s.  Please upgrade to latest minor version, 10.21." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
             elif self.pgversionmajor == Decimal('11.0') and self.pgversionminor < '11.16':
                 marker = MARK_WARN        
                 msg = "Current version: %s.  Please upgrade to latest minor version, 11.16." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
             elif self.pgversionmajor == Decimal('12.0') and self.pgversionminor < '12.11':
                 marker = MARK_WARN        
                 msg = "Current version: %s.  Please upgrade to latest minor version, 12.11." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
             elif self.pgversionmajor == Decimal('13.0') and self.pgversionminor < '13.7':
                 marker = MARK_WARN        
                 msg = "Current version: %s.  Please upgrade to latest minor version, 13.7." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
             elif self.pgversionmajor == Decimal('14.0') and self.pgversionminor < '14.4':
                 marker = MARK_WARN        
                 msg = "Current version: %s.  Please upgrade to latest minor version, 14.4." % self.pgversionminor
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                            
                 
             else:
                 marker = MARK_OK        
                 msg = "Current PG minor version is the latest (%s). No minor upgrade necessary." % self.pgversionminor        
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">PG Minor Version Summary</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"        
 
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg)
-            print (marker+msg)                
+            self.appendcheck(marker, "PG Minor Version Summary", msg)
 
 
         #####################
@@ -1368,19 +4118,12 @@ class maint:
             if not self.local:        
                 msg = 'Local Load Summary: N/A'
                 marker = MARK_OK        
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Local Load Summary</font></td><td width=\"75%\"><font color=\"blue\">" + 'N/A' + "</font></td></tr>"                
             elif rc == HIGHLOAD:
                 marker = MARK_WARN
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Local Load Summary</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"            
             else:
                 marker = MARK_OK        
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Local Load Summary</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"        
 
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg)
-            print (marker+msg)        
+            self.appendcheck(marker, "Local Load Summary", msg)
 
 
         #####################
@@ -1389,7 +4132,7 @@ class maint:
         # SELECT datname, blks_read, blks_hit, round((blks_hit::float/(blks_read+blks_hit+1)*100)::numeric, 2) as cachehitratio FROM pg_stat_database ORDER BY datname, cachehitratio
         sql = "SELECT blks_read, blks_hit, round((blks_hit::float/(blks_read+blks_hit+1)*100)::numeric, 2) as cachehitratio FROM pg_stat_database where datname = '%s' ORDER BY datname, cachehitratio" % self.database
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='cache hit ratio')
         if rc != SUCCESS:
             errors = "Unable to get database cache hit ratio: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1402,20 +4145,13 @@ class maint:
         if cache_ratio < Decimal('70.0'):
             marker = MARK_WARN
             msg = "low cache hit ratio: %.2f (blocks hit vs blocks read)" % cache_ratio
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10004;</font></td><td width=\"20%\"><font color=\"red\">Cache Hit Ratio</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
         elif cache_ratio < Decimal('90.0'):
             marker = MARK_WARN        
             msg = "Moderate cache hit ratio: %.2f (blocks hit vs blocks read)" % cache_ratio
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"red\">Cache Hit Ratio</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_OK
             msg = "High cache hit ratio: %.2f (blocks hit vs blocks read)" % cache_ratio
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Cache Hit Ratio</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Cache Hit Ratio", msg)
 
         ##########################
         # shared_preload_libraries
@@ -1423,16 +4159,10 @@ class maint:
         if 'pg_stat_statements' not in self.shared_preload_libraries:
             marker = MARK_WARN
             msg = "pg_stat_statements extension not loaded."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"red\">Shared Preload Libraries</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_OK
             msg = "pg_stat_statements loaded"
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Shared Preload Libraries</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"        
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Shared Preload Libraries", msg)
 
 
 
@@ -1441,7 +4171,7 @@ class maint:
         ######################################################
         sql = "select count(*) from pg_stat_activity"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='connections')
         if rc != SUCCESS:
             errors = "Unable to get count of current connections: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1457,16 +4187,10 @@ class maint:
             # 80 percent is the hard coded threshold
             marker = MARK_WARN        
             msg = "Current connections (%d) are greater than 80%% of max connections (%d) " % (conns, self.max_connections)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Connections</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_OK
             msg = "Current connections (%d) are not too close to max connections (%d) " % (conns, self.max_connections)
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Connections</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")            
-        print (marker+msg)
+        self.appendcheck(marker, "Connections", msg)
 
 
         #######################################################################
@@ -1481,7 +4205,7 @@ class maint:
             # select substring(query,1,50), round(EXTRACT(EPOCH FROM (now() - query_start))), now(), query_start, state  from pg_stat_activity;
             sql = "select count(*) from pg_stat_activity where state = \'idle in transaction\' and round(EXTRACT(EPOCH FROM (now() - query_start))) > 10"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='idle in transaction')
         if rc != SUCCESS:
             errors = "Unable to get count of idle in transaction connections: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1492,16 +4216,10 @@ class maint:
         if idle_in_transaction_cnt == 0:
             marker = MARK_OK
             msg = "No \"idle in transaction\" longer than 10 minutes were detected."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Idle In Transaction</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_WARN
             msg = "%d \"idle in transaction\" longer than 15 minutes were detected." % idle_in_transaction_cnt
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Idle In Transaction</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Idle In Transaction", msg)
 
 
         ######################################
@@ -1516,7 +4234,7 @@ class maint:
             # select pid,datname,usename, client_addr, now(), state, query_start, substring(query,1,100), now() - query_start as duration from pg_stat_activity where state not ilike 'idle%' and query <> ''::text and now() - query_start > interval '5 minutes';
             sql = "select count(*) from pg_stat_activity where state not ilike 'idle%' and query <> ''::text and now() - query_start > interval '5 minutes'"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='long running queries')
         if rc != SUCCESS:
             errors = "Unable to get count of long running queries: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1527,16 +4245,10 @@ class maint:
         if long_queries_cnt == 0:
             marker = MARK_OK
             msg = "No \"long running queries\" longer than 5 minutes were detected."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Long Running Queries</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_WARN
             msg = "%d \"long running queries\" longer than 5 minutes were detected." % long_queries_cnt
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Long Running Queries</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Long Running Queries", msg)
 
 
         ##########################################################
@@ -1554,7 +4266,7 @@ class maint:
             sql = "select count(*) from pg_stat_activity where wait_event is NOT NULL and wait_event not in ('DataFileRead') and state = 'active' and backend_type <> 'walsender' and now() - query_start > interval '30 seconds'"
 
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='blocked queries')
         if rc != SUCCESS:
             errors = "Unable to get count of blocked queries: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1564,21 +4276,40 @@ class maint:
         if blocked_queries_cnt == 0:
             marker = MARK_OK
             msg = "No \"Waiting/Blocked queries\" longer than 30 seconds were detected."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Waiting/Blocked queries</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_WARN
             msg = "%d \"Waiting/Blocked queries\" longer than 30 seconds were detected." % blocked_queries_cnt
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Waiting/Blocked queries</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Waiting/Blocked queries", msg)
 
         #################################
         # get archiving info if available
         #################################
-        rc, results = self.get_readycnt()
+        # pg_stat_archiver is cheap and works on cloud instances.  Counting archive_status files with pg_ls_dir
+        # is slow exactly when archiving is far behind and needs superuser, so it is only an optional fallback.
+        if self.archive_mode == 'off' or self.archive_mode == '':
+            rc = SUCCESS
+            marker = MARK_OK
+            msg = "Archiving is off so nothing to analyze."
+        elif self.archive_dircount or self.pgversionmajor < Decimal('10.0') or self.in_recovery:
+            rc, results = self.get_readycnt()
+            if rc == SUCCESS:
+                readycnt = int(results)
+                if self.verbose:
+                    print ("Ready Count = %d" % readycnt)
+                if readycnt > 1000:
+                    marker = MARK_WARN
+                    msg = "Archiving is behind more than 1000 WAL files. Current count: %d" % readycnt
+                elif readycnt == 0:
+                    marker = MARK_OK
+                    msg = "Archiving is on and no WAL backup detected."
+                else:
+                    marker = MARK_OK
+                    msg = "Archiving is working and not too far behind. WALs waiting to be archived=%d" % readycnt
+        else:
+            rc, results = self.get_archiverstatus()
+            if rc == SUCCESS:
+                marker, msg = results
+
         if rc == WARNING:
             errors = "Unable to get archiving status: %d %s" % (rc, results)
             aline = "%s" % (errors)
@@ -1589,52 +4320,12 @@ class maint:
             self.writeout(aline)
             return rc, errors
         else:
-            readycnt = int(results)
-            if self.verbose:
-                print ("Ready Count = %d" % readycnt)
-            if readycnt > 1000:
-                if self.html_format:
-                    marker = MARK_WARN
-                    msg = "Archiving is behind more than 1000 WAL files. Current count: %d" % readycnt
-                    html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Archiving Status</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
-            elif readycnt == 0:
-                if self.archive_mode == 'on':
-                    marker = MARK_OK
-                    msg = "Archiving is on and no WAL backup detected."            
-                    if self.html_format:
-                        html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Archiving Status</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
-                    else:
-                        msg = "Archiving Status: %s" % msg 
-                else:
-                    marker = MARK_OK
-                    msg = "Archiving is off so nothing to analyze."
-                    if self.html_format:
-                        html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Archiving Status</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
-                    else:
-                        msg = "Archiving Status: %s" % msg 
-            else:
-                marker = MARK_OK
-                msg = "Archiving is working and not too far behind. WALs waiting to be archived=%d" % readycnt
-                if self.html_format:
-                    html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Archiving Status</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
-                else:
-                    msg = "Archiving Status: %s" % msg 
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg+"\n")
-            print (marker+msg)
+            self.appendcheck(marker, "Archiving Status", msg)
 
         ###########################################################################################################################################
         # database conflicts: only applies to PG versions greater or equal to 9.1.  9.2 has additional fields of interest: deadlocks and temp_files
         ###########################################################################################################################################
         if self.pgversionmajor < Decimal('9.1'):
-            msg = "No database conflicts found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Database Conflicts</font></td><td width=\"75%\"><font color=\"blue\">N/A</font></td></tr>"
-            return SUCCESS, ""
-            print (msg)
-            if self.html_format:
-                self.appendreport(html)
             return SUCCESS, ""
 
         if self.pgversionmajor < Decimal('9.2'):
@@ -1642,7 +4333,7 @@ class maint:
         else:
             sql="select datname, conflicts, deadlocks, temp_files, temp_bytes from pg_stat_database where datname = '%s'" % self.database
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='database conflicts')
         if rc != SUCCESS:
             errors = "Unable to get database conflicts: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1665,17 +4356,11 @@ class maint:
         if conflicts > 0 or deadlocks > 0 or temp_files > 0:
             marker = MARK_WARN
             msg = "Database conflicts found: database=%s  conflicts=%d  deadlocks=%d  temp_files=%d  temp_bytes=%d" % (database, conflicts, deadlocks, temp_files, temp_bytes)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Database Conflicts (deadlocks, Query disk spillover, Standby cancelled queries)</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_OK
             msg = "No database conflicts found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Database Conflicts (deadlocks, Query disk spillover, Standby cancelled queries</font></td><td width=\"75%\"><font color=\"blue\">No database conflicts found.</font></td></tr>"
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Database Conflicts (deadlocks, Query disk spillover, Standby cancelled queries)", msg)
 
         ###############################################################################################################
         # Check for checkpoint frequency
@@ -1684,7 +4369,7 @@ class maint:
         ###############################################################################################################
         sql = "SELECT total_checkpoints, seconds_since_start / total_checkpoints / 60 AS minutes_between_checkpoints, checkpoints_timed, checkpoints_req, checkpoint_write_time, checkpoint_sync_time FROM (SELECT EXTRACT(EPOCH FROM (now() - pg_postmaster_start_time())) AS seconds_since_start, (checkpoints_timed+checkpoints_req) AS total_checkpoints, checkpoints_timed, checkpoints_req, checkpoint_write_time / 1000 as checkpoint_write_time, checkpoint_sync_time / 1000 as checkpoint_sync_time FROM pg_stat_bgwriter) AS sub"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='checkpoints')
         if rc != SUCCESS:
             errors = "Unable to get checkpoint frequency: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1704,28 +4389,22 @@ class maint:
         if minutes < Decimal('5.0'):
             marker = MARK_WARN
             msg = "Checkpoints are occurring too fast, every %.2f minutes, and taking about %d minutes on average." % (minutes, (avg_checkpoint_seconds / 60))
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Checkpoint Frequency</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
         elif minutes > Decimal('60.0'):
             marker = MARK_WARN
             msg = "Checkpoints are occurring too infrequently, every %.2f minutes, and taking about %d minutes on average." % (minutes, (avg_checkpoint_seconds / 60))
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Checkpoint Frequency</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                  
         else:
             marker = MARK_OK
             msg = "Checkpoints are occurring every %.2f minutes, and taking about %d minutes on average." % (minutes, (avg_checkpoint_seconds / 60))
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Checkpoint Frequency</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        self.appendcheck(marker, "Checkpoint Frequency", msg)
+        self.checkpointwarn = marker == MARK_WARN
 
         ####################################
         # Check some postgresql config parms
         ####################################
         sql = "with summary as (select name, setting from pg_settings where name in ('autovacuum', 'checkpoint_completion_target', 'data_checksums', 'idle_in_transaction_session_timeout', 'log_checkpoints', 'log_lock_waits',  'log_min_duration_statement', 'log_temp_files', 'shared_preload_libraries', 'track_activity_query_size') order by 1 ) select setting from summary order by name"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)        
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='settings')
         if rc != SUCCESS:
             errors = "Unable to get configuration parameters: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1783,18 +4462,11 @@ class maint:
 
         if msg != '':
             marker = MARK_WARN        
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Configuration Settings</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>" 
         else:
             marker = MARK_OK
             msg = "No configuration problems detected."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Configuration Settings</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"                         
-
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
 
-        print (marker+msg)
+        self.appendcheck(marker, "Configuration Settings", msg)
 
 
         
@@ -1804,7 +4476,7 @@ class maint:
         # v2.1 fix: divident could be zero and cause division by zero error, so check first.
         sql = "select buffers_checkpoint + buffers_checkpoint + buffers_clean + buffers_backend as buffers from pg_stat_bgwriter"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='bgwriter buffers')
         if rc != SUCCESS:
             errors = "Unable to get background/backend buffers count: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -1814,17 +4486,12 @@ class maint:
         if int(results) == 0:
             marker = MARK_WARN
             msg = "No buffers to check for checkpoint, background, or backend writers."
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10004;</font></td><td width=\"20%\"><font color=\"red\">Checkpoint/Background/Backend Writers</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg+"\n")
-            print (marker+msg)
+            self.appendcheck(marker, "Checkpoint/Background/Backend Writers", msg)
         else:            
             sql = "select checkpoints_timed, checkpoints_req, buffers_checkpoint, buffers_clean, maxwritten_clean, buffers_backend, buffers_backend_fsync, buffers_alloc, checkpoint_write_time / 1000 as checkpoint_write_time, checkpoint_sync_time / 1000 as checkpoint_sync_time, (100 * checkpoints_req) / (checkpoints_timed + checkpoints_req) AS checkpoints_req_pct,    pg_size_pretty(buffers_checkpoint * block_size / (checkpoints_timed + checkpoints_req)) AS avg_checkpoint_write,  pg_size_pretty(block_size * (buffers_checkpoint + buffers_clean + buffers_backend)) AS total_written,  100 * buffers_checkpoint / (buffers_checkpoint + buffers_clean + buffers_backend) AS checkpoint_write_pct,    100 * buffers_clean / (buffers_checkpoint + buffers_clean + buffers_backend) AS background_write_pct, 100 * buffers_backend / (buffers_checkpoint + buffers_clean + buffers_backend) AS backend_write_pct from pg_stat_bgwriter, (SELECT cast(current_setting('block_size') AS integer) AS block_size) bs"
 
             cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-            rc, results = self.executecmd(cmd, False)
+            rc, results = self.executecmd(cmd, False, probe='bgwriter')
             if rc != SUCCESS:
                 errors = "Unable to get background/backend writers: %d %s\nsql=%s\n" % (rc, results, sql)
                 aline = "%s" % (errors)
@@ -1877,18 +4544,12 @@ class maint:
                 marker = MARK_WARN
                 msg += "backends doing most of the cleaning. Consider increasing bgwriter_lru_multiplier and decreasing bgwriter_delay.  It could also be a problem with shared_buffers not being big enough."                        
            
-            if msg != '':
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Checkpoint/Background/Backend Writers</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>" 
-            else:
+            if msg == '':
                 marker = MARK_OK
                 msg = "No problems detected with checkpoint, background, or backend writers."
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Checkpoint/Background/Backend Writers</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
 
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg+"\n")
-            print (marker+msg)
+            self.appendcheck(marker, "Checkpoint/Background/Backend Writers", msg)
+            self.writerwarn = marker == MARK_WARN
 
 
         ########################
@@ -1899,102 +4560,106 @@ class maint:
             #NOTE: cannot run this against slaves since vacuumlo will attempt to create temp table
             numobjects = "-1"
         else:
-            # v1.2 fix: always use provided port number
-            if self.dbuser == '':
-                user_clause = "-p %s" % (self.dbport)
-            elif self.dbhost == '':
-                user_clause = " %s -U %s -p %s" % (self.dbuser, self.dbport)
+            rc, results = self.get_vacuumlo_cost() if self.max_query_cost > 0 else (SUCCESS, (0, 0, 0, 0))
+            if rc != SUCCESS:
+                self.writeout(results)
+                return rc, results
+            if self.skip_costly("Orphaned Large Objects", results[2]):
+                # -2: already reported as skipped
+                numobjects = "-2"
             else:
-                user_clause = " -h %s -U %s -p %s" % (self.dbhost, self.dbuser, self.dbport)
+                # v1.2 fix: always use provided port number
+                if self.dbuser == '':
+                    user_clause = "-p %s" % (self.dbport)
+                elif self.dbhost == '':
+                    user_clause = " %s -U %s -p %s" % (self.dbuser, self.dbport)
+                else:
+                    user_clause = " -h %s -U %s -p %s" % (self.dbhost, self.dbuser, self.dbport)
 
-            cmd = "%s/vacuumlo -n %s %s" % (self.pgbindir, user_clause, self.database)
-            rc, results = self.executecmd(cmd, False)
-            if rc != SUCCESS:
-                errors = "Unable to get orphaned large objects: %d %s\ncmd=%s\n" % (rc, results, cmd)
-                aline = "%s" % (errors)
-                self.writeout(aline)
-                return rc, errors
+                cmd = "%s/vacuumlo -n %s %s" % (self.pgbindir, user_clause, self.database)
+                rc, results = self.executecmd(cmd, False, probe='vacuumlo')
+                if rc != SUCCESS:
+                    errors = "Unable to get orphaned large objects: %d %s\ncmd=%s\n" % (rc, results, cmd)
+                    aline = "%s" % (errors)
+                    self.writeout(aline)
+                    return rc, errors
 
-            # expecting substring like this --> "Would remove 35 large objects from database "agmednet.core.image"."
-            numobjects = (results.split("Would remove"))[1].split("large objects")[0]
+                # expecting substring like this --> "Would remove 35 large objects from database "agmednet.core.image"."
+                numobjects = (results.split("Would remove"))[1].split("large objects")[0]
 
-        if int(numobjects) == -1:
+        marker = ''
+        if int(numobjects) == -2:
+            pass
+        elif int(numobjects) == -1:
             marker = MARK_OK
             msg = "N/A: Unable to detect orphaned large objects on slaves."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Orphaned Large Objects</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"             
         elif int(numobjects) == 0:
             marker = MARK_OK
             msg = "No orphaned large objects were found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Orphaned Large Objects</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
         else:
             marker = MARK_WARN
             msg = "%d orphaned large objects were found.  Consider running vacuumlo to remove them." % int(numobjects)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Orphaned Large Objects</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+        if marker != '':
+            self.appendcheck(marker, "Orphaned Large Objects", msg)
 
         ##################################
         # Check for bloated tables/indexes
         ##################################
-        sql = "SELECT count(*) FROM (SELECT  schemaname, tablename, cc.reltuples, cc.relpages, bs,  CEIL((cc.reltuples*((datahdr+ma- (CASE WHEN datahdr%ma=0 THEN ma ELSE datahdr%ma END))+nullhdr2+4))/(bs-20::FLOAT)) AS otta,  COALESCE(c2.relname,'?') AS iname, COALESCE(c2.reltuples,0) AS ituples, COALESCE(c2.relpages,0) AS ipages, COALESCE(CEIL((c2.reltuples*(datahdr-12))/(bs-20::FLOAT)),0) AS iotta FROM ( SELECT   ma,bs,schemaname,tablename,   (datawidth+(hdr+ma-(CASE WHEN hdr%ma=0 THEN ma ELSE hdr%ma END)))::NUMERIC AS datahdr,   (maxfracsum*(nullhdr+ma-(CASE WHEN nullhdr%ma=0 THEN ma ELSE nullhdr%ma END))) AS nullhdr2 FROM ( SELECT schemaname, tablename, hdr, ma, bs, SUM((1-null_frac)*avg_width) AS datawidth, MAX(null_frac) AS maxfracsum,  hdr+( SELECT 1+COUNT(*)/8 FROM pg_stats s2 WHERE null_frac<>0 AND s2.schemaname = s.schemaname AND s2.tablename = s.tablename ) AS nullhdr FROM pg_stats s, ( SELECT (SELECT current_setting('block_size')::NUMERIC) AS bs, CASE WHEN SUBSTRING(v,12,3) IN ('8.0','8.1','8.2') THEN 27 ELSE 23 END AS hdr, CASE WHEN v ~ 'mingw32' THEN 8 ELSE 4 END AS ma FROM (SELECT version() AS v) AS foo ) AS constants  GROUP BY 1,2,3,4,5 ) AS foo) AS rs  JOIN pg_class cc ON cc.relname = rs.tablename  JOIN pg_namespace nn ON cc.relnamespace = nn.oid AND nn.nspname = rs.schemaname AND nn.nspname <> 'information_schema' LEFT JOIN pg_index i ON indrelid = cc.oid LEFT JOIN pg_class c2 ON c2.oid = i.indexrelid ) AS sml where ROUND((CASE WHEN otta=0 THEN 0.0 ELSE sml.relpages::FLOAT/otta END)::NUMERIC,1) > 20 OR ROUND((CASE WHEN iotta=0 OR ipages=0 THEN 0.0 ELSE ipages::FLOAT/iotta END)::NUMERIC,1) > 20 or CASE WHEN relpages < otta THEN 0 ELSE bs*(sml.relpages-otta)::BIGINT END > 10737418240 OR CASE WHEN ipages < iotta THEN 0 ELSE bs*(ipages-iotta) END > 10737418240"
-        cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        sql = "select count(*) from (%s) as bloat" % self.get_bloat_sql()
+        rc, cost = self.query_cost(sql)
         if rc != SUCCESS:
-            errors = "Unable to get table/index bloat count: %d %s\nsql=%s\n" % (rc, results, sql)
-            aline = "%s" % (errors)
-            self.writeout(aline)
-            return rc, errors
-
-        if int(results) == 0:
-            marker = MARK_OK
+            self.writeout(cost)
+            return rc, cost
+        if self.skip_costly("Bloated Tables and/or Indexes", cost):
             self.bloatedtables = False
-            msg = "No bloated tables/indexes were found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Bloated Tables and/or Indexes</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"      
         else:
-            marker = MARK_WARN
-            self.bloatedtables = True
-            msg = "%d bloated tables/indexes were found (See output file for details)." % int(results)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Bloated Tables and/or Indexes</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"         
+            rc, rows = self.get_bloat_rows()
+            if rc != SUCCESS:
+                self.writeout(rows)
+                return rc, rows
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")
-        print (marker+msg)
+            if len(rows) == 0:
+                marker = MARK_OK
+                self.bloatedtables = False
+                msg = "No bloated tables/indexes were found."
+            else:
+                marker = MARK_WARN
+                self.bloatedtables = True
+                msg = "%d bloated tables/indexes were found (See output file for details)." % len(rows)
+
+            self.appendcheck(marker, "Bloated Tables and/or Indexes", msg)
 
 
         ##########################
         # Check for unused indexes
         ##########################
-        sql="SELECT count(*) FROM pg_stat_user_indexes JOIN pg_index USING(indexrelid) WHERE idx_scan = 0 AND idx_tup_read = 0 AND idx_tup_fetch = 0 AND NOT indisprimary AND NOT indisunique AND NOT indisexclusion AND indisvalid AND indisready AND pg_relation_size(indexrelid) > 8192"
-        cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        sql = "select count(*) from (%s) as unused" % self.get_unused_sql()
+        rc, cost = self.query_cost(sql)
         if rc != SUCCESS:
-            errors = "Unable to get unused indexes count: %d %s\nsql=%s\n" % (rc, results, sql)
-            aline = "%s" % (errors)
-            self.writeout(aline)
-            return rc, errors
-
-        if int(results) == 0:
-            marker = MARK_OK
+            self.writeout(cost)
+            return rc, cost
+        if self.skip_costly("Unused Indexes", cost):
             self.unusedindexes = False
-            msg = "No unused indexes were found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Unused Indexes</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
         else:
-            marker = MARK_WARN
-            self.unusedindexes = True
-            msg = "%d unused indexes were found (See output file for details)." % int(results)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Unused Indexes</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                        
+            cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
+            rc, results = self.executecmd(cmd, False, probe='unused index count')
+            if rc != SUCCESS:
+                errors = "Unable to get unused indexes count: %d %s\nsql=%s\n" % (rc, results, sql)
+                aline = "%s" % (errors)
+                self.writeout(aline)
+                return rc, errors
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")            
-        print (marker+msg)
+            if int(results) == 0:
+                marker = MARK_OK
+                self.unusedindexes = False
+                msg = "No unused indexes were found."
+            else:
+                marker = MARK_WARN
+                self.unusedindexes = True
+                msg = "%d unused indexes were found (See output file for details)." % int(results)
+
+            self.appendcheck(marker, "Unused Indexes", msg)
         
         ########################################################
         # Check for short-lived and extremely long connections #
@@ -2003,7 +4668,7 @@ class maint:
             "WHERE usename <> 'rdsadmin' AND datname IS NOT NULL AND " \
             "(backend_type not in ('logical replication launcher', 'autovacuum launcher') OR wait_event not in ('LogicalLauncherMain','AutoVacuumMain'))"
         cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        rc, results = self.executecmd(cmd, False, probe='connection time')
         if rc != SUCCESS:
             errors = "Unable to get average connection time: %d %s\nsql=%s\n" % (rc, results, sql)
             aline = "%s" % (errors)
@@ -2015,81 +4680,78 @@ class maint:
             # 24 hours, so warn to refresh connections
             marker = MARK_WARN
             msg = "Connections average more than 24 hours (%d). Consider refreshing these connections 2-3 times per day." % (avgsecs / 60)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Connection Time</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                                    
         elif avgsecs >= 300:
             marker = MARK_OK
             msg = "Connection duration averages more than 5 minutes (%d). This seems acceptable." % (avgsecs / 60)
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Connection Time</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"
         elif avgsecs < 300:
             marker = MARK_WARN
             msg = "Connections average less than 5 minutes (%d).  Use or tune a connection pooler to keep these connections alive longer." % (avgsecs / 60)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Connection Time</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                        
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")            
-        print (marker+msg)        
+        self.appendcheck(marker, "Connection Time", msg)
 
 
         ####################################
         # Check for vacuum freeze candidates
         ####################################
-        sql="WITH settings AS (select s.setting from pg_settings s where s.name = 'autovacuum_freeze_max_age') select count(c.*) from settings s, pg_class c, pg_namespace n WHERE n.oid = c.relnamespace and c.relkind = 'r' and pg_table_size(c.oid) > 1073741824 and round((age(c.relfrozenxid)::float / s.setting::float) * 100) > 50"
-        cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        # candidate rows are kept for the detail list, so the catalog is only scanned once
+        sql = self.get_freeze_sql()
+        rc, cost = self.query_cost(sql)
         if rc != SUCCESS:
-            errors = "Unable to get vacuum freeze candidate count: %d %s\nsql=%s\n" % (rc, results, sql)
-            aline = "%s" % (errors)
-            self.writeout(aline)
-            return rc, errors
-
-        if int(results) == 0:
-            marker = MARK_OK
+            self.writeout(cost)
+            return rc, cost
+        if self.skip_costly("Vacuum Freeze Candidates", cost):
             self.freezecandidates = False
-            msg = "No vacuum freeze candidates were found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Vacuum Freeze Candidates</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"           
+            self.freezerows = []
         else:
-            marker = MARK_WARN
-            self.freezecandidates = True
-            msg = "%d vacuum freeze candidates were found (See output file for details)." % int(results)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Vacuum Freeze Candidates</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"              
+            rc, rows = self.get_offload_rows(sql, probe='freeze candidates')
+            if rc != SUCCESS:
+                errors = "Unable to get vacuum freeze candidate count: %d %s\nsql=%s\n" % (rc, rows, sql)
+                aline = "%s" % (errors)
+                self.writeout(aline)
+                return rc, errors
+            self.freezerows = rows
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")            
-        print (marker+msg)
+            if len(rows) == 0:
+                marker = MARK_OK
+                self.freezecandidates = False
+                msg = "No vacuum freeze candidates (XID or multixact age) were found."
+            else:
+                marker = MARK_WARN
+                self.freezecandidates = True
+                msg = "%d vacuum freeze candidates (XID or multixact age) were found (See output file for details)." % len(rows)
+
+            self.appendcheck(marker, "Vacuum Freeze Candidates", msg)
 
 
         ##############################
         # Check for analyze candidates
         ##############################
-        sql="select count(*) from pg_namespace n, pg_class c, pg_tables t, pg_stat_user_tables u where c.relnamespace = n.oid and n.nspname = t.schemaname and t.tablename = c.relname and t.schemaname = u.schemaname and t.tablename = u.relname and n.nspname not in ('information_schema','pg_catalog') and (((c.reltuples > 0 and round((u.n_live_tup::float / c.reltuples::float) * 100) < 50)) OR ((last_vacuum is null and last_autovacuum is null and last_analyze is null and last_autoanalyze is null ) or (now()::date  - last_vacuum::date > 60 AND now()::date - last_autovacuum::date > 60 AND now()::date  - last_analyze::date > 60 AND now()::date  - last_autoanalyze::date > 60)))"
-        cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
-        rc, results = self.executecmd(cmd, False)
+        sql = "select count(*) from %s" % self.get_analyze_from()
+        rc, cost = self.query_cost(sql)
         if rc != SUCCESS:
-            errors = "Unable to get vacuum analyze candidate count: %d %s\nsql=%s\n" % (rc, results, sql)
-            aline = "%s" % (errors)
-            self.writeout(aline)
-            return rc, errors
-
-        if int(results) == 0:
-            marker = MARK_OK
+            self.writeout(cost)
+            return rc, cost
+        if self.skip_costly("Vacuum Analyze Candidates", cost):
             self.analyzecandidates = False
-            msg = "No vacuum analyze candidates were found."
-            html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Vacuum Analyze Candidates</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"          
         else:
-            marker = MARK_WARN
-            self.analyzecandidates = True
-            msg = "%d vacuum analyze candidate(s) were found (See output file for details)." % int(results)
-            html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Vacuum Analyze Candidates</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"             
+            cmd = "psql %s -t -c \"%s\"" % (self.connstring, sql)
+            rc, results = self.executecmd(cmd, False, probe='analyze candidates')
+            if rc != SUCCESS:
+                errors = "Unable to get vacuum analyze candidate count: %d %s\nsql=%s\n" % (rc, results, sql)
+                aline = "%s" % (errors)
+                self.writeout(aline)
+                return rc, errors
 
-        if self.html_format:
-            self.appendreport(html)
-        else:
-            self.appendreport(marker+msg+"\n")            
-        print (marker+msg)
+            if int(results) == 0:
+                marker = MARK_OK
+                self.analyzecandidates = False
+                msg = "No vacuum analyze candidates were found."
+            else:
+                marker = MARK_WARN
+                self.analyzecandidates = True
+                msg = "%d vacuum analyze candidate(s) were found (See output file for details)." % int(results)
+
+            self.appendcheck(marker, "Vacuum Analyze Candidates", msg)
 
 
         #############################################
@@ -2119,7 +4781,7 @@ class maint:
             '''
 
             cmd =  "ss -an state time-wait | wc -l"
-            rc, results = self.executecmd(cmd, False)
+            rc, results = self.executecmd(cmd, False, probe='time-wait')
             if rc != SUCCESS:
                 errors = "Unable to get network standby connections count: %d %s\nsql=%s\n" % (rc, results, sql)
                 aline = "%s" % (errors)
@@ -2129,54 +4791,41 @@ class maint:
             if standby < 1000:
                 marker = MARK_OK
                 msg = "Network: Relatively few network standby connections (%d)." % standby
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Network Standby Connections</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"    
             else:
                 marker = MARK_WARN  
                 msg = "Network: High number of standby connections: %d.  This may indicate a lot of short-lived connections and the absence of a connection pooler." % standby
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Network Standby Connections</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"       
 
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg+"\n")                
-            print (marker+msg)
+            self.appendcheck(marker, "Network Standby Connections", msg)
 
             msg = ''
             if self.overcommit_memory == 0:
                 marker = MARK_WARN              
                 msg = "Kernel memory overcommitment is currently allowed (default setting: 0).  The OOM Killer may kill at least one of the PostgreSQL processes, which may lead to data corruption."
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Kernel Memory Capacity</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                       
             else:
                 marker = MARK_OK
                 msg = "Kernel Memory Capacity: OOM Killer is disabled (%d)." % self.overcommit_memory
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Kernel Memory Capacity</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"                
             
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg+"\n")                
-            print (marker+msg)
+            self.appendcheck(marker, "Kernel Memory Capacity", msg)
 
             if self.overcommit_ratio <= 50:
                 marker = MARK_WARN              
                 msg = "Kernel memory overcommit ratio is too low (%d). Consider increasing to 70 or higher." % self.overcommit_ratio
-                html = "<tr><td width=\"5%\"><font color=\"red\">&#10060;</font></td><td width=\"20%\"><font color=\"red\">Kernel Memory Capacity</font></td><td width=\"75%\"><font color=\"red\">" + msg + "</font></td></tr>"                       
             else:
                 marker = MARK_OK
                 msg = "Kernel Memory Capacity: overcommit ratio is OK (%d)." % self.overcommit_memory
-                html = "<tr><td width=\"5%\"><font color=\"blue\">&#10004;</font></td><td width=\"20%\"><font color=\"blue\">Kernel Memory Capacity</font></td><td width=\"75%\"><font color=\"blue\">" + msg + "</font></td></tr>"                
             
-            if self.html_format:
-                self.appendreport(html)
-            else:
-                self.appendreport(marker+msg+"\n")                
-            print (marker+msg)
+            self.appendcheck(marker, "Kernel Memory Capacity", msg)
 
 
         ########################################
         ### end of linux only network checks ###
         ########################################
 
+        if self.opsys == 'posix' and self.local:
+            rc, results = self.check_hugepages()
+            if rc != SUCCESS:
+                return rc, results
+
         if self.html_format:
             # finish special table format
             self.appendreport("</table>")
@@ -2188,11 +4837,276 @@ class maint:
 
     ###########################################################
     def delay(self, freeze):
+
+        # wait before starting the next maintenance job while the load is above the threshold.  Load is only
+        # measured on the db host itself, so remote runs never pause.
+        if not self.local:
+            return SUCCESS, ""
+        while True:
+            rc, results = self.check_load()
+            if rc != HIGHLOAD:
+                return SUCCESS, ""
+            if self.maint_deadline > 0 and time.time() + self.maint_pause > self.maint_deadline:
+                return ERROR, "Maximum duration reached while waiting for the load to drop."
+            print ("Pausing %s: %s" % ('vacuum freeze' if freeze else 'analyze', results))
+            time.sleep(self.maint_pause)
+
+    ###########################################################
+    def get_maintenance_queue(self):
+
+        # freeze candidates come first and are already ordered by how close they are to wraparound.  Analyze
+        # candidates follow, never analyzed tables first, then the oldest last (auto)analyze.
+        queue = []
+        for row in self.freezerows:
+            queue.append(['VACUUM (FREEZE)', row[1], row[2]])
+
+        if self.analyzecandidates == True:
+            sql = "select n.nspname, c.relname from %s order by greatest(last_analyze, last_autoanalyze) nulls first, n.nspname, c.relname" % self.get_analyze_from()
+            rc, rows = self.get_rows(sql, probe='analyze list')
+            if rc != SUCCESS:
+                return rc, "Unable to get analyze candidates: %d %s\nsql=%s\n" % (rc, rows, sql)
+            for row in rows:
+                queue.append(['ANALYZE', row[0], row[1]])
+
+        return SUCCESS, queue
+
+    ###########################################################
+    def get_vacuum_progress(self):
+
+        if self.pgversionmajor < Decimal('9.6'):
+            return SUCCESS, []
+        sql = "select p.relid::regclass, p.phase, p.heap_blks_scanned, p.heap_blks_total, round(p.heap_blks_scanned * 100.0 / greatest(p.heap_blks_total, 1)) " \
+              "from pg_stat_progress_vacuum p join pg_stat_activity a on a.pid = p.pid where a.application_name = '%s'" % self.maint_appname
+        return self.get_rows(sql, probe='vacuum progress')
+
+    ###########################################################
+    def do_maintenance(self):
+
+        # Run VACUUM (FREEZE) and ANALYZE on the candidates found by the health checks.  Up to --jobs run at once,
+        # each in its own psql session, and never two on the same table since they would just wait on each other.
+        # Nothing new is started while the load is high or once --maxduration has passed, running jobs are allowed
+        # to finish.
+        if not self.execute:
+            return SUCCESS, ""
+
+        rc, queue = self.get_maintenance_queue()
+        if rc != SUCCESS:
+            self.writeout(queue)
+            return rc, queue
+        if len(queue) == 0:
+            print ("No maintenance candidates to execute.")
+            return SUCCESS, ""
+
+        title = "Maintenance executed on vacuum freeze and analyze candidates."
+        headers = ['command', 'schema', 'table', 'status', 'seconds', 'message']
+        if self.maxduration > 0:
+            self.maint_deadline = time.time() + self.maxduration * 60
+        env = dict(os.environ)
+        env['PGAPPNAME'] = self.maint_appname
+
+        rows = []
+        running = []
+        lastprogress = time.time()
+        stopped = ''
+        while len(queue) > 0 or len(running) > 0:
+
+            # reap finished jobs
+            for job in running[:]:
+                p, action, nspname, relname, started = job
+                if p.poll() is None:
+                    continue
+                running.remove(job)
+                out, err = p.communicate()
+                elapsed = "%.1f" % (time.time() - started)
+                if p.returncode == SUCCESS:
+                    status, message = 'done', ''
+                else:
+                    status, message = 'failed', bytes(err).decode('utf-8').strip()
+                print ("%s %s.%s %s in %s seconds. %s" % (action, nspname, relname, status, elapsed, message))
+                rows.append([action, nspname, relname, status, elapsed, message])
+
+            # start the next job whose table is not already being worked on
+            if len(queue) > 0 and len(running) < self.jobs and stopped == '':
+                busy = [(job[2], job[3]) for job in running]
+                nextjob = None
+                for item in queue:
+                    if (item[1], item[2]) not in busy:
+                        nextjob = item
+                        break
+                if nextjob is not None:
+                    action, nspname, relname = nextjob
+                    if self.maint_deadline > 0 and time.time() >= self.maint_deadline:
+                        stopped = "Maximum duration of %d minutes reached." % self.maxduration
+                    else:
+                        rc, results = self.delay(action != 'ANALYZE')
+                        if rc != SUCCESS:
+                            stopped = results
+                    if stopped == '':
+                        queue.remove(nextjob)
+                        sql = "%s %s.%s" % (action, self.quoteident(nspname), self.quoteident(relname))
+                        cmd = "psql %s -X -q -c %s" % (self.connstring, self.shellquote(sql))
+                        print ("Starting %s" % sql)
+                        if self.opsys == 'posix':
+                            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, env=env, executable="/bin/bash")
+                        else:
+                            p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE, env=env)
+                        running.append([p, action, nspname, relname, time.time()])
+                        continue
+
+            if stopped != '' and len(running) == 0:
+                break
+
+            # per table progress of the running vacuums
+            if len(running) > 0 and time.time() - lastprogress >= self.maint_progress:
+                lastprogress = time.time()
+                rc, progress = self.get_vacuum_progress()
+                if rc == SUCCESS:
+                    for relid, phase, scanned, total, pct in progress:
+                        print ("  vacuum %s: %s, %s of %s heap blocks scanned (%s%%)" % (relid, phase, scanned, total, pct))
+            time.sleep(1)
+
+        for action, nspname, relname in queue:
+            rows.append([action, nspname, relname, 'skipped', '', stopped])
+        if stopped != '':
+            print ("%s %d maintenance job(s) skipped." % (stopped, len(queue)))
+        self.appendlist(title, headers, rows)
+
         return SUCCESS, ""
        
 
 ##### END OF CLASS DEFINITION
 
+#############################################################################################
+# log analyzer workers: module level so the process pool can pickle them
+#############################################################################################
+def new_log_stats():
+    return {'bytes': 0, 'records': 0, 'checkpoints': {}, 'lockwaits': {}, 'tempfiles': [0, 0, 0, [0] * (len(LOG_TEMP_BUCKETS) + 1)], 'slow': {}}
+
+def merge_log_stats(stats, part):
+    stats['bytes']   += part['bytes']
+    stats['records'] += part['records']
+    for kind, values in part['checkpoints'].items():
+        old = stats['checkpoints'].setdefault(kind, [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        stats['checkpoints'][kind] = [old[0] + values[0], old[1] + values[1], max(old[2], values[2]), old[3] + values[3], old[4] + values[4], max(old[5], values[5])]
+    for key, values in part['lockwaits'].items():
+        old = stats['lockwaits'].setdefault(key, [0, 0, 0.0, 0.0])
+        stats['lockwaits'][key] = [old[0] + values[0], old[1] + values[1], old[2] + values[2], max(old[3], values[3])]
+    temp = stats['tempfiles']
+    stats['tempfiles'] = [temp[0] + part['tempfiles'][0], temp[1] + part['tempfiles'][1], max(temp[2], part['tempfiles'][2]),
+                          [a + b for a, b in zip(temp[3], part['tempfiles'][3])]]
+    for key, values in part['slow'].items():
+        old = stats['slow'].setdefault(key, [0, 0.0, 0.0])
+        stats['slow'][key] = [old[0] + values[0], old[1] + values[1], max(old[2], values[2])]
+    return stats
+
+def fingerprint_statement(sql):
+    # literals and numbers become ?, IN lists collapse, so the same statement with other values groups together
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\$\d+|\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\s+', ' ', sql).strip().lower()
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(...)', sql)
+    return sql[:200]
+
+def read_log_records(mm, fmt, start, end, limit):
+    # Yield the records that start in [start, end).  A chunk can start in the middle of a record, so skip ahead
+    # to the next record start: stderr continuation lines start with a tab, csvlog records start with a timestamp
+    # and continue while a quoted field is open.  The last record may run past end, but never past limit.
+    pos = start
+    if pos > 0 and mm[pos - 1:pos] != b'\n':
+        pos = mm.find(b'\n', pos, limit) + 1
+        if pos == 0:
+            return
+    while pos < end:
+        nextpos = mm.find(b'\n', pos, limit) + 1
+        if nextpos == 0:
+            nextpos = limit
+        line = mm[pos:nextpos].decode('utf-8', 'replace')
+        if (fmt == 'stderr' and line.startswith('\t')) or (fmt == 'csvlog' and not LOG_RE_START.match(line)):
+            pos = nextpos
+            continue
+        record = line
+        while nextpos < limit:
+            if fmt == 'csvlog':
+                if record.count('"') % 2 == 0:
+                    break
+            elif fmt != 'stderr' or mm[nextpos:nextpos + 1] != b'\t':
+                break
+            following = mm.find(b'\n', nextpos, limit) + 1
+            if following == 0:
+                following = limit
+            record += mm[nextpos:following].decode('utf-8', 'replace')
+            nextpos = following
+        yield record
+        pos = nextpos
+
+def analyze_log_chunk(chunk):
+    path, fmt, start, end, limit = chunk
+    stats = new_log_stats()
+    f = open(path, "rb")
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    stats['bytes'] = end - start
+    for record in read_log_records(mm, fmt, start, end, limit):
+        stats['records'] += 1
+        if fmt == 'csvlog':
+            try:
+                fields = next(csv.reader([record.rstrip('\r\n')]))
+                message = fields[13]
+            except (csv.Error, IndexError, StopIteration):
+                continue
+        elif fmt == 'jsonlog':
+            try:
+                message = json.loads(record).get('message', '')
+            except ValueError:
+                continue
+        else:
+            match = LOG_RE_LEVEL.search(record)
+            if not match:
+                continue
+            message = record[match.end():].replace('\n\t', '\n')
+
+        match = LOG_RE_DURATION.match(message)
+        if match:
+            key = fingerprint_statement(match.group(2))
+            ms = float(match.group(1))
+            old = stats['slow'].setdefault(key, [0, 0.0, 0.0])
+            stats['slow'][key] = [old[0] + 1, old[1] + ms, max(old[2], ms)]
+            continue
+        match = LOG_RE_TEMPFILE.match(message)
+        if match:
+            size = int(match.group(1))
+            temp = stats['tempfiles']
+            temp[0] += 1
+            temp[1] += size
+            temp[2] = max(temp[2], size)
+            bucket = len(LOG_TEMP_BUCKETS)
+            for idx, upper in enumerate(LOG_TEMP_BUCKETS):
+                if size < upper:
+                    bucket = idx
+                    break
+            temp[3][bucket] += 1
+            continue
+        match = LOG_RE_LOCKWAIT.match(message)
+        if match:
+            # transaction ids and tuple positions differ on every wait, the relation is the hot spot
+            lockobject = re.sub(r'(virtual transaction|transaction) [\d/]+', r'\1', match.group(3))
+            lockobject = re.sub(r'(tuple|page) \(?[\d,]+\)?', r'\1', lockobject)
+            key = "%s|%s" % (match.group(2), lockobject)
+            ms = float(match.group(4))
+            old = stats['lockwaits'].setdefault(key, [0, 0, 0.0, 0.0])
+            if match.group(1) == 'still waiting for':
+                stats['lockwaits'][key] = [old[0] + 1, old[1], old[2], max(old[3], ms)]
+            else:
+                stats['lockwaits'][key] = [old[0], old[1] + 1, old[2] + ms, max(old[3], ms)]
+            continue
+        match = LOG_RE_CHECKPOINT.match(message)
+        if match:
+            write, sync, total = float(match.group(2)), float(match.group(3)), float(match.group(4))
+            old = stats['checkpoints'].setdefault(match.group(1), [0, 0.0, 0.0, 0.0, 0.0, 0.0])
+            stats['checkpoints'][match.group(1)] = [old[0] + 1, old[1] + total, max(old[2], total), old[3] + write, old[4] + sync, max(old[5], sync)]
+    mm.close()
+    f.close()
+    return stats
+
 #############################################################################################
 def setupOptionParser():
     parser = OptionParser(add_help_option=False, description=DESCRIPTION)
@@ -2204,45 +5118,187 @@ def setupOptionParser():
     parser.add_option("-m", "--html",           dest="html", help="html report format",                         default=False, action="store_true")
     parser.add_option("-r", "--dryrun",         dest="dryrun", help="Dry Run Only",                             default=False, action="store_true")
     parser.add_option("-v", "--verbose",        dest="verbose", help="Verbose Output",                          default=False, action="store_true")
+    parser.add_option("--topn",                 dest="topn", help="number of rows in top-N workload lists",     default="10", metavar="TOPN")
+    parser.add_option("--ash",                  dest="ash", help="sample active sessions for this many seconds", default="0", metavar="SECONDS")
+    parser.add_option("--ash-interval",         dest="ash_interval", help="seconds between active session samples", default="0.5", metavar="INTERVAL")
+    parser.add_option("--walsample",            dest="walsample", help="seconds between WAL position samples, 0 to skip", default="5", metavar="SECONDS")
+    parser.add_option("--archive-dircount",     dest="archive_dircount", help="count archive_status files instead of using pg_stat_archiver", default=False, action="store_true")
+    parser.add_option("--gzip",                 dest="gzip", help="gzip compress the report file",            default=False, action="store_true")
+    parser.add_option("--capture",              dest="capture", help="only collect data and write it to this compressed archive", default="", metavar="FILE")
+    parser.add_option("--replay",               dest="replay", help="generate the report from a capture archive, no database needed", default="", metavar="FILE")
+    parser.add_option("--execute",              dest="execute", help="vacuum freeze and analyze the candidates found", default=False, action="store_true")
+    parser.add_option("--jobs",                 dest="jobs", help="maximum concurrent maintenance jobs with --execute", default="1", metavar="JOBS")
+    parser.add_option("--maxduration",          dest="maxduration", help="minutes after which no new maintenance jobs are started, 0 for no limit", default="0", metavar="MINUTES")
+    parser.add_option("--checks",               dest="checks", help="comma separated report sections to run, default all", default="", metavar="CHECKS")
+    parser.add_option("--results",              dest="results", help="also write the check results and lists as json to this file", default="", metavar="FILE")
+    parser.add_option("--logs",                 dest="logs", help="analyze the server log files of a local server", default=False, action="store_true")
+    parser.add_option("--log-jobs",             dest="log_jobs", help="worker processes for --logs, default one per cpu", default="0", metavar="JOBS")
+    parser.add_option("--export",               dest="export", help="write the bloat, unused index, freeze and analyze lists as gzip csv files to this directory", default="", metavar="DIR")
+    parser.add_option("--offload-to",           dest="offload_to", help="run heavy catalog queries on this standby (dsn), or auto", default="", metavar="DSN")
+    parser.add_option("--compare",              dest="compare", help="compare two results files or snapshots, no database needed", default=None, nargs=2, metavar="OLD NEW")
+    parser.add_option("--checksdir",            dest="checksdir", help="directory of *.sql checks to run with the built-in ones", default="", metavar="DIR")
+    parser.add_option("--partitions",           dest="partitions", help="roll partitions up to their partitioned table in the bloat, freeze and analyze lists", default=False, action="store_true")
+    parser.add_option("--max-query-cost",       dest="max_query_cost", help="skip checks whose estimated query cost is above this, 0 for no limit", default="0", metavar="COST")
+    parser.add_option("--iosample",             dest="iosample", help="seconds between host I/O samples for local servers, 0 to skip", default="2", metavar="SECONDS")
+    parser.add_option("--statedir",             dest="statedir", help="directory for snapshots kept between runs", default=tempfile.gettempdir(), metavar="STATEDIR")
 
     return parser
 
 #############################################################################################
 
-#################################################################
-#################### MAIN ENTRY POINT ###########################
-#############################################@###################
-
-optionParser   = setupOptionParser()
-(options,args) = optionParser.parse_args()
-
-# load the instance
-pg = maint()
+#############################################################################################
+def make_report(options, argv=None, shared=None, quiet=False):
+
+    # run one report for one set of parsed options, returns rc, results and the maint instance.  argv is the
+    # command line (sys.argv when None), shared holds the host probes and caches run_report keeps between targets,
+    # quiet leaves the console alone.
+    pg = maint()
+    if shared is not None:
+        pg.shared = shared
+    pg.quiet = quiet
+
+    # comparing two saved runs needs no database either
+    if options.compare is not None:
+        pg.html_format = options.html
+        pg.gzip        = options.gzip
+        pg.verbose     = options.verbose
+        rc, results = pg.do_compare(options.compare[0], options.compare[1])
+        if rc == SUCCESS and options.results != '':
+            rc, results = pg.save_results(options.results)
+        return rc, results, pg
+
+    # replaying a capture archive needs no database, the connection parameters come from the archive
+    if options.replay != '':
+        rc, results = pg.load_capture(options.replay)
+        if rc != SUCCESS:
+            return rc, results, pg
+        options.dbhost   = results['dbhost']
+        options.dbport   = results['dbport']
+        options.dbuser   = results['dbuser']
+        options.database = results['database']
+        options.schema   = results['schema']
+
+    # maintenance and exports have to run against the live database
+    if options.execute and (options.replay != '' or options.capture != ''):
+        return ERROR, "--execute cannot be combined with --capture or --replay.", pg
+    if options.export != '' and (options.replay != '' or options.capture != ''):
+        return ERROR, "--export cannot be combined with --capture or --replay.", pg
+
+    if options.database == '':
+        return ERROR, "You must provide some input parameters like database name, etc.", pg
+
+    pg.topn     = int(options.topn)
+    pg.statedir = options.statedir
+    pg.ash_seconds  = int(options.ash)
+    pg.ash_interval = float(options.ash_interval)
+    if pg.ash_interval <= 0:
+        return ERROR, "--ash-interval must be greater than 0.", pg
+    pg.walsample_seconds = int(options.walsample)
+    pg.archive_dircount  = options.archive_dircount
+    pg.gzip              = options.gzip
+    pg.capturefile       = options.capture
+    pg.execute           = options.execute
+    pg.jobs              = max(int(options.jobs), 1)
+    pg.maxduration       = int(options.maxduration)
+    pg.logs              = options.logs
+    pg.iosample_seconds  = int(options.iosample)
+    pg.log_jobs          = int(options.log_jobs)
+    pg.max_query_cost    = float(options.max_query_cost)
+    pg.partitions        = options.partitions
+    pg.checksdir         = options.checksdir
+    pg.offloadto         = options.offload_to
+    pg.exportdir         = options.export
+    if options.checks != '':
+        pg.enabled = [check.strip() for check in options.checks.split(',')]
+        unknown = [check for check in pg.enabled if check not in [section for section, method in REPORT_SECTIONS]]
+        if len(unknown) > 0:
+            return ERROR, "Unknown check(s): %s.  Valid checks: %s" % (', '.join(unknown), ', '.join([section for section, method in REPORT_SECTIONS])), pg
+
+    # temp files are removed however the report ends, a scheduler runs many of them in one process
+    try:
+        # Load and validate parameters
+        rc, errors = pg.set_dbinfo(options.dbhost, options.dbport, options.dbuser, options.database, options.schema, \
+                                   options.html, options.dryrun, options.verbose, sys.argv if argv is None else argv)
+        if rc != SUCCESS:
+            return rc, errors, pg
+
+        if not quiet:
+            print ("%s  version: %.1f  %s     Python Version: %d     PG Version: %s     PG Database: %s\n\n" % (PROGNAME, VERSION, ADATE, sys.version_info[0], pg.pgversionminor, pg.database))
+
+        rc, results = pg.do_report()
+        if pg.capturefile != '':
+            rc2, results2 = pg.save_capture()
+            if rc2 != SUCCESS:
+                if not quiet:
+                    print (results2)
+                rc, results = rc2, results2
+            elif not quiet:
+                print ("capture archive generated: %s" % pg.capturefile)
+        if rc == SUCCESS and options.results != '':
+            rc, results = pg.save_results(options.results)
+        return rc, results, pg
+    finally:
+        pg.cleanup()
 
-# make sure we got a few input parms
-if options.database == '':
-    print ('You must provide some input parameters like database name, etc.')
-    optionParser.print_help()
-    sys.exit(1)
+#############################################################################################
+def run_report(targets, checks=None, options=None):
+    """
+    Library entry point: run the report in process for each target and return the structured results.
+
+    targets: a dict or a list of dicts with any of dbhost, dbport, dbuser, database, schema.
+    checks:  list of section names to run (see REPORT_SECTIONS), None runs them all.
+    options: dict of command line option names (the optparse dest, e.g. html, topn, statedir, ash) to values.
+    Returns a list with one dict per target: the target, rc, error and, when it ran, the checks and sections.
+
+    Nothing is printed, errors are in the results.  The targets share the host probes (psql and pg_config lookups, physical memory) and the
+    bloat caches of the state directory, which stay in memory for the whole call.  Every query is still a psql
+    run of its own, there is no session to keep open between targets.
+    """
+    if isinstance(targets, dict):
+        targets = [targets]
+    shared = {}
+    allresults = []
+    # quiet covers the report messages, the progress and diagnostic prints of the sections go to the null device
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        for target in targets:
+            opts = setupOptionParser().get_default_values()
+            for name, value in list((options or {}).items()) + list(target.items()):
+                setattr(opts, name, value)
+            if checks is not None:
+                opts.checks = ','.join(checks)
+            rc, results, pg = make_report(opts, argv=[], shared=shared, quiet=True)
+            result = {'target': target, 'rc': rc, 'error': results if rc != SUCCESS else ''}
+            if rc == SUCCESS:
+                result.update(pg.get_results())
+            allresults.append(result)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return allresults
 
-# Load and validate parameters
-rc, errors = pg.set_dbinfo(options.dbhost, options.dbport, options.dbuser, options.database, options.schema, \
-                           options.html, options.dryrun, options.verbose, sys.argv)
-if rc != SUCCESS:
-    print (errors)
-    optionParser.print_help()
-    sys.exit(1)
+#############################################################################################
+def main():
 
-print ("%s  version: %.1f  %s     Python Version: %d     PG Version: %s     PG Database: %s\n\n" % (PROGNAME, VERSION, ADATE, sys.version_info[0], pg.pgversionminor, pg.database))
+    optionParser   = setupOptionParser()
+    (options,args) = optionParser.parse_args()
 
-#print ("globals=%s" % globals())
-#print ("locals=%s" % locals())
+    # make sure we got a few input parms
+    if options.database == '' and options.replay == '' and options.compare is None:
+        print ('You must provide some input parameters like database name, etc.')
+        optionParser.print_help()
+        return 1
 
-rc, results = pg.do_report()
-if rc < SUCCESS:
-    pg.cleanup()
-    sys.exit(1)
+    rc, results, pg = make_report(options)
+    if rc < SUCCESS:
+        print (results)
+        return 1
+    return 0
 
-pg.cleanup()
+#################################################################
+#################### MAIN ENTRY POINT ###########################
+#############################################@###################
 
-sys.exit(0)
+if __name__ == '__main__':
+    sys.exit(main())
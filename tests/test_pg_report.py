@@ -0,0 +1,169 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import pg_report
+
+
+class ReplayTestCase(unittest.TestCase):
+    # a maint object that answers get_rows/executecmd from canned probes, the way --replay does
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pg = pg_report.maint()
+        self.pg.tempfile = os.path.join(self.tmpdir, 'temp.sql')
+        self.pg.workfile = os.path.join(self.tmpdir, 'work.sql')
+        self.pg.reportfile = os.path.join(self.tmpdir, 'report.txt')
+        self.pg.replayfile = os.path.join(self.tmpdir, 'capture.json.gz')
+        self.pg.probes = {}
+        self.pg.probeidx = {}
+        self.pg.snapshot = {}
+        self.pg.prevsnapshot = {}
+        self.pg.pgversionmajor = Decimal('16.0')
+        # the types set_dbinfo leaves behind
+        self.pg.shared_buffers = self.pg.convert_humanfriendly_to_MB('16GB')
+        self.pg.work_mem = self.pg.convert_humanfriendly_to_MB('4MB')
+        self.pg.maint_work_mem = self.pg.convert_humanfriendly_to_MB('1GB')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add_rows(self, probe, rows):
+        contents = ''.join(['|'.join([str(col) for col in row]) + '\n' for row in rows])
+        self.pg.probes.setdefault(probe, []).append([pg_report.SUCCESS, '', contents])
+
+    def add_output(self, probe, output):
+        self.pg.probes.setdefault(probe, []).append([pg_report.SUCCESS, output, None])
+
+
+class WorkmemModelTest(ReplayTestCase):
+
+    def setUp(self):
+        ReplayTestCase.setUp(self)
+        # 100 temp files of 64MB, 10 active sessions, 3 autovacuum workers using maintenance_work_mem, 8kB blocks
+        self.add_rows('workmem', [[100, 100 * 64 * 1048576, 0, 10, 3, -1, 8192, 1]])
+
+    def test_model_with_ram(self):
+        self.pg.totalmemGB = 64
+        rc, (recommended, evidence) = self.pg.get_workmem_model()
+        self.assertEqual(rc, pg_report.SUCCESS)
+        # budget: 75% of 64GB less 16GB shared_buffers less 3 x 1GB = 29696MB, per operation 29696 / (10 x 2) = 1484MB
+        # need: average temp file of 64MB x 2
+        self.assertEqual(recommended, 128)
+        self.assertIn(['work_mem budget', '29696 MB', '75% of RAM less shared_buffers and autovacuum memory'], evidence)
+
+    def test_model_capped_by_ram(self):
+        self.pg.totalmemGB = 20.5
+        rc, (recommended, evidence) = self.pg.get_workmem_model()
+        self.assertEqual(rc, pg_report.SUCCESS)
+        # budget: 15744 - 16384 - 3072 < 0, so the floor of 4MB per operation applies
+        self.assertEqual(recommended, 4)
+
+    def test_model_without_ram(self):
+        self.pg.totalmemGB = -1
+        rc, (recommended, evidence) = self.pg.get_workmem_model()
+        self.assertEqual(rc, pg_report.SUCCESS)
+        self.assertEqual(recommended, 128)
+
+
+class HugepagesTest(ReplayTestCase):
+
+    MEMINFO = "MemTotal:       65536000 kB\nPageTables:       204800 kB\nHugePages_Total:       0\nHugePages_Free:        0\n" \
+              "HugePages_Rsvd:        0\nHugepagesize:       2048 kB\n"
+
+    def run_check(self, settings):
+        self.add_rows('hugepages settings', settings)
+        self.add_output('meminfo', self.MEMINFO)
+        self.add_output('thp enabled', 'always madvise [never]')
+        self.add_output('thp defrag', 'always defer defer+madvise [madvise] never')
+        rc, results = self.pg.check_hugepages()
+        self.assertEqual(rc, pg_report.SUCCESS)
+        return self.pg.checks[-1]
+
+    def test_estimated_before_pg15(self):
+        # no shared_memory_size_in_huge_pages: (16384MB x 1.02 + 16MB wal_buffers + 64MB) / 2MB pages
+        check = self.run_check([['huge_pages', 'off'], ['wal_buffers', 2048], ['block_size', 8192]])
+        self.assertEqual(check['status'], 'warn')
+        self.assertIn('shared_buffers at 16 GB', check['message'])
+        self.assertIn('vm.nr_hugepages = 8396 (estimated from shared_buffers and wal_buffers)', check['message'])
+
+    def test_small_shared_buffers(self):
+        self.pg.shared_buffers = self.pg.convert_humanfriendly_to_MB('128MB')
+        check = self.run_check([['huge_pages', 'off'], ['wal_buffers', 512], ['block_size', 8192]])
+        self.assertEqual(check['status'], 'ok')
+
+    def test_reported_by_server(self):
+        check = self.run_check([['huge_pages', 'try'], ['huge_pages_status', 'off'], ['shared_memory_size_in_huge_pages', 8500],
+                                ['wal_buffers', 2048], ['block_size', 8192]])
+        self.assertEqual(check['status'], 'warn')
+        self.assertIn('8500 huge pages', check['message'])
+
+
+class CaptureStateTest(unittest.TestCase):
+    # a capture must leave the baseline and log offsets of the live runs alone
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.pg = pg_report.maint()
+        self.pg.capturefile = os.path.join(self.tmpdir, 'capture.json.gz')
+        self.pg.snapshotfile = os.path.join(self.tmpdir, 'snapshot.json')
+        self.pg.logoffsetsfile = os.path.join(self.tmpdir, 'logoffsets.json')
+        self.pg.snapshot = {'taken': 0, 'seqscans': {'1': [1, 2, 3]}}
+        self.pg.logoffsets = {'postgresql.log': 100}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_capture_saves_nothing(self):
+        self.assertEqual(self.pg.save_snapshot()[0], pg_report.SUCCESS)
+        self.assertEqual(self.pg.save_log_offsets()[0], pg_report.SUCCESS)
+        self.assertFalse(os.path.exists(self.pg.snapshotfile))
+        self.assertFalse(os.path.exists(self.pg.logoffsetsfile))
+
+    def test_live_run_saves_snapshot(self):
+        self.pg.capturefile = ''
+        self.assertEqual(self.pg.save_snapshot()[0], pg_report.SUCCESS)
+        self.assertTrue(os.path.exists(self.pg.snapshotfile))
+
+
+class SharedProbesTest(unittest.TestCase):
+    # run_report hands the same dict to each target, host probes run once
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_maint(self, shared):
+        pg = pg_report.maint()
+        pg.opsys = 'posix' if os.name == 'posix' else 'nt'
+        pg.tempfile = os.path.join(self.tmpdir, 'temp.sql')
+        pg.workfile = os.path.join(self.tmpdir, 'work.sql')
+        pg.shared = shared
+        return pg
+
+    def test_host_probe_runs_once(self):
+        shared = {}
+        rc, results = self.make_maint(shared).executecmd("echo first", True, probe='which psql')
+        self.assertEqual((rc, results.strip()), (pg_report.SUCCESS, 'first'))
+        rc, results = self.make_maint(shared).executecmd("echo second", True, probe='which psql')
+        self.assertEqual(results.strip(), 'first')
+        # database probes are never shared
+        rc, results = self.make_maint(shared).executecmd("echo second", True, probe='show all')
+        self.assertEqual(results.strip(), 'second')
+
+    def test_cleanup_removes_temp_files(self):
+        pg = self.make_maint({})
+        for afile in (pg.tempfile, pg.workfile):
+            open(afile, "w").close()
+        pg.cleanup()
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()